@@ -74,3 +74,28 @@ def stock_model():
     from django.apps import apps
 
     return apps.get_model(*settings.PLATA_STOCK_TRACKING_MODEL.split("."))
+
+
+stock_backend_cache = None
+
+
+def stock_backend():
+    """
+    Return the stock backend instance defined by the ``PLATA_STOCK_BACKEND``
+    setting or ``None`` in case stock transactions are turned off.
+    """
+    if not settings.PLATA_STOCK_TRACKING:
+        return None
+
+    global stock_backend_cache
+    if (
+        not stock_backend_cache
+        or stock_backend_cache[0] != settings.PLATA_STOCK_BACKEND
+    ):
+        from django.urls import get_callable
+
+        stock_backend_cache = (
+            settings.PLATA_STOCK_BACKEND,
+            get_callable(settings.PLATA_STOCK_BACKEND)(),
+        )
+    return stock_backend_cache[1]
@@ -71,6 +71,32 @@ PLATA_REPORTING_STATIONERY = getattr(
 #: PDF address line
 PLATA_REPORTING_ADDRESSLINE = getattr(settings, "PLATA_REPORTING_ADDRESSLINE", "")
 
+#: Dotted path to the storage (an instance or a class) generated invoices
+#: and packing slips are kept in, see ``plata.reporting.documents``.
+#: Documents are generated on every request if ``None``.
+PLATA_REPORTING_DOCUMENT_STORAGE = getattr(
+    settings, "PLATA_REPORTING_DOCUMENT_STORAGE", None
+)
+
+#: Number of processes rendering documents in batches, see
+#: ``plata.reporting.batch``. The number of CPUs is used if ``None``.
+PLATA_REPORTING_BATCH_PROCESSES = getattr(
+    settings, "PLATA_REPORTING_BATCH_PROCESSES", 2
+)
+
+#: Dotted path to the storage (an instance or a class) large order exports
+#: are written to in the background, see ``plata.reporting.export``. Exports
+#: are always streamed directly if ``None``.
+PLATA_REPORTING_EXPORT_STORAGE = getattr(
+    settings, "PLATA_REPORTING_EXPORT_STORAGE", None
+)
+
+#: Orders exported in the admin are exported in the background if more than
+#: this many orders have been selected
+PLATA_REPORTING_EXPORT_THRESHOLD = getattr(
+    settings, "PLATA_REPORTING_EXPORT_THRESHOLD", 10000
+)
+
 #: Transactional stock tracking
 #:
 #: ``'plata.product.stock'`` has to be included in ``INSTALLED_APPS`` for
@@ -79,6 +105,64 @@ PLATA_STOCK_TRACKING = getattr(settings, "PLATA_STOCK_TRACKING", False)
 PLATA_STOCK_TRACKING_MODEL = getattr(
     settings, "PLATA_STOCK_TRACKING_MODEL", "stock.StockTransaction"
 )
+#: The stock backend used by the checkout and payment processes, see
+#: ``plata.product.stock.backends``
+PLATA_STOCK_BACKEND = getattr(
+    settings, "PLATA_STOCK_BACKEND", "plata.product.stock.backends.DatabaseBackend"
+)
+#: Seconds the current stock period is cached in the process. ``0``
+#: disables the cache.
+PLATA_STOCK_PERIOD_CACHE_TIMEOUT = getattr(
+    settings, "PLATA_STOCK_PERIOD_CACHE_TIMEOUT", 60
+)
+#: Seconds the stock availability shown in catalog listings using the
+#: ``stock_availability`` template tag is cached. ``0`` disables the cache.
+PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT = getattr(
+    settings, "PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT", 0
+)
+#: Seconds payment process reservations are held
+PLATA_STOCK_RESERVATION_TTL = getattr(settings, "PLATA_STOCK_RESERVATION_TTL", 15 * 60)
+#: Per payment module overrides of ``PLATA_STOCK_RESERVATION_TTL``. Example::
+#:
+#:     PLATA_STOCK_RESERVATION_TTLS = {
+#:         'paypal': 30 * 60,
+#:     }
+PLATA_STOCK_RESERVATION_TTLS = getattr(settings, "PLATA_STOCK_RESERVATION_TTLS", {})
+
+#: The HTTP client used by payment modules for server-to-server calls, see
+#: ``plata.payment.http``
+PLATA_PAYMENT_HTTP_CLIENT = getattr(
+    settings, "PLATA_PAYMENT_HTTP_CLIENT", "plata.payment.http.HTTPClient"
+)
+#: Connect and read timeouts in seconds of server-to-server calls
+PLATA_PAYMENT_HTTP_TIMEOUT = getattr(settings, "PLATA_PAYMENT_HTTP_TIMEOUT", (5, 15))
+#: Number of times failed server-to-server calls are retried
+PLATA_PAYMENT_HTTP_RETRIES = getattr(settings, "PLATA_PAYMENT_HTTP_RETRIES", 2)
+#: Number of consecutive failed calls after which the circuit breaker of a
+#: payment module opens
+PLATA_PAYMENT_BREAKER_THRESHOLD = getattr(
+    settings, "PLATA_PAYMENT_BREAKER_THRESHOLD", 5
+)
+#: Seconds after which an open circuit breaker lets a probing call through
+PLATA_PAYMENT_BREAKER_RESET_TIMEOUT = getattr(
+    settings, "PLATA_PAYMENT_BREAKER_RESET_TIMEOUT", 60
+)
+#: Seconds a call to a payment service provider may take (including
+#: retries) before it counts as failed
+PLATA_PAYMENT_LATENCY_BUDGET = getattr(settings, "PLATA_PAYMENT_LATENCY_BUDGET", 10)
+
+#: Number of delivery attempts after which outbox messages are marked as
+#: failed, see ``plata.shop.outbox``
+PLATA_OUTBOX_MAX_ATTEMPTS = getattr(settings, "PLATA_OUTBOX_MAX_ATTEMPTS", 8)
+#: Seconds to wait before retrying a failed outbox message delivery,
+#: doubled for every further attempt
+PLATA_OUTBOX_RETRY_DELAY = getattr(settings, "PLATA_OUTBOX_RETRY_DELAY", 60)
+
+#: Store e-mail messages and send them in batches using the
+#: ``plata_send_mail`` management command instead of sending them
+#: immediately, see ``plata.shop.mail``. Otherwise only the messages sent
+#: by the receivers of ``order_paid`` share an SMTP connection.
+PLATA_EMAIL_QUEUE = getattr(settings, "PLATA_EMAIL_QUEUE", False)
 
 #: All available currencies. Use ISO 4217 currency codes in this list only.
 CURRENCIES = getattr(settings, "CURRENCIES", ("CHF", "EUR", "USD", "CAD"))
@@ -0,0 +1,181 @@
+"""
+Circuit breakers for server-to-server calls of payment modules
+==============================================================
+
+Every payment module has a circuit breaker (``ProcessorBase.breaker``)
+guarding its calls to the payment service provider. Calls which raise an
+exception or take longer than the latency budget count as failures. After
+``PLATA_PAYMENT_BREAKER_THRESHOLD`` consecutive failures the breaker opens:
+calls fail immediately with ``CircuitOpen`` and ``Shop.get_payment_modules``
+does not offer the module anymore. After
+``PLATA_PAYMENT_BREAKER_RESET_TIMEOUT`` seconds the breaker is half-open and
+lets a single probing call through; the breaker closes again if the probe
+succeeds and opens again otherwise.
+
+The state is stored in the default cache so that it is shared by all
+worker processes. Use a cache backend shared by all processes (not the
+local memory or the dummy cache) in production. ``breaker_states`` and the
+``plata_payment_breakers`` management command report the state of all
+payment modules for monitoring.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+import plata
+
+
+logger = logging.getLogger("plata.payment.breaker")
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling the payment service provider while the
+    circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, key, threshold=None, reset_timeout=None, latency_budget=None):
+        self.key = key
+        self.threshold = threshold or plata.settings.PLATA_PAYMENT_BREAKER_THRESHOLD
+        self.reset_timeout = (
+            reset_timeout or plata.settings.PLATA_PAYMENT_BREAKER_RESET_TIMEOUT
+        )
+        self.latency_budget = (
+            latency_budget or plata.settings.PLATA_PAYMENT_LATENCY_BUDGET
+        )
+        self.cache_key = "plata-payment-breaker:%s" % key
+        self.probe_cache_key = "plata-payment-breaker-probe:%s" % key
+
+    def __repr__(self):
+        return "<CircuitBreaker %s (%s)>" % (self.key, self.state)
+
+    def _get(self):
+        return cache.get(self.cache_key) or {
+            "failures": 0,
+            "opened": None,
+            "latency": None,
+        }
+
+    def _set(self, data):
+        cache.set(self.cache_key, data, timeout=None)
+
+    @property
+    def state(self):
+        opened = self._get()["opened"]
+        if opened is None:
+            return self.CLOSED
+        if time.time() < opened + self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def is_open(self):
+        """
+        ``True`` while calls are rejected without probing
+        """
+        return self.state == self.OPEN
+
+    def status(self):
+        """
+        Returns a dictionary describing the breaker for monitoring
+        """
+        data = self._get()
+        return {
+            "key": self.key,
+            "state": self.state,
+            "failures": data["failures"],
+            "opened": data["opened"],
+            "latency": data["latency"],
+        }
+
+    def allow(self):
+        """
+        Returns whether a call may be made now
+
+        Only one caller (across all processes) is allowed to probe a
+        half-open breaker at a time.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        return cache.add(self.probe_cache_key, 1, timeout=self.latency_budget + 1)
+
+    @contextmanager
+    def call(self, exclude=()):
+        """
+        Guard a call to the payment service provider::
+
+            with self.breaker.call() as breaker:
+                response = self.http_client.post(
+                    url, data, budget=breaker.latency_budget
+                )
+
+        Raises ``CircuitOpen`` without running the block if the breaker is
+        open. Exceptions of the types in ``exclude`` (f.e. declined cards)
+        are propagated without counting as failures.
+        """
+        if not self.allow():
+            raise CircuitOpen("Circuit breaker of %s is open" % self.key)
+
+        start = time.monotonic()
+        try:
+            yield self
+        except exclude:
+            cache.delete(self.probe_cache_key)
+            raise
+        except Exception as exc:
+            self.record_failure(time.monotonic() - start, exc)
+            raise
+        else:
+            latency = time.monotonic() - start
+            if latency > self.latency_budget:
+                self.record_failure(latency, "latency budget exceeded")
+            else:
+                self.record_success(latency)
+
+    def record_success(self, latency=None):
+        data = self._get()
+        if data["opened"] is not None:
+            logger.info("Circuit breaker of %s closed" % self.key)
+        self._set({"failures": 0, "opened": None, "latency": latency})
+        cache.delete(self.probe_cache_key)
+
+    def record_failure(self, latency=None, reason=None):
+        data = self._get()
+        data["failures"] += 1
+        data["latency"] = latency
+        if data["opened"] is not None or data["failures"] >= self.threshold:
+            # Open the breaker or keep it open after a failed probe
+            logger.warning(
+                "Circuit breaker of %s opened after %s failures (%s)"
+                % (self.key, data["failures"], reason)
+            )
+            data["opened"] = time.time()
+        self._set(data)
+        cache.delete(self.probe_cache_key)
+
+    def reset(self):
+        """
+        Close the breaker and forget all failures
+        """
+        cache.delete_many([self.cache_key, self.probe_cache_key])
+
+
+def breaker_states(shop=None):
+    """
+    Returns the ``status()`` of the circuit breakers of all payment modules
+    of the given (or the default) shop instance
+    """
+    shop = shop or plata.shop_instance()
+    return [module.breaker.status() for module in shop.get_payment_modules()]
@@ -0,0 +1,216 @@
+"""
+HTTP client for server-to-server calls of payment modules
+=========================================================
+
+Payment modules verify notifications and query transaction states using
+the client returned by ``get_client`` (also available as
+``ProcessorBase.http_client``) instead of opening a new connection for
+every call. The client keeps connections to the payment service providers
+alive, applies the connect and read timeouts configured using
+``PLATA_PAYMENT_HTTP_TIMEOUT`` and retries failed calls
+``PLATA_PAYMENT_HTTP_RETRIES`` times with exponential backoff.
+
+Set ``PLATA_PAYMENT_HTTP_CLIENT`` to the dotted path of a subclass of
+``HTTPClient`` to change its behavior, f.e. to send all calls to a local
+stub server in tests.
+"""
+
+import http.client
+import logging
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import plata
+
+
+logger = logging.getLogger("plata.payment.http")
+
+
+class HTTPResponse:
+    """
+    The status, headers and the complete body of a response
+    """
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self):
+        return "<HTTPResponse %s (%s bytes)>" % (self.status, len(self.content))
+
+    @property
+    def text(self):
+        return self.content.decode(self.headers.get_content_charset() or "utf-8")
+
+
+class HTTPClient:
+    """
+    Thread-safe HTTP client keeping up to ``pool_size`` idle connections per
+    host alive
+
+    Calls failing because of network errors, timeouts or server errors
+    (status codes 500 and up) are retried after ``backoff``, ``2 *
+    backoff``, ``4 * backoff``... seconds. Only use the client for calls
+    which may be repeated safely, such as verification requests.
+    """
+
+    #: Number of idle connections kept per host
+    pool_size = 4
+    #: Seconds to wait before the first retry, doubled for every retry
+    backoff = 0.5
+
+    def __init__(self, timeout=None, retries=None):
+        self.connect_timeout, self.read_timeout = (
+            timeout or plata.settings.PLATA_PAYMENT_HTTP_TIMEOUT
+        )
+        self.retries = (
+            plata.settings.PLATA_PAYMENT_HTTP_RETRIES if retries is None else retries
+        )
+        self._pools = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def request(self, method, url, data=None, headers=None, budget=None):
+        """
+        Send a request and return a ``HTTPResponse``
+
+        ``data`` may be a dictionary (which is sent form-encoded), a string
+        or bytes. Raises ``OSError`` or ``http.client.HTTPException`` if
+        the last attempt failed; responses with server errors are returned
+        after the last attempt.
+
+        If ``budget`` is given, the read timeout is shortened and no more
+        retries are made so that the call takes at most ``budget`` seconds
+        (plus the connect timeout).
+        """
+
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        if scheme not in ("http", "https"):
+            raise ValueError("Unsupported URL %r" % url)
+
+        headers = dict(headers or {})
+        if isinstance(data, dict):
+            data = urlencode(data)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data is not None:
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+        key = (scheme, netloc)
+        target = urlunsplit(("", "", path or "/", query, ""))
+        deadline = None if budget is None else time.monotonic() + budget
+        attempt = 0
+
+        while True:
+            connection, reused = None, False
+            try:
+                connection, reused = self._acquire(key)
+                timeout = self.read_timeout
+                if deadline is not None:
+                    timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+                connection.sock.settimeout(timeout)
+                connection.request(method, target, body=data, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (OSError, http.client.HTTPException) as exc:
+                if connection is not None:
+                    connection.close()
+                if reused and isinstance(exc, ConnectionError):
+                    # The server closed the idle connection in the meantime
+                    continue
+                if not self._may_retry(attempt, deadline):
+                    raise
+                attempt += 1
+                logger.warning(
+                    "%s %s failed (%r), retrying (%s/%s)"
+                    % (method, url, exc, attempt, self.retries)
+                )
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+
+            if response.status >= 500 and self._may_retry(attempt, deadline):
+                attempt += 1
+                logger.warning(
+                    "%s %s returned status %s, retrying (%s/%s)"
+                    % (method, url, response.status, attempt, self.retries)
+                )
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+
+            return HTTPResponse(response.status, response.headers, content)
+
+    def _may_retry(self, attempt, deadline):
+        if attempt >= self.retries:
+            return False
+        return (
+            deadline is None or time.monotonic() + self.backoff * 2**attempt < deadline
+        )
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            connections = [c for pool in self._pools.values() for c in pool]
+            self._pools.clear()
+        for connection in connections:
+            connection.close()
+
+    def _acquire(self, key):
+        """
+        Returns an idle connection of the pool or a new connection, and
+        whether the connection has been used before
+        """
+        with self._lock:
+            if self._pools[key]:
+                return self._pools[key].pop(), True
+
+        scheme, netloc = key
+        connection_class = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        connection = connection_class(netloc, timeout=self.connect_timeout)
+        connection.connect()
+        return connection, False
+
+    def _release(self, key, connection):
+        with self._lock:
+            if len(self._pools[key]) < self.pool_size:
+                self._pools[key].append(connection)
+                return
+        connection.close()
+
+
+client_cache = None
+
+
+def get_client():
+    """
+    Return the HTTP client instance shared by all payment modules, defined
+    by the ``PLATA_PAYMENT_HTTP_CLIENT`` setting
+    """
+
+    global client_cache
+    if not client_cache or client_cache[0] != plata.settings.PLATA_PAYMENT_HTTP_CLIENT:
+        from django.urls import get_callable
+
+        client_cache = (
+            plata.settings.PLATA_PAYMENT_HTTP_CLIENT,
+            get_callable(plata.settings.PLATA_PAYMENT_HTTP_CLIENT)(),
+        )
+    return client_cache[1]
@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+import plata
+from plata.payment.breaker import breaker_states
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the circuit breaker state of all payment modules, or closes"
+        " the circuit breakers of the given payment modules."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reset",
+            nargs="+",
+            metavar="KEY",
+            help="Close the circuit breakers of these payment modules.",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Output the states as JSON."
+        )
+
+    def handle(self, **options):
+        if options["reset"]:
+            modules = {
+                module.key: module
+                for module in plata.shop_instance().get_payment_modules()
+            }
+            for key in options["reset"]:
+                if key not in modules:
+                    raise CommandError("Unknown payment module %s." % key)
+                modules[key].breaker.reset()
+                self.stdout.write("Closed the circuit breaker of %s." % key)
+            return
+
+        states = breaker_states()
+        if options["json"]:
+            self.stdout.write(json.dumps(states))
+            return
+
+        for state in states:
+            self.stdout.write(
+                "%(key)s: %(state)s (%(failures)s failures, latency %(latency)s)"
+                % state
+            )
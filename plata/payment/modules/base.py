@@ -1,11 +1,19 @@
 import logging
 import warnings
+from contextlib import contextmanager
+from datetime import timedelta
 
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from django.utils.translation import gettext, gettext_lazy as _
 
 import plata
 from plata.discount.models import Discount
-from plata.shop import signals
+from plata.payment.breaker import CircuitBreaker
+from plata.payment.http import get_client
+from plata.shop import outbox, signals
+from plata.shop.models import PaymentNotification
 
 
 logger = logging.getLogger("plata.payment")
@@ -40,6 +48,39 @@ class ProcessorBase:
             self.key, self.default_name
         )
 
+    @property
+    def stock_reservation_ttl(self):
+        """
+        Returns the number of seconds payment process reservations created by
+        this payment module are held
+
+        Defaults to ``PLATA_STOCK_RESERVATION_TTL`` but can be overridden by
+        placing an entry in ``PLATA_STOCK_RESERVATION_TTLS``. Example::
+
+            PLATA_STOCK_RESERVATION_TTLS = {
+                'paypal': 30 * 60,
+                }
+        """
+        return plata.settings.PLATA_STOCK_RESERVATION_TTLS.get(
+            self.key, plata.settings.PLATA_STOCK_RESERVATION_TTL
+        )
+
+    @property
+    def http_client(self):
+        """
+        Returns the HTTP client shared by all payment modules, see
+        ``plata.payment.http``
+        """
+        return get_client()
+
+    @property
+    def breaker(self):
+        """
+        Returns the circuit breaker guarding the calls of this payment module
+        to its payment service provider, see ``plata.payment.breaker``
+        """
+        return CircuitBreaker(self.key)
+
     @property
     def urls(self):
         """
@@ -92,11 +133,7 @@ class ProcessorBase:
         """
         logger.info("Clearing pending payments on %s" % order)
         if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            for transaction in order.stock_transactions.filter(
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION
-            ):
-                transaction.delete()
+            plata.stock_backend().release(order)
 
         order.payments.pending().delete()
 
@@ -116,7 +153,8 @@ class ProcessorBase:
     def create_transactions(self, order, stage, **kwargs):
         """
         Create transactions for all order items. The real work is offloaded
-        to ``StockTransaction.objects.bulk_create``.
+        to the stock backend for sales, to
+        ``StockTransaction.objects.bulk_create`` otherwise.
         """
 
         if not plata.settings.PLATA_STOCK_TRACKING:
@@ -131,13 +169,18 @@ class ProcessorBase:
             )
             return
         StockTransaction = plata.stock_model()
-        StockTransaction.objects.bulk_create(
-            order,
-            notes=_("%(stage)s: %(order)s processed by %(payment_module)s")
-            % {"stage": stage, "order": order, "payment_module": self.name},
-            **kwargs,
-        )
-
+        kwargs["notes"] = _("%(stage)s: %(order)s processed by %(payment_module)s") % {
+            "stage": stage,
+            "order": order,
+            "payment_module": self.name,
+        }
+        if kwargs.get("type") == StockTransaction.SALE and kwargs.get("negative"):
+            del kwargs["type"], kwargs["negative"]
+            plata.stock_backend().commit_sale(order, **kwargs)
+        else:
+            StockTransaction.objects.bulk_create(order, **kwargs)
+
+    @transaction.atomic
     def order_paid(self, order, payment=None, request=None):
         """
         Call this when the order has been fully paid for.
@@ -148,6 +191,12 @@ class ProcessorBase:
         - Calculates the remaining discount amount (if any) and calls the
           ``order_paid`` signal.
         - Clears pending payments which aren't interesting anymore anyway.
+
+        All of this happens in one transaction, so that messages stored for
+        deferred receivers (see ``plata.shop.outbox``) are only delivered
+        if the order status change has been committed. All other receivers
+        of ``order_paid`` are called after the transaction has been
+        committed, see ``plata.shop.outbox.send_on_commit``.
         """
 
         if order.status < order.PAID:
@@ -205,7 +254,7 @@ class ProcessorBase:
 
                 signal_kwargs["remaining_discount"] = remaining_discount
 
-            signals.order_paid.send(**signal_kwargs)
+            outbox.send_on_commit(signals.order_paid, **signal_kwargs)
         self.clear_pending_payments(order)
 
     def already_paid(self, order, request=None):
@@ -229,13 +278,133 @@ class ProcessorBase:
 
         return self.shop.redirect("plata_order_success")
 
+    def notification_processed(self, transaction_id, status=None):
+        """
+        Returns whether a notification has been processed already, useful
+        for skipping expensive verification steps of retried notifications
+
+        Pass ``status=None`` if the status is only known after verifying
+        the notification and the transaction ID identifies it already.
+        """
+        notifications = PaymentNotification.objects.filter(
+            payment_module_key=self.key, transaction_id=transaction_id
+        )
+        if status is not None:
+            notifications = notifications.filter(status=status)
+        return notifications.exists()
+
+    @contextmanager
+    def process_notification(self, order, transaction_id, status):
+        """
+        Process a notification of the payment service provider exactly once
+
+        Records the notification in the ``PaymentNotification`` journal and
+        locks the order row until the end of the block, so that concurrent
+        notifications for the same order are processed one after the
+        other. The order instance is refreshed after acquiring the lock.
+        Yields ``False`` without locking the order if the same
+        notification (payment module, transaction ID and status) has been
+        processed before::
+
+            with self.process_notification(order, transaction_id, status) as new:
+                if not new:
+                    return HttpResponse("OK")
+                ...
+
+        If the block raises an exception, the notification is forgotten
+        again so that the retry is processed.
+        """
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    PaymentNotification.objects.create(
+                        payment_module_key=self.key,
+                        transaction_id=transaction_id,
+                        status=status,
+                        order=order,
+                    )
+            except IntegrityError:
+                new = False
+                logger.info(
+                    "Ignoring duplicate notification %s (%s) for %s"
+                    % (transaction_id, status, order)
+                )
+            else:
+                new = True
+                locked = order.__class__._default_manager.select_for_update().get(
+                    pk=order.pk
+                )
+                for field in order._meta.concrete_fields:
+                    setattr(order, field.attname, getattr(locked, field.attname))
+
+            yield new
+
     def reserve_stock_item(self, order, payment):
+        """
+        Reserve the stock of all order items for the duration of the payment
+        process
+
+        Checking the stock and creating the reservations happens atomically,
+        see ``reserve`` of the stock backend. If not enough stock is
+        available the pending payment is removed again and a
+        ``ValidationError`` is raised; the shop's checkout views handle it.
+        """
         if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+            try:
+                plata.stock_backend().reserve(
+                    order,
+                    payment=payment,
+                    expires=timezone.now()
+                    + timedelta(seconds=self.stock_reservation_ttl),
+                    notes=_("%(stage)s: %(order)s processed by %(payment_module)s")
+                    % {
+                        "stage": _("payment process reservation"),
+                        "order": order,
+                        "payment_module": self.name,
+                    },
+                )
+            except ValidationError:
+                logger.warning("Not enough stock to reserve for %s" % order)
+                payment.delete()
+                raise
+
+
+def move_payment_tokens(apps, schema_editor):
+    """
+    Data migration moving the confirmation tokens of the ``prepay`` and
+    ``check`` payment modules from ``Order.notes`` to ``OrderPayment.token``
+
+    Plata does not bundle migrations; use this function in a ``RunPython``
+    operation of your own ``shop`` migration after adding the ``token``
+    field::
+
+        from plata.payment.modules.base import move_payment_tokens
+
+        operations = [
+            migrations.RunPython(move_payment_tokens, migrations.RunPython.noop),
+        ]
+
+    The token is assigned to the newest payment of the order (the payment
+    the confirmation link used to authorize) and removed from the notes.
+    """
+    Order = apps.get_model("shop", "Order")
+    OrderPayment = apps.get_model("shop", "OrderPayment")
+
+    orders = (
+        Order.objects.filter(
+            notes__regex=r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$",
+            payments__payment_module_key__in=("prepay", "check"),
+        )
+        .distinct()
+        .order_by("pk")
+        .values_list("pk", "notes")
+    )
+
+    for order_id, token in list(orders):
+        payment = (
+            OrderPayment.objects.filter(order=order_id).order_by("-timestamp").first()
+        )
+        if payment.token is None:
+            payment.token = token
+            payment.save(update_fields=["token"])
+        Order.objects.filter(pk=order_id).update(notes="")
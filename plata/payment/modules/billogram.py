@@ -16,6 +16,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 import plata.shop.models
+from plata.payment.breaker import CircuitOpen
 from plata.payment.modules.base import ProcessorBase
 
 
@@ -26,6 +27,14 @@ require_POST_m = method_decorator(require_POST)
 
 CUSTOMER_NO_OFFSET = 10000
 
+#: Errors of the Billogram API, of the HTTP requests made by its client
+#: (``requests`` exceptions are ``OSError`` subclasses) and open circuits
+API_ERRORS = (
+    billogram_api.BillogramExceptions.BillogramAPIError,
+    OSError,
+    CircuitOpen,
+)
+
 
 class PaymentProcessor(ProcessorBase):
     key = "billogram"
@@ -107,7 +116,12 @@ class PaymentProcessor(ProcessorBase):
             return self.already_paid(order)
         payment = self.create_pending_payment(order)
         self.reserve_stock_item(order, payment)
-        customer = self.get_or_create_customer(order)
+        try:
+            with self.breaker.call():
+                customer = self.get_or_create_customer(order)
+        except API_ERRORS as e:
+            logger.error(str(e))
+            return redirect(reverse("plata_order_payment_failure"))
         billogram_data = {
             "customer": {"customer_no": customer["customer_no"]},
             "items": [
@@ -143,20 +157,21 @@ class PaymentProcessor(ProcessorBase):
         method = "+".join(methods)
 
         try:
-            billogram = self.api.billogram.create_and_send(billogram_data, method)
-            payment.transaction_id = billogram.id
-            payment.save()
-            order.shipping_tax_rate = billogram.invoice_fee_vat
-            order.recalculate_total(save=True)
-        except Exception as e:
+            with self.breaker.call():
+                billogram = self.api.billogram.create_and_send(billogram_data, method)
+        except API_ERRORS as e:
             logger.error(str(e))
             # message error
             return redirect(reverse("plata_order_payment_failure"))
-        else:
-            # set as authorized?
-            # subtract from stock
-            # message success
-            return redirect(reverse("plata_order_payment_pending"))
+
+        payment.transaction_id = billogram.id
+        payment.save()
+        order.shipping_tax_rate = billogram.invoice_fee_vat
+        order.recalculate_total(save=True)
+        # set as authorized?
+        # subtract from stock
+        # message success
+        return redirect(reverse("plata_order_payment_pending"))
 
     @csrf_exempt_m
     @require_POST_m
@@ -198,7 +213,6 @@ class PaymentProcessor(ProcessorBase):
             payment.status = plata.shop.models.OrderPayment.AUTHORIZED
         # TODO: release stock if cancelled or credited
         payment.save()
-        order = order.reload()
         if not order.balance_remaining:
             self.order_paid(order, payment=payment, request=request)
 
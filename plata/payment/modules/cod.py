@@ -32,7 +32,6 @@ class PaymentProcessor(ProcessorBase):
         payment.status = OrderPayment.AUTHORIZED
         payment.authorized = timezone.now()
         payment.save()
-        order = order.reload()
 
         if plata.settings.PLATA_STOCK_TRACKING:
             StockTransaction = plata.stock_model()
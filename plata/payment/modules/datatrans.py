@@ -10,7 +10,6 @@ Needs the following settings to work correctly::
 """
 
 import logging
-import urllib
 from decimal import Decimal
 from xml.etree import ElementTree as ET
 
@@ -23,6 +22,7 @@ from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
 import plata
+from plata.payment.breaker import CircuitOpen
 from plata.payment.modules.base import ProcessorBase
 from plata.shop.models import OrderPayment
 
@@ -71,15 +71,7 @@ class PaymentProcessor(ProcessorBase):
         logger.info("Processing order %s using Datatrans" % order)
 
         payment = self.create_pending_payment(order)
-        if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+        self.reserve_stock_item(order, payment)
 
         if DATATRANS.get("LIVE", True):
             DT_URL = "https://payment.datatrans.biz/upp/jsp/upStart.jsp"
@@ -127,6 +119,12 @@ class PaymentProcessor(ProcessorBase):
             if parameters:
                 logger.info("IPN: Processing request data %s" % parameters_repr)
 
+                if self.notification_processed(
+                    parameters.get("refno"), parameters.get("responseCode")
+                ):
+                    # Redirect retries without querying the status again
+                    return redirect("plata_order_success")
+
                 xml = """<?xml version="1.0" encoding="UTF-8" ?>
                 <statusService version="1">
                   <body merchantId="{merchant_id}">
@@ -141,8 +139,14 @@ class PaymentProcessor(ProcessorBase):
                     transaction_id=parameters["uppTransactionId"],
                     merchant_id=DATATRANS["MERCHANT_ID"],
                 )
-                params = urllib.urlencode({"xmlRequest": xml})
-                xml_response = urllib.urlopen(DT_URL, params).read()
+                try:
+                    with self.breaker.call() as breaker:
+                        xml_response = self.http_client.post(
+                            DT_URL, {"xmlRequest": xml}, budget=breaker.latency_budget
+                        ).content
+                except CircuitOpen:
+                    logger.warning("IPN: Status query postponed, Datatrans unavailable")
+                    return redirect("plata_order_payment_pending")
 
                 tree = ET.fromstring(xml_response)
                 response = tree.find("body/transaction/response")
@@ -168,42 +172,52 @@ class PaymentProcessor(ProcessorBase):
                     logger.error("IPN: Order %s does not exist" % order_id)
                     return HttpResponseForbidden("Order %s does not exist" % order_id)
 
-                try:
-                    payment = order.payments.get(pk=payment_id)
-                except order.payments.model.DoesNotExist:
-                    return HttpResponseForbidden(
-                        "Payment %s does not exist" % payment_id
-                    )
+                with self.process_notification(order, refno, response_code) as new:
+                    if not new:
+                        return redirect("plata_order_success")
 
-                payment.status = OrderPayment.PROCESSED
-                payment.currency = currency
-                payment.amount = Decimal(float(amount) / SMALLEST_UNIT_FACTOR)
-                payment.data = request.POST.copy()
-                payment.transaction_id = refno
-                payment.payment_method = payment.payment_module
-
-                payment.authorized = now()
-                payment.status = OrderPayment.AUTHORIZED
-
-                payment.save()
-                order = order.reload()
-
-                logger.info("IPN: Successfully processed IPN request for %s" % order)
-
-                if payment.authorized and plata.settings.PLATA_STOCK_TRACKING:
-                    StockTransaction = plata.stock_model()
-                    self.create_transactions(
-                        order,
-                        _("sale"),
-                        type=StockTransaction.SALE,
-                        negative=True,
-                        payment=payment,
-                    )
+                    try:
+                        payment = order.payments.get(pk=payment_id)
+                    except order.payments.model.DoesNotExist:
+                        return HttpResponseForbidden(
+                            "Payment %s does not exist" % payment_id
+                        )
 
-                if not order.balance_remaining:
-                    self.order_paid(order, payment=payment)
+                    was_authorized = payment.authorized is not None
+                    payment.status = OrderPayment.PROCESSED
+                    payment.currency = currency
+                    payment.amount = Decimal(float(amount) / SMALLEST_UNIT_FACTOR)
+                    payment.data = request.POST.copy()
+                    payment.transaction_id = refno
+                    payment.payment_method = payment.payment_module
+
+                    payment.authorized = now()
+                    payment.status = OrderPayment.AUTHORIZED
+
+                    payment.save()
+
+                    logger.info(
+                        "IPN: Successfully processed IPN request for %s" % order
+                    )
 
-                return redirect("plata_order_success")
+                    if (
+                        payment.authorized
+                        and not was_authorized
+                        and plata.settings.PLATA_STOCK_TRACKING
+                    ):
+                        StockTransaction = plata.stock_model()
+                        self.create_transactions(
+                            order,
+                            _("sale"),
+                            type=StockTransaction.SALE,
+                            negative=True,
+                            payment=payment,
+                        )
+
+                    if not order.balance_remaining:
+                        self.order_paid(order, payment=payment)
+
+                    return redirect("plata_order_success")
 
         except Exception as e:
             logger.error("IPN: Processing failure %s" % e)
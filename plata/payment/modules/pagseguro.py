@@ -6,7 +6,6 @@ Date: 03/14/2012
 
 import logging
 import time
-import urllib
 from datetime import datetime
 from decimal import Decimal
 from xml.dom import minidom
@@ -18,6 +17,7 @@ from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
 import plata
+from plata.payment.breaker import CircuitOpen
 from plata.payment.modules.base import ProcessorBase
 from plata.shop.models import OrderPayment
 
@@ -51,15 +51,7 @@ class PaymentProcessor(ProcessorBase):
         logger.info("Processing order %s using PagSeguro" % order)
 
         payment = self.create_pending_payment(order)
-        if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+        self.reserve_stock_item(order, payment)
 
         return self.shop.render(
             request,
@@ -92,11 +84,27 @@ class PaymentProcessor(ProcessorBase):
                     f.write(f"{time.ctime()} - notification: {data}\n")
                     f.close()
 
-                notificationCode = data["notificationCode"]
-                result = urllib.urlopen(
-                    "https://ws.pagseguro.uol.com.br/v2/transactions/notifications/%s?email=%s&token=%s"  # noqa
-                    % (notificationCode, PAGSEGURO["EMAIL"], PAGSEGURO["TOKEN"])
-                ).read()
+                notificationCode = request.POST["notificationCode"]
+                if self.notification_processed(notificationCode):
+                    # Every status change has its own notification code,
+                    # acknowledge retries without querying them again
+                    return HttpResponse("OK")
+
+                try:
+                    with self.breaker.call() as breaker:
+                        result = self.http_client.get(
+                            "https://ws.pagseguro.uol.com.br/v2/transactions/notifications/%s?email=%s&token=%s"  # noqa
+                            % (
+                                notificationCode,
+                                PAGSEGURO["EMAIL"],
+                                PAGSEGURO["TOKEN"],
+                            ),
+                            budget=breaker.latency_budget,
+                        ).content
+                except CircuitOpen:
+                    # PagSeguro resends the notification later
+                    logger.warning("Pagseguro: Notification postponed, unavailable")
+                    return HttpResponse("Unavailable", status=503)
 
                 if PAGSEGURO.get("LOG"):
                     f = open(PAGSEGURO["LOG"], "a")
@@ -145,43 +153,53 @@ class PaymentProcessor(ProcessorBase):
                         _("Order %s does not exist" % order_id)
                     )
 
-                try:
-                    payment = order.payments.get(pk=payment_id)
-                except order.payments.model.DoesNotExist:
-                    payment = order.payments.model(
-                        order=order, payment_module="%s" % self.name
+                with self.process_notification(order, notificationCode, status) as new:
+                    if not new:
+                        return HttpResponse("OK")
+
+                    try:
+                        payment = order.payments.get(pk=payment_id)
+                    except order.payments.model.DoesNotExist:
+                        payment = order.payments.model(
+                            order=order, payment_module="%s" % self.name
+                        )
+
+                    was_authorized = payment.authorized is not None
+                    payment.status = OrderPayment.PROCESSED
+                    payment.amount = Decimal(amount)
+                    payment.data = request.POST.copy()
+                    payment.transaction_id = notificationCode
+                    payment.payment_method = payment.payment_module
+
+                    if status == "3":
+                        payment.authorized = datetime.now()
+                        payment.status = OrderPayment.AUTHORIZED
+                    payment.save()
+
+                    payment.amount = Decimal(amount)
+
+                    logger.info(
+                        "Pagseguro: Successfully processed request for %s" % order
                     )
 
-                payment.status = OrderPayment.PROCESSED
-                payment.amount = Decimal(amount)
-                payment.data = request.POST.copy()
-                payment.transaction_id = notificationCode
-                payment.payment_method = payment.payment_module
-
-                if status == "3":
-                    payment.authorized = datetime.now()
-                    payment.status = OrderPayment.AUTHORIZED
-                payment.save()
-
-                order = order.reload()
-                payment.amount = Decimal(amount)
-
-                logger.info("Pagseguro: Successfully processed request for %s" % order)
-
-                if payment.authorized and plata.settings.PLATA_STOCK_TRACKING:
-                    StockTransaction = plata.stock_model()
-                    self.create_transactions(
-                        order,
-                        _("sale"),
-                        type=StockTransaction.SALE,
-                        negative=True,
-                        payment=payment,
-                    )
-
-                if not order.balance_remaining:
-                    self.order_paid(order, payment=payment)
-
-                return HttpResponse("OK")
+                    if (
+                        payment.authorized
+                        and not was_authorized
+                        and plata.settings.PLATA_STOCK_TRACKING
+                    ):
+                        StockTransaction = plata.stock_model()
+                        self.create_transactions(
+                            order,
+                            _("sale"),
+                            type=StockTransaction.SALE,
+                            negative=True,
+                            payment=payment,
+                        )
+
+                    if not order.balance_remaining:
+                        self.order_paid(order, payment=payment)
+
+                    return HttpResponse("OK")
 
         except Exception:
             logger.exception("Pagseguro: Processing failure")
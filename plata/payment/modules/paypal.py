@@ -11,7 +11,6 @@ Needs the following settings to work correctly::
 
 import logging
 from decimal import Decimal
-from urllib.request import urlopen
 
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
@@ -21,6 +20,7 @@ from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 
 import plata
+from plata.payment.breaker import CircuitOpen
 from plata.payment.modules.base import ProcessorBase
 from plata.shop.models import OrderPayment
 
@@ -48,15 +48,7 @@ class PaymentProcessor(ProcessorBase):
         logger.info("Processing order %s using Paypal" % order)
 
         payment = self.create_pending_payment(order)
-        if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+        self.reserve_stock_item(order, payment)
 
         if PAYPAL["LIVE"]:
             PP_URL = "https://www.paypal.com/cgi-bin/webscr"
@@ -122,8 +114,22 @@ class PaymentProcessor(ProcessorBase):
             if parameters:
                 logger.info("IPN: Processing request data %s" % parameters_repr)
 
+                if self.notification_processed(
+                    parameters.get("txn_id"), parameters.get("payment_status")
+                ):
+                    # Acknowledge retries without verifying them again
+                    return HttpResponse("Ok")
+
                 querystring = "cmd=_notify-validate&%s" % (request.POST.urlencode())
-                status = urlopen(PP_URL, querystring).read()
+                try:
+                    with self.breaker.call() as breaker:
+                        status = self.http_client.post(
+                            PP_URL, querystring, budget=breaker.latency_budget
+                        ).content
+                except CircuitOpen:
+                    # PayPal resends the notification later
+                    logger.warning("IPN: Verification postponed, PayPal unavailable")
+                    return HttpResponse("Unavailable", status=503)
 
                 if status != b"VERIFIED":
                     logger.error(
@@ -153,43 +159,55 @@ class PaymentProcessor(ProcessorBase):
                     logger.error("IPN: Order %s does not exist" % order_id)
                     return HttpResponseForbidden("Order %s does not exist" % order_id)
 
-                try:
-                    payment = order.payments.get(pk=payment_id)
-                except (order.payments.model.DoesNotExist, ValueError):
-                    payment = order.payments.model(
-                        order=order, payment_module="%s" % self.name
-                    )
-
-                payment.status = OrderPayment.PROCESSED
-                payment.currency = currency
-                payment.amount = Decimal(amount)
-                payment.data = request.POST.copy()
-                payment.transaction_id = reference
-                payment.payment_method = payment.payment_module
-
-                if parameters["payment_status"] == "Completed":
-                    payment.authorized = timezone.now()
-                    payment.status = OrderPayment.AUTHORIZED
-
-                payment.save()
-                order = order.reload()
-
-                logger.info("IPN: Successfully processed IPN request for %s" % order)
-
-                if payment.authorized and plata.settings.PLATA_STOCK_TRACKING:
-                    StockTransaction = plata.stock_model()
-                    self.create_transactions(
-                        order,
-                        _("sale"),
-                        type=StockTransaction.SALE,
-                        negative=True,
-                        payment=payment,
+                with self.process_notification(
+                    order, reference, parameters["payment_status"]
+                ) as new:
+                    if not new:
+                        return HttpResponse("Ok")
+
+                    try:
+                        payment = order.payments.get(pk=payment_id)
+                    except (order.payments.model.DoesNotExist, ValueError):
+                        payment = order.payments.model(
+                            order=order, payment_module="%s" % self.name
+                        )
+
+                    was_authorized = payment.authorized is not None
+                    payment.status = OrderPayment.PROCESSED
+                    payment.currency = currency
+                    payment.amount = Decimal(amount)
+                    payment.data = request.POST.copy()
+                    payment.transaction_id = reference
+                    payment.payment_method = payment.payment_module
+
+                    if parameters["payment_status"] == "Completed":
+                        payment.authorized = timezone.now()
+                        payment.status = OrderPayment.AUTHORIZED
+
+                    payment.save()
+
+                    logger.info(
+                        "IPN: Successfully processed IPN request for %s" % order
                     )
 
-                if not order.balance_remaining:
-                    self.order_paid(order, payment=payment, request=request)
-
-                return HttpResponse("Ok")
+                    if (
+                        payment.authorized
+                        and not was_authorized
+                        and plata.settings.PLATA_STOCK_TRACKING
+                    ):
+                        StockTransaction = plata.stock_model()
+                        self.create_transactions(
+                            order,
+                            _("sale"),
+                            type=StockTransaction.SALE,
+                            negative=True,
+                            payment=payment,
+                        )
+
+                    if not order.balance_remaining:
+                        self.order_paid(order, payment=payment, request=request)
+
+                    return HttpResponse("Ok")
 
         except Exception as e:
             logger.error("IPN: Processing failure %s" % e)
@@ -119,7 +119,6 @@ class PaymentProcessor(ProcessorBase):
             payment.authorized = timezone.now()
             payment.status = plata.shop.models.OrderPayment.AUTHORIZED
         payment.save()
-        order = order.reload()
         if payment.authorized and plata.settings.PLATA_STOCK_TRACKING:
             StockTransaction = plata.stock_model()
             self.create_transactions(
@@ -97,15 +97,7 @@ class PaymentProcessor(ProcessorBase):
         logger.info("Processing order %s using Postfinance" % order)
 
         payment = self.create_pending_payment(order)
-        if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+        self.reserve_stock_item(order, payment)
 
         form_params = {
             "orderID": "Order-%d-%d" % (order.id, payment.id),
@@ -202,44 +194,52 @@ class PaymentProcessor(ProcessorBase):
                 logger.error("IPN: Order %s does not exist" % order_id)
                 return HttpResponseForbidden("Order %s does not exist" % order_id)
 
-            try:
-                payment = order.payments.get(pk=payment_id)
-            except order.payments.model.DoesNotExist:
-                payment = order.payments.model(
-                    order=order, payment_module="%s" % self.name
-                )
+            with self.process_notification(order, PAYID, STATUS) as new:
+                if not new:
+                    return HttpResponse("OK")
 
-            payment.status = OrderPayment.PROCESSED
-            payment.currency = currency
-            payment.amount = Decimal(amount)
-            payment.data = request.POST.copy()
-            payment.transaction_id = PAYID
-            payment.payment_method = BRAND
-            payment.notes = STATUS_DICT.get(STATUS)
-
-            if STATUS in ("5", "9"):
-                payment.authorized = timezone.now()
-                payment.status = OrderPayment.AUTHORIZED
-
-            payment.save()
-            order = order.reload()
-
-            logger.info("IPN: Successfully processed IPN request for %s" % order)
-
-            if payment.authorized and plata.settings.PLATA_STOCK_TRACKING:
-                StockTransaction = plata.stock_model()
-                self.create_transactions(
-                    order,
-                    _("sale"),
-                    type=StockTransaction.SALE,
-                    negative=True,
-                    payment=payment,
-                )
+                try:
+                    payment = order.payments.get(pk=payment_id)
+                except order.payments.model.DoesNotExist:
+                    payment = order.payments.model(
+                        order=order, payment_module="%s" % self.name
+                    )
+
+                was_authorized = payment.authorized is not None
+                payment.status = OrderPayment.PROCESSED
+                payment.currency = currency
+                payment.amount = Decimal(amount)
+                payment.data = request.POST.copy()
+                payment.transaction_id = PAYID
+                payment.payment_method = BRAND
+                payment.notes = STATUS_DICT.get(STATUS)
+
+                if STATUS in ("5", "9"):
+                    payment.authorized = timezone.now()
+                    payment.status = OrderPayment.AUTHORIZED
+
+                payment.save()
+
+                logger.info("IPN: Successfully processed IPN request for %s" % order)
+
+                if (
+                    payment.authorized
+                    and not was_authorized
+                    and plata.settings.PLATA_STOCK_TRACKING
+                ):
+                    StockTransaction = plata.stock_model()
+                    self.create_transactions(
+                        order,
+                        _("sale"),
+                        type=StockTransaction.SALE,
+                        negative=True,
+                        payment=payment,
+                    )
 
-            if not order.balance_remaining:
-                self.order_paid(order, payment=payment, request=request)
+                if not order.balance_remaining:
+                    self.order_paid(order, payment=payment, request=request)
 
-            return HttpResponse("OK")
+                return HttpResponse("OK")
         except Exception as e:
             logger.error("IPN: Processing failure %s" % e)
             raise
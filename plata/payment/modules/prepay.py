@@ -14,7 +14,7 @@ from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
 from django.http import Http404, HttpResponse
 from django.urls import reverse
 from django.utils import timezone
@@ -22,7 +22,8 @@ from django.utils.translation import gettext_lazy as _
 
 import plata
 from plata.payment.modules.base import ProcessorBase
-from plata.shop.models import Order, OrderPayment
+from plata.shop.mail import send_messages
+from plata.shop.models import OrderPayment
 
 
 logger = logging.getLogger("plata.payment.prepay")
@@ -52,9 +53,8 @@ class PaymentProcessor(ProcessorBase):
         )
 
         payment = self.create_pending_payment(order)
-
-        order.notes = str(uuid4())
-        order.save()
+        payment.token = str(uuid4())
+        payment.save()
 
         if plata.settings.PLATA_STOCK_TRACKING:
             StockTransaction = plata.stock_model()
@@ -68,7 +68,7 @@ class PaymentProcessor(ProcessorBase):
         current_site = Site.objects.get_current()
         confirm_link = "https://{}{}".format(
             current_site.domain,
-            reverse("plata_payment_prepay_confirm", kwargs={"uuid": order.notes}),
+            reverse("plata_payment_prepay_confirm", kwargs={"uuid": payment.token}),
         )
         message = _(
             """The order {order} has been confirmed for bank transfer in advance.
@@ -106,16 +106,20 @@ Click on this link when the payment is received: {confirm_link}
                 )
             )
 
-        send_mail(
-            _(
-                "{prefix}New order on bank transfer ({order})".format(
-                    prefix=getattr(settings, "EMAIL_SUBJECT_PREFIX", ""),
-                    order=order,
+        send_messages(
+            [
+                EmailMessage(
+                    _(
+                        "{prefix}New order on bank transfer ({order})".format(
+                            prefix=getattr(settings, "EMAIL_SUBJECT_PREFIX", ""),
+                            order=order,
+                        )
+                    ),
+                    message,
+                    settings.SERVER_EMAIL,
+                    notification_emails,
                 )
-            ),
-            message,
-            settings.SERVER_EMAIL,
-            notification_emails,
+            ]
         )
 
         return self.shop.render(
@@ -130,11 +134,13 @@ Click on this link when the payment is received: {confirm_link}
 
     def confirm(self, request, uuid):
         try:
-            order = Order.objects.get(notes=uuid)
-        except Order.DoesNotExist:
+            payment = OrderPayment.objects.select_related("order").get(
+                token=uuid, payment_module_key=self.key
+            )
+        except OrderPayment.DoesNotExist:
             raise Http404
 
-        payment = list(order.payments.all()[:1])[0]
+        order = payment.order
 
         if payment.status == OrderPayment.AUTHORIZED:
             return HttpResponse("Already authorized")
@@ -19,6 +19,7 @@ import logging
 import stripe  # official API, see https://stripe.com/docs/api/python
 from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
+from django.shortcuts import redirect
 from django.urls import re_path
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
@@ -26,6 +27,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 import plata
+from plata.payment.breaker import CircuitOpen
 from plata.payment.modules.base import ProcessorBase
 
 
@@ -98,15 +100,7 @@ class PaymentProcessor(ProcessorBase):
         logger.info(f"Processing order {order} using {self.default_name}")
 
         payment = self.create_pending_payment(order)
-        if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-            self.create_transactions(
-                order,
-                _("payment process reservation"),
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
-                negative=True,
-                payment=payment,
-            )
+        self.reserve_stock_item(order, payment)
 
         for item in order.items.all():
             itemsum = 0
@@ -144,16 +138,21 @@ class PaymentProcessor(ProcessorBase):
     def callback(self, request):
         # data = json.loads(request.body)
 
-        customer = stripe.Customer.create(
-            email="customer@example.com", source=request.form["stripeToken"]
-        )
-
-        charge = stripe.Charge.create(
-            customer=customer.id,
-            amount=self.amount,
-            currency=self.order.currency.lower(),
-            description=_("Order %s") % self.order,
-        )
+        try:
+            with self.breaker.call(exclude=(stripe.error.CardError,)):
+                customer = stripe.Customer.create(
+                    email="customer@example.com", source=request.form["stripeToken"]
+                )
+
+                charge = stripe.Charge.create(
+                    customer=customer.id,
+                    amount=self.amount,
+                    currency=self.order.currency.lower(),
+                    description=_("Order %s") % self.order,
+                )
+        except CircuitOpen:
+            logger.warning("Stripe unavailable, not charging %s" % self.order)
+            return redirect("plata_order_payment_failure")
 
         return self.shop.render(
             request,
@@ -0,0 +1,447 @@
+"""
+Stock backends
+==============
+
+The checkout and payment processes do all their stock accounting through
+the stock backend configured using ``PLATA_STOCK_BACKEND``:
+
+- ``DatabaseBackend`` (the default) reads and writes the stock transaction
+  ledger directly.
+- ``CounterBackend`` keeps the available stock of every product in counters
+  in the Django cache and writes the stock transactions to the ledger in
+  batches later on (write-behind). The cache has to support atomic
+  ``incr`` and ``decr`` operations which may go below zero (e.g. Redis).
+  Run ``./manage.py plata_stock_flush`` and
+  ``./manage.py plata_stock_expire_reservations`` every minute or so.
+- ``LocalCounterBackend`` is a ``CounterBackend`` using a process-local
+  in-memory cache, useful for tests and single-process setups.
+
+Subclass one of these and set ``PLATA_STOCK_BACKEND`` to the dotted path of
+your class to change their configuration.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+import plata
+from plata.product.stock.models import Period, StockBalance
+
+
+logger = logging.getLogger("plata.product.stock")
+
+
+class BaseBackend:
+    """Stock backend base class"""
+
+    def availability(self, products, exclude_order=None, include_reservations=False):
+        """
+        Returns a dictionary mapping product IDs to the available quantity,
+        see ``StockTransaction.objects.availability``
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def items_in_stock(self, product, **kwargs):
+        """
+        Returns the available quantity of a single product
+        """
+        return self.availability([product], **kwargs)[getattr(product, "pk", product)]
+
+    def cached_availability(self, products):
+        """
+        Returns the available quantity minus live payment process
+        reservations of all products, suitable for catalog listings
+
+        The values are cached in the default cache for
+        ``PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT`` seconds if it is set.
+        All products missing in the cache are determined at once.
+        """
+        timeout = plata.settings.PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT
+        if not timeout:
+            return self.availability(products, include_reservations=True)
+
+        product_ids = {getattr(product, "pk", product) for product in products}
+        keys = {"plata-stock-availability:%s" % pk: pk for pk in product_ids}
+        available = {keys[key]: value for key, value in cache.get_many(keys).items()}
+
+        missing = product_ids - set(available)
+        if missing:
+            fresh = self.availability(missing, include_reservations=True)
+            cache.set_many(
+                {
+                    "plata-stock-availability:%s" % pk: value
+                    for pk, value in fresh.items()
+                },
+                timeout,
+            )
+            available.update(fresh)
+
+        return available
+
+    def reserve(self, order, **kwargs):
+        """
+        Atomically check the stock of all order items and reserve them for the
+        payment process, raising a ``ValidationError`` with code
+        ``insufficient_stock`` if not enough stock is available
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def release(self, order):
+        """
+        Release all payment process reservations of the order
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def commit_sale(self, order, **kwargs):
+        """
+        Record the sale of all order items
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def expire_reservations(self, now=None):
+        """
+        Release expired payment process reservations, returns their count
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def flush(self, wait=False):
+        """
+        Write pending changes to the stock transaction ledger, returns the
+        number of written changes
+
+        If ``wait`` is ``True`` and somebody else is flushing right now,
+        wait for them to finish and write the remaining changes instead of
+        returning immediately.
+        """
+        return 0
+
+
+class DatabaseBackend(BaseBackend):
+    """
+    Reads and writes the stock transaction ledger directly
+    """
+
+    @property
+    def ledger(self):
+        return plata.stock_model().objects
+
+    def availability(self, products, exclude_order=None, include_reservations=False):
+        return self.ledger.availability(
+            products,
+            exclude_order=exclude_order,
+            include_reservations=include_reservations,
+        )
+
+    def reserve(self, order, **kwargs):
+        return self.ledger.reserve(order, **kwargs)
+
+    def release(self, order):
+        self.ledger.release_reservations(order)
+
+    def commit_sale(self, order, **kwargs):
+        return self.ledger.bulk_create(
+            order, type=self.ledger.model.SALE, negative=True, **kwargs
+        )
+
+    def expire_reservations(self, now=None):
+        return self.ledger.expire_reservations(now=now)
+
+
+class CounterBackend(DatabaseBackend):
+    """
+    Keeps the available stock (``items_in_stock`` minus all payment process
+    reservations which have not been released yet) in cache counters
+
+    Reservations and sales only touch the cache; the stock transactions are
+    queued in the cache too and written to the ledger by ``flush``, which
+    runs automatically once ``batch_size`` changes are pending. Counters
+    are rebuilt from the ledger after ``timeout`` seconds, so stock
+    transactions created elsewhere (e.g. purchases entered in the
+    administration panel) are picked up eventually. Availability queries
+    which do not include reservations are answered by the ledger.
+    """
+
+    #: Alias of the cache holding the counters and the queue
+    cache_alias = "default"
+    #: Prefix of all cache keys
+    key_prefix = "plata-stock"
+    #: Seconds until counters are rebuilt from the ledger
+    timeout = 300
+    #: Number of queued changes which triggers a flush
+    batch_size = 500
+    #: Seconds until the flush lock is released even if flushing crashed
+    lock_timeout = 60
+    #: Seconds between attempts to acquire the flush lock when waiting for it
+    lock_poll_interval = 0.05
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, *parts):
+        return ":".join([self.key_prefix, *map(str, parts)])
+
+    def _counters(self, product_ids):
+        keys = {self._key("available", pk): pk for pk in product_ids if pk is not None}
+        values = self.cache.get_many(keys)
+        missing = [pk for key, pk in keys.items() if key not in values]
+
+        if missing:
+            # Queued changes have to be in the ledger before rebuilding,
+            # including those a concurrent flush is writing right now
+            self.flush(wait=True)
+
+            stock = dict.fromkeys(missing, 0)
+            stock.update(
+                StockBalance.objects.filter(
+                    period=Period.objects.current(), product__in=missing
+                )
+                .order_by()
+                .values("product")
+                .annotate(stock=Sum("total"))
+                .values_list("product", "stock")
+            )
+            for pk, value in stock.items():
+                self.cache.add(self._key("available", pk), value, self.timeout)
+            values.update(
+                self.cache.get_many([self._key("available", pk) for pk in missing])
+            )
+            for pk in missing:
+                values.setdefault(self._key("available", pk), stock[pk])
+
+        return {keys[key]: value for key, value in values.items()}
+
+    def _adjust(self, product_id, delta):
+        key = self._key("available", product_id)
+        try:
+            return self.cache.incr(key, delta)
+        except ValueError:
+            # The counter expired in the meantime
+            self._counters([product_id])
+            return self.cache.incr(key, delta)
+
+    def _rows(self, order, type, negative, **kwargs):
+        factor = negative and -1 or 1
+        payment = kwargs.pop("payment", None)
+        common = {
+            "period_id": Period.objects.current().pk,
+            "created": timezone.now(),
+            "type": type,
+            "order_id": order.pk,
+            "payment_id": getattr(payment, "pk", payment),
+            **kwargs,
+        }
+        return [
+            dict(
+                common,
+                product_id=item.product_id,
+                change=item.quantity * factor,
+                name=item.name,
+                sku=item.sku,
+                line_item_price=item._line_item_price,
+                line_item_discount=item._line_item_discount,
+                line_item_tax=item._line_item_tax,
+            )
+            for item in order.items.all()
+        ]
+
+    def _enqueue(self, entry):
+        self.cache.add(self._key("tail"), 0, None)
+        position = self.cache.incr(self._key("tail"))
+        self.cache.set(self._key("queue", position), entry, None)
+
+        if position - self.cache.get(self._key("head"), 0) >= self.batch_size:
+            self.flush()
+
+    def availability(self, products, exclude_order=None, include_reservations=False):
+        if not include_reservations:
+            self.flush()
+            return super().availability(products, exclude_order=exclude_order)
+
+        product_ids = {getattr(product, "pk", product) for product in products}
+        available = dict.fromkeys(product_ids, 0)
+        available.update(self._counters(product_ids))
+
+        if exclude_order:
+            reserved = self.cache.get(
+                self._key("order", getattr(exclude_order, "pk", exclude_order))
+            )
+            for product_id, quantity in (reserved or {}).items():
+                if product_id in available:
+                    available[product_id] += quantity
+
+        return available
+
+    def cached_availability(self, products):
+        # The counters are cached already
+        return self.availability(products, include_reservations=True)
+
+    def reserve(self, order, **kwargs):
+        self.release(order)
+
+        items = list(order.items.select_related("product"))
+        quantities = defaultdict(int)
+        for item in items:
+            if item.product_id:
+                quantities[item.product_id] += item.quantity
+
+        self._counters(quantities)
+        reserved = []
+        for product_id in sorted(quantities):
+            reserved.append(product_id)
+            if self._adjust(product_id, -quantities[product_id]) < 0:
+                for undo in reserved:
+                    self._adjust(undo, quantities[undo])
+                product = next(i.product for i in items if i.product_id == product_id)
+                raise ValidationError(
+                    _("Not enough stock available for %s.") % product,
+                    code="insufficient_stock",
+                )
+
+        self.cache.set(self._key("order", order.pk), dict(quantities), None)
+
+        StockTransaction = plata.stock_model()
+        if "expires" not in kwargs:
+            kwargs["expires"] = timezone.now() + timedelta(
+                seconds=plata.settings.PLATA_STOCK_RESERVATION_TTL
+            )
+        self._enqueue(
+            (
+                "insert",
+                self._rows(
+                    order,
+                    StockTransaction.PAYMENT_PROCESS_RESERVATION,
+                    True,
+                    **kwargs,
+                ),
+            )
+        )
+
+    def release(self, order):
+        key = self._key("order", order.pk)
+        quantities = self.cache.get(key)
+
+        # Only one of several concurrent releases may return the stock
+        if quantities is not None and self.cache.delete(key):
+            for product_id, quantity in quantities.items():
+                self._adjust(product_id, quantity)
+            self._enqueue(("release", order.pk))
+
+    def commit_sale(self, order, **kwargs):
+        rows = self._rows(order, plata.stock_model().SALE, True, **kwargs)
+        changes = defaultdict(int)
+        for row in rows:
+            if row["product_id"]:
+                changes[row["product_id"]] += row["change"]
+
+        self._counters(changes)
+        for product_id, change in changes.items():
+            self._adjust(product_id, change)
+
+        self._enqueue(("insert", rows))
+
+    def expire_reservations(self, now=None):
+        now = now or timezone.now()
+        self.flush()
+
+        orders = set(
+            self.ledger.expired_reservations(now)
+            .filter(order__isnull=False)
+            .values_list("order", flat=True)
+        )
+        count = self.ledger.expire_reservations(now=now)
+
+        for order_id in orders:
+            key = self._key("order", order_id)
+            quantities = self.cache.get(key)
+            if quantities is not None and self.cache.delete(key):
+                for product_id, quantity in quantities.items():
+                    self._adjust(product_id, quantity)
+
+        return count
+
+    def flush(self, wait=False):
+        while not self.cache.add(self._key("lock"), 1, self.lock_timeout):
+            # Somebody else is flushing right now
+            if not wait:
+                return 0
+            # The lock expires after lock_timeout seconds at the latest
+            time.sleep(self.lock_poll_interval)
+
+        flushed = 0
+        try:
+            head = self.cache.get(self._key("head"), 0)
+            tail = self.cache.get(self._key("tail"), 0)
+
+            while head < tail:
+                keys = [
+                    self._key("queue", position)
+                    for position in range(
+                        head + 1, min(tail, head + self.batch_size) + 1
+                    )
+                ]
+                entries = self.cache.get_many(keys)
+
+                batch = []
+                for key in keys:
+                    if key not in entries:
+                        # Not written yet, retry during the next flush
+                        break
+                    batch.append(entries[key])
+
+                if not batch:
+                    break
+
+                self._write(batch)
+                head += len(batch)
+                self.cache.set(self._key("head"), head, None)
+                self.cache.delete_many(keys[: len(batch)])
+                flushed += len(batch)
+
+                if len(batch) < len(keys):
+                    break
+        finally:
+            self.cache.delete(self._key("lock"))
+
+        if flushed:
+            logger.info("Flushed %s queued stock changes" % flushed)
+        return flushed
+
+    def _write(self, batch):
+        StockTransaction = plata.stock_model()
+        pending = []
+
+        with transaction.atomic():
+            for operation, value in batch:
+                if operation == "insert":
+                    pending.extend(StockTransaction(**row) for row in value)
+                else:
+                    # Reservations have to exist before being released
+                    self.ledger.bulk_insert(pending)
+                    pending = []
+                    super().release(value)
+
+            self.ledger.bulk_insert(pending)
+
+
+class LocalCounterBackend(CounterBackend):
+    """
+    ``CounterBackend`` using a process-local in-memory cache
+    """
+
+    cache = None
+
+    def __init__(self):
+        self.cache = LocMemCache(
+            "plata-stock-%s" % id(self),
+            {"TIMEOUT": None, "OPTIONS": {"MAX_ENTRIES": 10**9}},
+        )
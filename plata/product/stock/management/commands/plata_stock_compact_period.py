@@ -0,0 +1,66 @@
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+import plata
+from plata.product.stock.models import Period
+
+
+class Command(BaseCommand):
+    help = (
+        "Archives the stock transactions of a closed period and replaces them"
+        " with one summary transaction per product and type."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("period", type=int, metavar="PERIOD_ID")
+        parser.add_argument(
+            "--archive",
+            metavar="FILE",
+            help="Append the raw transactions to this JSON Lines file.",
+        )
+        parser.add_argument(
+            "--no-archive",
+            action="store_true",
+            help="Discard the raw transactions instead of archiving them.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of products processed per transaction.",
+        )
+
+    def handle(self, **options):
+        try:
+            period = Period.objects.get(pk=options["period"])
+        except Period.DoesNotExist:
+            raise CommandError("Period %s does not exist." % options["period"])
+
+        if not options["archive"] and not options["no_archive"]:
+            raise CommandError("Pass either --archive FILE or --no-archive.")
+
+        def progress(processed, total):
+            self.stdout.write("%s/%s products processed" % (processed, total))
+
+        StockTransaction = plata.stock_model()
+        if options["archive"]:
+            archive_file = open(options["archive"], "a", encoding="utf-8")
+        else:
+            archive_file = nullcontext()
+
+        with archive_file as archive:
+            try:
+                removed = StockTransaction.objects.compact_period(
+                    period,
+                    archive=archive,
+                    chunk_size=options["chunk_size"],
+                    progress=progress,
+                )
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        self.stdout.write(
+            "Compacted period %s (%s), removed %s transactions."
+            % (period, period.pk, removed)
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+import plata
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes expired payment process reservations and updates the stock"
+        " balances accordingly. Run this periodically, e.g. every few minutes."
+    )
+
+    def handle(self, **options):
+        count = plata.stock_backend().expire_reservations()
+        self.stdout.write("Deleted %s expired reservations." % count)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+import plata
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes stock changes queued by write-behind stock backends to the"
+        " stock transaction ledger."
+    )
+
+    def handle(self, **options):
+        count = plata.stock_backend().flush()
+        self.stdout.write("Flushed %s queued stock changes." % count)
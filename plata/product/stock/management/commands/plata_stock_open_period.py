@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import plata
+from plata.product.stock.models import Period
+
+
+class Command(BaseCommand):
+    help = (
+        "Opens a new stock period and creates initial stock transactions for"
+        " all products with their current items_in_stock value."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", help="Name of the new period.")
+        parser.add_argument(
+            "--resume",
+            type=int,
+            metavar="PERIOD_ID",
+            help="Resume an interrupted run for an existing period.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of products processed per transaction.",
+        )
+        parser.add_argument(
+            "--skip-zero-stock",
+            action="store_true",
+            help="Do not create initial transactions for products without stock.",
+        )
+
+    def handle(self, **options):
+        period = None
+        if options["resume"]:
+            try:
+                period = Period.objects.get(pk=options["resume"])
+            except Period.DoesNotExist:
+                raise CommandError("Period %s does not exist." % options["resume"])
+
+        def progress(processed, total):
+            self.stdout.write("%s/%s products processed" % (processed, total))
+
+        StockTransaction = plata.stock_model()
+        period = StockTransaction.objects.open_new_period(
+            name=options["name"],
+            period=period,
+            chunk_size=options["chunk_size"],
+            skip_zero_stock=options["skip_zero_stock"],
+            progress=progress,
+        )
+        self.stdout.write("Opened period %s (%s)." % (period, period.pk))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+import plata
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the materialized stock balances and items_in_stock values"
+        " with the stock transaction ledger and reports any drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Overwrite drifted values with the values from the ledger.",
+        )
+
+    def handle(self, **options):
+        StockTransaction = plata.stock_model()
+        drift = StockTransaction.objects.reconcile(fix=options["fix"])
+
+        for row in drift:
+            self.stdout.write(
+                "Product %(product)s, type %(type)s: expected %(expected)s,"
+                " found %(actual)s" % row
+            )
+
+        if not drift:
+            self.stdout.write("No drift found.")
+        elif options["fix"]:
+            self.stdout.write("Fixed %s drifted values." % len(drift))
@@ -14,13 +14,33 @@ Follow these steps to enable this module:
   checkout and payment processes.
 - Optionally modify your add-to-cart forms on product detail pages to take
   into account ``items_in_stock``.
+
+``items_in_stock`` and the per-type ``StockBalance`` totals are maintained
+incrementally whenever a stock transaction is saved or deleted. Run
+``./manage.py plata_stock_reconcile`` periodically to verify them against
+the transaction ledger (add ``--fix`` to repair any drift).
+
+Use ``./manage.py plata_stock_open_period`` to open a new period, e.g. at
+the start of each year. Interrupted runs can be resumed using ``--resume``.
+Expired payment process reservations are deleted by
+``./manage.py plata_stock_expire_reservations``. The transactions of
+closed periods can be archived and summarized using
+``./manage.py plata_stock_compact_period``.
 """
 
+import io
+import logging
+import operator
+import os
+import time
+from collections import defaultdict
 from datetime import timedelta
+from functools import reduce
 
+from django.core import serializers
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q, Sum
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
 from django.utils import timezone
 from django.utils.translation import gettext, gettext_lazy as _
 
@@ -28,20 +48,57 @@ import plata
 from plata.shop.models import Order, OrderPayment
 
 
+logger = logging.getLogger("plata.product.stock")
+
+
 class PeriodManager(models.Manager):
+    #: ``(period, expires)`` tuple shared by all threads of the process
+    _current = None
+
     def current(self):
         """
         Return the newest active period
+
+        The period is cached in the process for
+        ``PLATA_STOCK_PERIOD_CACHE_TIMEOUT`` seconds, but never beyond the
+        start of the next (future) period. Saving or deleting periods
+        clears the cache.
         """
 
+        now = timezone.now()
+        cached = PeriodManager._current
+        if cached and now < cached[1]:
+            return cached[0]
+
         try:
-            return self.filter(start__lte=timezone.now()).order_by("-start")[0]
+            period = self.filter(start__lte=now).order_by("-start")[0]
         except IndexError:
             return self.create(
                 name=gettext("Automatically created"),
                 notes=gettext("Automatically created because no period existed yet."),
             )
 
+        timeout = plata.settings.PLATA_STOCK_PERIOD_CACHE_TIMEOUT
+        if timeout:
+            expires = now + timedelta(seconds=timeout)
+            next_start = (
+                self.filter(start__gt=now)
+                .order_by("start")
+                .values_list("start", flat=True)
+                .first()
+            )
+            if next_start and next_start < expires:
+                expires = next_start
+            PeriodManager._current = (period, expires)
+
+        return period
+
+    def clear_cache(self):
+        """
+        Forget the cached current period
+        """
+        PeriodManager._current = None
+
 
 class Period(models.Model):
     """
@@ -76,21 +133,248 @@ class Period(models.Model):
 
 
 class StockTransactionManager(models.Manager):
-    def open_new_period(self, name=None):
+    def open_new_period(
+        self,
+        name=None,
+        period=None,
+        chunk_size=1000,
+        skip_zero_stock=False,
+        progress=None,
+    ):
         """
         Create a new period and create initial transactions for all product
         variations with their current ``items_in_stock`` value
+
+        Products are streamed in primary key order and processed in chunks
+        of ``chunk_size``, each in its own database transaction. Pass an
+        existing ``period`` to resume an interrupted run; products which
+        already have been processed are skipped. Products without stock do
+        not get an initial transaction if ``skip_zero_stock`` is ``True``.
+
+        Other processes may have cached the current period (see
+        ``PeriodManager.current``) and would keep booking stock changes into
+        the old period. The new period therefore starts
+        ``PLATA_STOCK_PERIOD_CACHE_TIMEOUT`` seconds from now, when all
+        these caches have expired; this method waits until then before
+        creating the initial transactions.
+
+        ``progress`` is called as ``progress(processed, total)`` after every
+        chunk. Returns the period.
+        """
+
+        if period is None:
+            period = Period.objects.create(
+                name=name or gettext("New period"),
+                start=timezone.now()
+                + timedelta(
+                    seconds=plata.settings.PLATA_STOCK_PERIOD_CACHE_TIMEOUT or 0
+                ),
+            )
+            start_after = None
+        else:
+            start_after = (
+                self.filter(period=period, type=self.model.INITIAL)
+                .order_by("-product")
+                .values_list("product", flat=True)
+                .first()
+            )
+
+        wait = (period.start - timezone.now()).total_seconds()
+        if wait > 0:
+            time.sleep(wait)
+
+        products = plata.product_model()._default_manager.order_by("pk")
+        if start_after is not None:
+            products = products.filter(pk__gt=start_after)
+
+        total = products.count() if progress else None
+        processed = 0
+        chunk = []
+
+        for pk in products.values_list("pk", flat=True).iterator(chunk_size=chunk_size):
+            chunk.append(pk)
+            if len(chunk) >= chunk_size:
+                processed += self._open_period_chunk(period, chunk, skip_zero_stock)
+                chunk = []
+                if progress:
+                    progress(processed, total)
+
+        if chunk:
+            processed += self._open_period_chunk(period, chunk, skip_zero_stock)
+            if progress:
+                progress(processed, total)
+
+        return period
+
+    def _open_period_chunk(self, period, pks, skip_zero_stock):
         """
+        Create the initial transactions and balances for a chunk of products
 
-        period = Period.objects.create(name=name or gettext("New period"))
+        Stock movements which already happened in the new period have been
+        added to ``items_in_stock`` already and are therefore subtracted
+        from the initial amount.
+        """
 
-        for p in plata.product_model()._default_manager.all():
-            p.stock_transactions.create(
-                period=period,
-                type=StockTransaction.INITIAL,
-                change=p.items_in_stock,
-                notes=gettext("New period"),
+        with transaction.atomic():
+            products = (
+                plata.product_model()
+                ._default_manager.select_for_update()
+                .filter(pk__in=pks)
+                .order_by("pk")
             )
+            movements = dict(
+                StockBalance.objects.filter(period=period, product__in=pks)
+                .exclude(type=self.model.PAYMENT_PROCESS_RESERVATION)
+                .values("product")
+                .annotate(movements=Sum("total"))
+                .values_list("product", "movements")
+            )
+
+            transactions = []
+            for product in products:
+                change = product.items_in_stock - movements.get(product.pk, 0)
+                if change or not skip_zero_stock:
+                    transactions.append(
+                        self.model(
+                            period=period,
+                            product=product,
+                            type=self.model.INITIAL,
+                            change=change,
+                            notes=gettext("New period"),
+                        )
+                    )
+
+            self._handle_stock_transactions(transactions)
+            # Manager.bulk_create; items_in_stock already is up to date
+            super().bulk_create(transactions)
+            StockBalance.objects.apply_changes(
+                period.pk,
+                self.model.INITIAL,
+                {t.product_id: t.change for t in transactions if t.change},
+            )
+
+        logger.info(
+            "Opened period %s for %s products (%s transactions)"
+            % (period.pk, len(pks), len(transactions))
+        )
+        return len(pks)
+
+    def compact_period(self, period, archive=None, chunk_size=1000, progress=None):
+        """
+        Replace the stock transactions of a closed period with one summary
+        transaction per product and type
+
+        The sums per product and type -- and therefore the ``StockBalance``
+        totals, ``reconcile`` and the product reports -- stay the same, but
+        the order and payment references of the individual transactions
+        are lost. If ``archive`` (a text file object) is given, the raw
+        transactions are written to it in the JSON Lines serialization
+        format first; ``./manage.py loaddata`` can restore them. The archive
+        is flushed and synced to disk before the transactions of a chunk
+        are deleted.
+
+        Products are streamed in primary key order and processed in chunks
+        of ``chunk_size``, each in its own database transaction. Products
+        which do not have more than one transaction per type are skipped,
+        therefore interrupted runs can simply be restarted. Transactions of
+        deleted products are archived and removed.
+
+        ``progress`` is called as ``progress(processed, total)`` after every
+        chunk. Returns by how many transactions the ledger shrank.
+        """
+
+        if not Period.objects.filter(
+            start__gt=period.start, start__lte=timezone.now()
+        ).exists():
+            raise ValueError("Period %s has not been closed yet." % period.pk)
+
+        products = plata.product_model()._default_manager.order_by("pk")
+        total = products.count() if progress else None
+        processed = 0
+        removed = 0
+        chunk = []
+
+        for pk in products.values_list("pk", flat=True).iterator(chunk_size=chunk_size):
+            chunk.append(pk)
+            if len(chunk) >= chunk_size:
+                removed += self._compact_period_chunk(period, chunk, archive)
+                processed += len(chunk)
+                chunk = []
+                if progress:
+                    progress(processed, total)
+
+        if chunk:
+            removed += self._compact_period_chunk(period, chunk, archive)
+            processed += len(chunk)
+            if progress:
+                progress(processed, total)
+
+        removed += self._compact_period_chunk(period, None, archive)
+        return removed
+
+    def _compact_period_chunk(self, period, pks, archive):
+        """
+        Archive and summarize the transactions of a chunk of products, or of
+        all deleted products if ``pks`` is ``None``
+        """
+
+        transactions = self.filter(period=period)
+        if pks is None:
+            transactions = transactions.filter(product__isnull=True)
+        else:
+            transactions = transactions.filter(product__in=pks)
+
+        with transaction.atomic():
+            # Transactions added while compacting are left alone
+            last = transactions.aggregate(last=models.Max("pk"))["last"]
+            if last is None:
+                return 0
+            transactions = transactions.filter(pk__lte=last).order_by("pk")
+
+            totals = []
+            if pks is not None:
+                totals = list(
+                    transactions.order_by()
+                    .values("product", "type")
+                    .annotate(total=Sum("change"), count=models.Count("pk"))
+                )
+                compact = {row["product"] for row in totals if row["count"] > 1}
+                if not compact:
+                    return 0
+                totals = [row for row in totals if row["product"] in compact]
+                transactions = transactions.filter(product__in=compact)
+
+            if archive is not None:
+                serializers.serialize("jsonl", transactions.iterator(), stream=archive)
+                # The raw transactions are gone once this transaction commits
+                archive.flush()
+                try:
+                    fileno = archive.fileno()
+                except (AttributeError, io.UnsupportedOperation):
+                    pass
+                else:
+                    os.fsync(fileno)
+
+            # Nothing references stock transactions and the sums do not
+            # change -- the balances do not have to be updated.
+            removed = transactions._raw_delete(self.db)
+            super().bulk_create(
+                self.model(
+                    period=period,
+                    created=period.start,
+                    product_id=row["product"],
+                    type=row["type"],
+                    change=row["total"],
+                    notes=gettext("Summary of %s transactions") % row["count"],
+                )
+                for row in totals
+            )
+
+        logger.info(
+            "Compacted %s transactions of period %s into %s"
+            % (removed, period.pk, len(totals))
+        )
+        return removed - len(totals)
 
     def items_in_stock(
         self, product, update=False, exclude_order=None, include_reservations=False
@@ -99,6 +383,10 @@ class StockTransactionManager(models.Manager):
         Determine the items in stock for the given product variation,
         optionally updating the ``items_in_stock`` field in the database.
 
+        The stock is determined using ``availability``. ``update=True``
+        recalculates the stock from the full ledger instead and writes the
+        result to the ``items_in_stock`` field.
+
         If ``exclude_order`` is given, ``update`` is always switched off
         and transactions from the given order aren't taken into account.
 
@@ -106,22 +394,25 @@ class StockTransactionManager(models.Manager):
         switched off.
         """
 
-        queryset = self.filter(period=Period.objects.current(), product=product)
+        product_id = getattr(product, "pk", product)
 
-        if exclude_order:
+        if exclude_order or include_reservations:
             update = False
-            queryset = queryset.filter(Q(order__isnull=True) | ~Q(order=exclude_order))
 
-        if include_reservations:
-            update = False
-            queryset = queryset.exclude(
-                type=self.model.PAYMENT_PROCESS_RESERVATION,
-                created__lt=timezone.now() - timedelta(seconds=15 * 60),
+        if update:
+            count = (
+                self.filter(period=Period.objects.current(), product=product_id)
+                .exclude(type=self.model.PAYMENT_PROCESS_RESERVATION)
+                .aggregate(items=Sum("change"))
+                .get("items")
+                or 0
             )
         else:
-            queryset = queryset.exclude(type=self.model.PAYMENT_PROCESS_RESERVATION)
-
-        count = queryset.aggregate(items=Sum("change")).get("items") or 0
+            count = self.availability(
+                [product_id],
+                exclude_order=exclude_order,
+                include_reservations=include_reservations,
+            )[product_id]
 
         product_model = plata.product_model()
 
@@ -129,25 +420,240 @@ class StockTransactionManager(models.Manager):
             product.items_in_stock = count
 
         if update:
-            product_model._default_manager.filter(
-                id=getattr(product, "pk", product)
-            ).update(items_in_stock=count)
+            product_model._default_manager.filter(id=product_id).update(
+                items_in_stock=count
+            )
 
         return count
 
+    def availability(self, products, exclude_order=None, include_reservations=False):
+        """
+        Determine the items in stock for several product variations at
+        once using a single grouped query
+
+        Returns a dictionary mapping product IDs to the available quantity.
+        ``exclude_order`` and ``include_reservations`` have the same meaning
+        as in ``items_in_stock``.
+
+        The stock is read from the per-type ``StockBalance`` totals; only
+        the transactions of ``exclude_order`` and live payment process
+        reservations are read from the ledger itself.
+        """
+
+        product_ids = {getattr(product, "pk", product) for product in products}
+        available = dict.fromkeys(product_ids, 0)
+        if not product_ids:
+            return available
+
+        period = Period.objects.current()
+        exclude_order = getattr(exclude_order, "pk", exclude_order)
+        reservation = self.model.PAYMENT_PROCESS_RESERVATION
+
+        queryset = (
+            StockBalance.objects.filter(period=period, product__in=product_ids)
+            .order_by()
+            .values("product")
+            .annotate(stock=Sum("total", filter=~Q(type=reservation)))
+        )
+
+        adjustments = []
+        if exclude_order:
+            adjustments.append(
+                When(
+                    Q(order=exclude_order) & ~Q(type=reservation),
+                    then=-F("change"),
+                )
+            )
+        if include_reservations:
+            reservations = Q(type=reservation) & ~self._expired(timezone.now())
+            if exclude_order:
+                reservations &= Q(order__isnull=True) | ~Q(order=exclude_order)
+            adjustments.append(When(reservations, then=F("change")))
+
+        if adjustments:
+            queryset = queryset.annotate(
+                adjustment=Subquery(
+                    self.filter(period=period, product=OuterRef("product"))
+                    .filter(
+                        reduce(operator.or_, (when.condition for when in adjustments))
+                    )
+                    .order_by()
+                    .values("product")
+                    .annotate(
+                        adjustment=Sum(
+                            Case(*adjustments, default=0),
+                            output_field=models.IntegerField(),
+                        )
+                    )
+                    .values("adjustment")
+                )
+            )
+
+        for row in queryset:
+            available[row["product"]] = (row["stock"] or 0) + (
+                row.get("adjustment") or 0
+            )
+
+        return available
+
+    def apply_changes(self, entries, create=True):
+        """
+        Apply stock changes to the ``StockBalance`` totals and to the
+        ``items_in_stock`` field of the affected products using atomic
+        ``F()`` updates instead of recalculating the ledger
+
+        ``entries`` is an iterable of ``(period_id, product_id, type,
+        change)`` tuples. Changes are summed up per balance row and per
+        product first. Only changes in the current period are applied to
+        ``items_in_stock``, and payment process reservations never are.
+
+        Missing balance rows are created unless ``create`` is ``False``.
+        """
+
+        balances = defaultdict(int)
+        for period_id, product_id, type, change in entries:
+            if product_id is not None and change:
+                balances[(period_id, product_id, type)] += change
+
+        if not balances:
+            return
+
+        current_period_id = Period.objects.current().pk
+        groups = defaultdict(dict)
+        products = defaultdict(int)
+
+        for (period_id, product_id, type), change in balances.items():
+            if not change:
+                continue
+
+            groups[(period_id, type)][product_id] = change
+
+            if (
+                period_id == current_period_id
+                and type != self.model.PAYMENT_PROCESS_RESERVATION
+            ):
+                products[product_id] += change
+
+        for (period_id, type), changes in groups.items():
+            StockBalance.objects.apply_changes(period_id, type, changes, create=create)
+
+        products = {pk: change for pk, change in products.items() if change}
+        if products:
+            plata.product_model()._default_manager.filter(pk__in=products).update(
+                items_in_stock=F("items_in_stock") + _case_per_pk("pk", products)
+            )
+
+    def reconcile(self, period=None, fix=False):
+        """
+        Compare the ``StockBalance`` totals and the ``items_in_stock``
+        field of all products with the transaction ledger of the given
+        (or the current) period
+
+        Returns a list of dictionaries describing every drift found; the
+        ``type`` key is ``None`` for ``items_in_stock`` drifts. Pass
+        ``fix=True`` to overwrite the materialized values with the values
+        from the ledger.
+        """
+
+        current_period = Period.objects.current()
+        period = period or current_period
+
+        ledger = defaultdict(int)
+        for row in (
+            self.filter(period=period, product__isnull=False)
+            .order_by()
+            .values("product", "type")
+            .annotate(total=Sum("change"))
+        ):
+            ledger[(row["product"], row["type"])] = row["total"] or 0
+
+        balances = {
+            (product_id, type): total
+            for product_id, type, total in StockBalance.objects.filter(
+                period=period
+            ).values_list("product", "type", "total")
+        }
+
+        drift = [
+            {
+                "product": product_id,
+                "type": type,
+                "expected": ledger.get((product_id, type), 0),
+                "actual": balances.get((product_id, type), 0),
+            }
+            for product_id, type in sorted(set(ledger) | set(balances))
+            if ledger.get((product_id, type), 0) != balances.get((product_id, type), 0)
+        ]
+
+        if period == current_period:
+            stock = defaultdict(int)
+            for (product_id, type), total in ledger.items():
+                if type != self.model.PAYMENT_PROCESS_RESERVATION:
+                    stock[product_id] += total
+
+            for product_id, items_in_stock in (
+                plata.product_model()
+                ._default_manager.order_by("pk")
+                .values_list("pk", "items_in_stock")
+                .iterator()
+            ):
+                if items_in_stock != stock.get(product_id, 0):
+                    drift.append(
+                        {
+                            "product": product_id,
+                            "type": None,
+                            "expected": stock.get(product_id, 0),
+                            "actual": items_in_stock,
+                        }
+                    )
+
+        for row in drift:
+            logger.warning(
+                "Stock drift for product %(product)s, type %(type)s:"
+                " expected %(expected)s, found %(actual)s" % row
+            )
+
+        if fix and drift:
+            product_manager = plata.product_model()._default_manager
+
+            with transaction.atomic():
+                for row in drift:
+                    if row["type"] is None:
+                        product_manager.filter(pk=row["product"]).update(
+                            items_in_stock=row["expected"]
+                        )
+                    else:
+                        StockBalance.objects.update_or_create(
+                            period=period,
+                            product_id=row["product"],
+                            type=row["type"],
+                            defaults={"total": row["expected"]},
+                        )
+
+        return drift
+
     def bulk_create(self, order, type, negative, **kwargs):
         """
         Create transactions in bulk for every order item
 
         Set ``negative`` to ``True`` for sales, lendings etc. (anything
         that diminishes the stock you have)
+
+        The transactions are saved using ``bulk_insert``.
         """
 
         # Set negative to True for sales, lendings etc.
         factor = negative and -1 or 1
+        kwargs.setdefault("period", Period.objects.current())
+        if type == self.model.PAYMENT_PROCESS_RESERVATION:
+            kwargs.setdefault(
+                "expires",
+                timezone.now()
+                + timedelta(seconds=plata.settings.PLATA_STOCK_RESERVATION_TTL),
+            )
 
-        for item in order.items.all():
-            self.model.objects.create(
+        transactions = [
+            self.model(
                 product=item.product,
                 type=type,
                 change=item.quantity * factor,
@@ -159,6 +665,194 @@ class StockTransactionManager(models.Manager):
                 line_item_tax=item._line_item_tax,
                 **kwargs,
             )
+            for item in order.items.select_related("product")
+        ]
+
+        return self.bulk_insert(transactions)
+
+    def bulk_insert(self, transactions):
+        """
+        Save a list of unsaved stock transactions
+
+        All transactions are inserted using a single query and the stock
+        balances are updated once per batch, independent of the number of
+        transactions. No ``post_save`` signals are sent. If the product model
+        has a ``handle_stock_transactions`` classmethod, it is called once
+        with the list of unsaved transactions; otherwise
+        ``handle_stock_transaction`` is called for every transaction, just
+        like ``StockTransaction.save`` does.
+        """
+
+        if not transactions:
+            return []
+
+        self._handle_stock_transactions(transactions)
+
+        with transaction.atomic():
+            # Manager.bulk_create, not this method
+            transactions = super().bulk_create(transactions)
+            self.apply_changes(
+                stock_transaction.ledger_entry() for stock_transaction in transactions
+            )
+
+        for stock_transaction in transactions:
+            stock_transaction._ledger_entry = stock_transaction.ledger_entry()
+
+        return transactions
+
+    def reserve(self, order, **kwargs):
+        """
+        Atomically check the stock of all order items and create payment
+        process reservations for them
+
+        The product rows are locked in primary key order (so that concurrent
+        checkouts cannot deadlock) for the rest of the transaction, which
+        means that concurrent reservations of the same products are
+        serialized and cannot oversell. Raises a ``ValidationError`` with
+        code ``insufficient_stock`` if not enough stock is available; nothing
+        is reserved in this case. Additional keyword arguments are passed on
+        to ``bulk_create``.
+        """
+
+        with transaction.atomic():
+            list(
+                plata.product_model()
+                ._default_manager.select_for_update()
+                .filter(pk__in=order.items.values("product"))
+                .order_by("pk")
+                .values_list("pk", flat=True)
+            )
+            check_order_stock(order, self.availability)
+            return self.bulk_create(
+                order,
+                type=self.model.PAYMENT_PROCESS_RESERVATION,
+                negative=True,
+                **kwargs,
+            )
+
+    def _expired(self, now):
+        """
+        Returns a ``Q`` object matching reservations which have expired at
+        ``now``
+
+        Reservations created before ``expires`` has been introduced have no
+        expiry date; they expire ``PLATA_STOCK_RESERVATION_TTL`` seconds
+        after their creation.
+        """
+
+        return Q(expires__lte=now) | Q(
+            expires__isnull=True,
+            created__lte=now
+            - timedelta(seconds=plata.settings.PLATA_STOCK_RESERVATION_TTL),
+        )
+
+    def expired_reservations(self, now=None):
+        """
+        Returns all payment process reservations which have expired at
+        ``now`` (defaults to the current time)
+        """
+
+        return self.filter(
+            self._expired(now or timezone.now()),
+            type=self.model.PAYMENT_PROCESS_RESERVATION,
+        )
+
+    def expire_reservations(self, now=None, chunk_size=1000):
+        """
+        Delete all payment process reservations which have expired at
+        ``now`` (defaults to the current time) in bulk
+
+        Returns the number of deleted reservations, see
+        ``_delete_reservations``.
+        """
+
+        count = self._delete_reservations(
+            self.expired_reservations(now), chunk_size=chunk_size
+        )
+        if count:
+            logger.info("Deleted %s expired payment process reservations" % count)
+        return count
+
+    def release_reservations(self, order):
+        """
+        Delete all payment process reservations of the given order (an
+        instance or a primary key) in bulk
+
+        Returns the number of deleted reservations, see
+        ``_delete_reservations``.
+        """
+
+        return self._delete_reservations(
+            self.filter(
+                type=self.model.PAYMENT_PROCESS_RESERVATION,
+                order=getattr(order, "pk", order),
+            )
+        )
+
+    def _delete_reservations(self, reservations, chunk_size=1000):
+        """
+        Delete the payment process reservations in the queryset using a
+        single query and update the stock balances once per period and
+        product instead of once per reservation; no ``post_delete`` signals
+        are sent
+
+        Reservations are deleted in chunks of ``chunk_size``, each in its
+        own database transaction, so that a large backlog of expired
+        reservations does not lock all of them at once.
+        """
+
+        count = 0
+        while True:
+            deleted = self._delete_reservations_chunk(reservations, chunk_size)
+            count += deleted
+            if deleted < chunk_size:
+                return count
+
+    def _delete_reservations_chunk(self, reservations, chunk_size):
+        with transaction.atomic():
+            rows = list(
+                reservations.select_for_update()
+                .order_by("pk")
+                .values_list("pk", "period", "product", "change")[:chunk_size]
+            )
+            if not rows:
+                return 0
+
+            # Nothing references stock transactions, and the balances are
+            # updated below -- a raw delete is safe and avoids sending
+            # signals for every single row.
+            self.filter(pk__in=[row[0] for row in rows])._raw_delete(self.db)
+            self.apply_changes(
+                (
+                    (
+                        period_id,
+                        product_id,
+                        self.model.PAYMENT_PROCESS_RESERVATION,
+                        -change,
+                    )
+                    for pk, period_id, product_id, change in rows
+                ),
+                create=False,
+            )
+
+        return len(rows)
+
+    def _handle_stock_transactions(self, transactions):
+        """
+        Call the batch-aware ``handle_stock_transactions`` classmethod of
+        the product model if it exists, ``handle_stock_transaction`` of
+        every product otherwise
+        """
+
+        product_model = plata.product_model()
+        if hasattr(product_model, "handle_stock_transactions"):
+            product_model.handle_stock_transactions(transactions)
+        else:
+            for stock_transaction in transactions:
+                if hasattr(stock_transaction.product, "handle_stock_transaction"):
+                    stock_transaction.product.handle_stock_transaction(
+                        stock_transaction
+                    )
 
 
 def current_period():
@@ -192,7 +886,8 @@ class StockTransaction(models.Model):
     - ``PAYMENT_PROCESS_RESERVATION`` transactions are created by payment
       modules which send the user to a different domain for payment data
       entry (f.e. PayPal). These transactions are also special in that they
-      are only valid for 15 minutes. After 15 minutes, other customers are
+      are only valid until ``expires`` (15 minutes by default, see
+      ``PLATA_STOCK_RESERVATION_TTL``). Afterwards, other customers are
       able to put the product in their cart and proceed to checkout again.
       This time period is a security measure against customers buying
       products at the same time which cannot be delivered afterwards because
@@ -233,6 +928,12 @@ class StockTransaction(models.Model):
         verbose_name=_("period"),
     )
     created = models.DateTimeField(_("created"), default=timezone.now)
+    expires = models.DateTimeField(
+        _("expires"),
+        blank=True,
+        null=True,
+        help_text=_("Payment process reservations are released at this time."),
+    )
     product = models.ForeignKey(
         plata.settings.PLATA_SHOP_PRODUCT,
         related_name="stock_transactions",
@@ -281,6 +982,7 @@ class StockTransaction(models.Model):
     class Meta:
         # See https://github.com/matthiask/plata/issues/27
         abstract = not plata.settings.PLATA_STOCK_TRACKING
+        indexes = [models.Index(fields=["product", "type", "expires"])]
         ordering = ["-id"]
         verbose_name = _("stock transaction")
         verbose_name_plural = _("stock transactions")
@@ -290,20 +992,178 @@ class StockTransaction(models.Model):
     def __str__(self):
         return f"{self.change} {self.get_type_display()} of {self.product}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields():
+            # Remember the values the stock balances know about
+            instance._ledger_entry = instance.ledger_entry()
+        return instance
+
+    def ledger_entry(self):
+        """
+        Returns the ``(period_id, product_id, type, change)`` tuple used to
+        maintain the stock balances
+        """
+        return (self.period_id, self.product_id, self.type, self.change)
+
     def save(self, *args, **kwargs):
         if not self.period_id:
             self.period = Period.objects.current()
 
+        if self.type == self.PAYMENT_PROCESS_RESERVATION and not self.expires:
+            self.expires = self.created + timedelta(
+                seconds=plata.settings.PLATA_STOCK_RESERVATION_TTL
+            )
+
         if self.product and hasattr(self.product, "handle_stock_transaction"):
             self.product.handle_stock_transaction(self)
 
+        if self.pk and not hasattr(self, "_ledger_entry"):
+            self._ledger_entry = (
+                self.__class__._default_manager.filter(pk=self.pk)
+                .values_list("period", "product", "type", "change")
+                .first()
+            )
+
         super().save(*args, **kwargs)
 
     save.alters_data = True
 
 
-def update_items_in_stock(instance, **kwargs):
-    StockTransaction.objects.items_in_stock(instance.product_id, update=True)
+def _case_per_pk(field, changes):
+    """
+    Returns an expression evaluating to ``changes[<field value>]`` so that
+    differing changes can be applied to many rows using a single UPDATE
+    """
+
+    return Case(
+        *[When(**{field: pk, "then": Value(change)}) for pk, change in changes.items()],
+        default=Value(0),
+        output_field=models.IntegerField(),
+    )
+
+
+class StockBalanceManager(models.Manager):
+    def apply_change(self, period_id, product_id, type, change, create=True):
+        """
+        Atomically add ``change`` to the running total, creating the balance
+        row if it does not exist yet (and ``create`` is ``True``)
+        """
+
+        filters = {"period_id": period_id, "product_id": product_id, "type": type}
+
+        if self.filter(**filters).update(total=F("total") + change) or not create:
+            return
+
+        try:
+            with transaction.atomic():
+                self.create(total=change, **filters)
+        except IntegrityError:
+            # Somebody else has been faster.
+            self.filter(**filters).update(total=F("total") + change)
+
+    def apply_changes(self, period_id, type, changes, create=True):
+        """
+        Atomically add the changes in the ``{product_id: change}`` dictionary
+        to the running totals of the given period and type using a constant
+        number of queries
+        """
+
+        if not changes:
+            return
+
+        if len(changes) == 1:
+            ((product_id, change),) = changes.items()
+            self.apply_change(period_id, product_id, type, change, create=create)
+            return
+
+        if create:
+            self.bulk_create(
+                [
+                    self.model(period_id=period_id, product_id=product_id, type=type)
+                    for product_id in changes
+                ],
+                ignore_conflicts=True,
+            )
+
+        self.filter(period_id=period_id, type=type, product__in=changes).update(
+            total=F("total") + _case_per_pk("product", changes)
+        )
+
+
+class StockBalance(models.Model):
+    """
+    Running total of all stock transactions of a single type for a product
+    in a period
+
+    These rows are maintained incrementally when stock transactions are
+    saved or deleted. ``StockTransaction.objects.reconcile`` verifies them
+    against the ledger.
+    """
+
+    period = models.ForeignKey(
+        Period,
+        on_delete=models.CASCADE,
+        related_name="stock_balances",
+        verbose_name=_("period"),
+    )
+    product = models.ForeignKey(
+        plata.settings.PLATA_SHOP_PRODUCT,
+        on_delete=models.CASCADE,
+        related_name="stock_balances",
+        verbose_name=_("product"),
+    )
+    type = models.PositiveIntegerField(_("type"), choices=StockTransaction.TYPE_CHOICES)
+    total = models.IntegerField(_("total"), default=0)
+
+    class Meta:
+        # See https://github.com/matthiask/plata/issues/27
+        abstract = not plata.settings.PLATA_STOCK_TRACKING
+        unique_together = (("period", "product", "type"),)
+        verbose_name = _("stock balance")
+        verbose_name_plural = _("stock balances")
+
+    objects = StockBalanceManager()
+
+    def __str__(self):
+        return f"{self.total} {self.get_type_display()} of {self.product}"
+
+
+def clear_period_cache(**kwargs):
+    """
+    Clears the cached current period now and once the transaction
+    modifying the periods has been committed
+    """
+    Period.objects.clear_cache()
+    transaction.on_commit(Period.objects.clear_cache)
+
+
+def stock_transaction_saved(instance, created, **kwargs):
+    """
+    Applies the difference between the previously saved and the current
+    state of the transaction to the stock balances
+    """
+    entries = [instance.ledger_entry()]
+
+    previous = None if created else getattr(instance, "_ledger_entry", None)
+    if previous:
+        entries.append(previous[:3] + (-previous[3],))
+
+    StockTransaction.objects.apply_changes(entries)
+    instance._ledger_entry = instance.ledger_entry()
+
+
+def stock_transaction_deleted(instance, **kwargs):
+    """
+    Removes the deleted transaction from the stock balances
+    """
+    period_id, product_id, type, change = getattr(
+        instance, "_ledger_entry", instance.ledger_entry()
+    )
+    StockTransaction.objects.apply_changes(
+        [(period_id, product_id, type, -change)], create=False
+    )
 
 
 def validate_order_stock_available(order):
@@ -311,10 +1171,25 @@ def validate_order_stock_available(order):
     Check whether enough stock is available for all selected products,
     taking into account payment process reservations.
     """
-    for item in order.items.select_related("product"):
-        if item.quantity > StockTransaction.objects.items_in_stock(
-            item.product, exclude_order=order, include_reservations=True
-        ):
+    check_order_stock(order, plata.stock_backend().availability)
+
+
+def check_order_stock(order, availability):
+    """
+    Raise a ``ValidationError`` if ``availability`` (a callable with the
+    signature of ``StockTransaction.objects.availability``) reports less
+    stock than required by the order items
+    """
+    items = list(order.items.select_related("product"))
+
+    quantities = defaultdict(int)
+    for item in items:
+        quantities[item.product_id] += item.quantity
+
+    available = availability(quantities, exclude_order=order, include_reservations=True)
+
+    for item in items:
+        if quantities[item.product_id] > available.get(item.product_id, 0):
             raise ValidationError(
                 _("Not enough stock available for %s.") % item.product,
                 code="insufficient_stock",
@@ -0,0 +1,171 @@
+"""
+Batch generation of order documents
+===================================
+
+Renders the invoices or packing slips of many orders at once, f.e. the
+packing slips of all orders paid today, and returns them as one merged PDF
+or as a ZIP file containing one PDF per order::
+
+    from plata.reporting.batch import render_batch
+
+    content, content_type, filename = render_batch(
+        Order.objects.filter(status=Order.PAID), 'packing-slip', 'pdf')
+
+Documents are rendered in a pool of ``processes`` worker processes
+(``PLATA_REPORTING_BATCH_PROCESSES``, 2 by default), each using its own
+database connection. Worker processes are started using the ``spawn``
+method and set up Django again; the ``DJANGO_SETTINGS_MODULE`` environment
+variable has to be set. Documents are read from and written to the document
+store if ``PLATA_REPORTING_DOCUMENT_STORAGE`` is set (see
+:mod:`plata.reporting.documents`).
+
+Every document is rendered in the language of its order without changing
+the active language of the calling thread. Merging PDFs requires
+`pypdf <https://pypi.org/project/pypdf/>`_.
+
+The packing slip and invoice admin actions of orders and the
+``plata_documents`` management command use ``render_batch``.
+"""
+
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.utils import timezone
+from django.utils.translation import get_language, override
+
+import plata
+
+
+#: Output formats and their content types
+FORMATS = {
+    "pdf": "application/pdf",
+    "zip": "application/zip",
+}
+
+
+def document_filename(order, document_type):
+    return "%s-%09d.pdf" % (document_type, order.pk)
+
+
+def render_document(order, document_type):
+    """
+    Returns the document of the order rendered in the order's language
+
+    ``OrderReport`` activates the language of the order; the previously
+    active language is restored afterwards.
+    """
+    from plata.reporting.documents import get_document
+
+    with override(order.language_code or get_language()):
+        return get_document(order, document_type)
+
+
+def _initialize_worker():
+    import django
+
+    django.setup()
+
+
+def _render_in_worker(pk, document_type):
+    from plata.reporting.order import OrderReportData
+
+    order = (
+        plata.shop_instance()
+        .order_model._default_manager.prefetch_related(
+            *OrderReportData.prefetch_related
+        )
+        .get(pk=pk)
+    )
+    return render_document(order, document_type)
+
+
+def _pool_size(processes, count):
+    if processes is None:
+        processes = plata.settings.PLATA_REPORTING_BATCH_PROCESSES or os.cpu_count()
+    return min(processes, count)
+
+
+def render_documents(orders, document_type, processes=None):
+    """
+    Returns a list of ``(order, content)`` tuples for all orders
+
+    Documents are rendered in the calling process if ``processes`` is 1 or
+    if there is only one order. Otherwise only the primary keys of
+    ``orders`` are passed to the worker processes, which load the orders
+    themselves.
+    """
+    orders = list(orders)
+    processes = _pool_size(processes, len(orders))
+
+    if processes <= 1:
+        return [(order, render_document(order, document_type)) for order in orders]
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_worker,
+    ) as executor:
+        contents = executor.map(
+            _render_in_worker,
+            [order.pk for order in orders],
+            [document_type] * len(orders),
+            chunksize=max(1, len(orders) // (processes * 4)),
+        )
+        return list(zip(orders, contents))
+
+
+def merge_pdfs(contents):
+    """
+    Returns a PDF containing all pages of the PDFs in ``contents``
+    """
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for content in contents:
+        writer.append(io.BytesIO(content))
+    with io.BytesIO() as output:
+        writer.write(output)
+        return output.getvalue()
+
+
+def zip_documents(documents, document_type):
+    """
+    Returns a ZIP file containing the ``(order, content)`` documents
+    """
+    with io.BytesIO() as output:
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+            for order, content in documents:
+                archive.writestr(document_filename(order, document_type), content)
+        return output.getvalue()
+
+
+def render_batch(queryset, document_type, format="pdf", processes=None):
+    """
+    Renders the documents of all orders in ``queryset`` and returns a
+    ``(content, content_type, filename)`` tuple
+
+    ``format`` is either ``pdf`` (one merged PDF) or ``zip``.
+    """
+    from plata.reporting.order import OrderReportData
+
+    queryset = queryset.order_by("pk")
+    processes = _pool_size(processes, queryset.count())
+    if processes <= 1:
+        orders = queryset.prefetch_related(*OrderReportData.prefetch_related)
+    else:
+        # The worker processes load the orders and their data themselves
+        orders = queryset.only("pk")
+
+    documents = render_documents(orders, document_type, processes=processes)
+    if format == "pdf":
+        content = merge_pdfs(content for order, content in documents)
+    else:
+        content = zip_documents(documents, document_type)
+
+    filename = "{}-{}.{}".format(
+        document_type, timezone.localtime().strftime("%Y%m%d-%H%M%S"), format
+    )
+    return content, FORMATS[format], filename
@@ -0,0 +1,125 @@
+"""
+Generated document store
+========================
+
+Invoices and packing slips are generated for the e-mails sent by
+``plata.shop.notifications``, for customers downloading their invoice and
+for the staff. If ``PLATA_REPORTING_DOCUMENT_STORAGE`` is set, documents are
+written to this storage when they are generated the first time and read
+from the storage afterwards.
+
+Stored documents are keyed by the order, the document type and a
+fingerprint of everything shown in the document (the order including its
+items and authorized payments, and the reporting settings). Changing the
+order therefore invalidates its stored documents automatically; outdated
+documents are removed when the new version is stored. Call ``invalidate``
+to remove the documents of an order explicitly, f.e. when deleting it.
+
+Documents contain personal data and are never served from the storage's
+URL. Use a storage which is not publicly accessible.
+"""
+
+import contextlib
+import hashlib
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.utils.module_loading import import_string
+
+import plata
+from plata.reporting.order import invoice_pdf, packing_slip_pdf
+from plata.reporting.pdfdocument import PlataPDFDocument
+
+
+#: Document types and the functions drawing them
+DOCUMENTS = {
+    "invoice": invoice_pdf,
+    "packing-slip": packing_slip_pdf,
+}
+
+
+def document_storage():
+    """
+    Returns the storage defined by ``PLATA_REPORTING_DOCUMENT_STORAGE`` or
+    ``None`` if documents should not be stored
+    """
+    if not plata.settings.PLATA_REPORTING_DOCUMENT_STORAGE:
+        return None
+    storage = import_string(plata.settings.PLATA_REPORTING_DOCUMENT_STORAGE)
+    return storage() if isinstance(storage, type) else storage
+
+
+def fingerprint(order):
+    """
+    Returns a hash of everything which may be shown in the documents of the
+    order
+    """
+    # Use the database representation, which does not depend on whether the
+    # order has been loaded from the database or modified in memory
+    values = [
+        f.get_db_prep_save(getattr(order, f.attname), connection)
+        for f in order._meta.concrete_fields
+    ]
+    values.append(list(order.items.order_by("id").values_list()))
+    values.append(
+        list(
+            order.payments.authorized()
+            .order_by("id")
+            .values_list("payment_method", "transaction_id")
+        )
+    )
+    values.append(plata.settings.PLATA_REPORTING_ADDRESSLINE)
+    values.append(plata.settings.PLATA_REPORTING_STATIONERY)
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
+
+
+def generate_document(order, document_type):
+    """
+    Generates the document and returns its content
+    """
+    with contextlib.closing(BytesIO()) as content:
+        pdf = PlataPDFDocument(content)
+        DOCUMENTS[document_type](pdf, order)
+        return content.getvalue()
+
+
+def get_document(order, document_type):
+    """
+    Returns the content of the document, generating and storing it only if
+    no up-to-date version has been stored yet
+    """
+    storage = document_storage()
+    if storage is None:
+        return generate_document(order, document_type)
+
+    name = "plata/documents/{}/{}-{}.pdf".format(
+        order.pk, document_type, fingerprint(order)
+    )
+    if storage.exists(name):
+        with storage.open(name) as f:
+            return f.read()
+
+    content = generate_document(order, document_type)
+    invalidate(order, document_type)
+    storage.save(name, ContentFile(content))
+    return content
+
+
+def invalidate(order, document_type=None):
+    """
+    Removes the stored documents (of the given type) of the order
+    """
+    storage = document_storage()
+    if storage is None:
+        return
+
+    directory = "plata/documents/%s" % order.pk
+    try:
+        filenames = storage.listdir(directory)[1]
+    except FileNotFoundError:
+        return
+
+    for filename in filenames:
+        if document_type is None or filename.startswith("%s-" % document_type):
+            storage.delete(f"{directory}/{filename}")
@@ -0,0 +1,316 @@
+"""
+Order exports
+=============
+
+Exports orders for accounting as CSV or XLSX without loading the whole
+selection into memory. Orders are loaded in chunks together with their items
+and authorized payments; rows are written as they are generated::
+
+    from plata.reporting.export import order_csv
+
+    response = StreamingHttpResponse(
+        order_csv(Order.objects.filter(status__gte=Order.PAID)),
+        content_type='text/csv')
+
+The ``Export orders`` admin actions stream small selections directly. If
+``PLATA_REPORTING_EXPORT_STORAGE`` is set, selections of more than
+``PLATA_REPORTING_EXPORT_THRESHOLD`` orders are exported by the
+``plata_outbox_worker`` management command (see ``plata.shop.outbox``)
+instead. The file is written to the storage and can be downloaded by staff
+members using the ``plata_reporting_export`` view when it is ready.
+"""
+
+import csv
+import os
+import tempfile
+import uuid
+
+from django.core.exceptions import PermissionDenied
+from django.core.files import File
+from django.db.models import Max, Prefetch
+from django.http import FileResponse, HttpRequest, QueryDict, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.utils.text import capfirst
+from django.utils.translation import gettext as _
+from xlsxdocument import XLSXDocument
+
+import plata
+from plata.reporting.product import Echo
+from plata.shop import outbox
+
+
+#: Output formats and their content types
+FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def export_storage():
+    """
+    Returns the storage defined by ``PLATA_REPORTING_EXPORT_STORAGE`` or
+    ``None`` if orders cannot be exported in the background
+    """
+    if not plata.settings.PLATA_REPORTING_EXPORT_STORAGE:
+        return None
+    storage = import_string(plata.settings.PLATA_REPORTING_EXPORT_STORAGE)
+    return storage() if isinstance(storage, type) else storage
+
+
+def order_titles(model=None):
+    """
+    Returns the column titles of the order export
+    """
+    model = model or plata.shop_instance().order_model
+    titles = [capfirst(_("order"))]
+    titles.extend(str(capfirst(field.verbose_name)) for field in model._meta.fields)
+    titles.extend(
+        [capfirst(_("order items")), capfirst(_("payments")), capfirst(_("tax"))]
+    )
+    return titles
+
+
+def order_rows(queryset, chunk_size=500):
+    """
+    Yields a row for every order in ``queryset``
+
+    Orders are loaded in chunks of ``chunk_size`` with one query each for the
+    orders (including their users), items and authorized payments.
+    """
+    model = queryset.model
+    payments = model.payments.rel.related_model._default_manager.filter(
+        authorized__isnull=False
+    )
+    fields = model._meta.fields
+
+    for order in (
+        queryset.select_related("user")
+        .prefetch_related(
+            "items",
+            Prefetch("payments", queryset=payments, to_attr="authorized_payments"),
+        )
+        .order_by("pk")
+        .iterator(chunk_size=chunk_size)
+    ):
+        row = ["%s" % order]
+        for field in fields:
+            if field.choices:
+                row.append(getattr(order, "get_%s_display" % field.name)())
+            else:
+                row.append(getattr(order, field.name))
+
+        row.append(
+            "\n".join(
+                "{} x {}".format(
+                    item.quantity, " ".join(bit for bit in (item.sku, item.name) if bit)
+                )
+                for item in order.items.all()
+            )
+        )
+        row.append(
+            "\n".join(
+                " ".join(
+                    bit
+                    for bit in (
+                        payment.currency,
+                        "%s" % payment.amount,
+                        payment.payment_method,
+                        payment.transaction_id,
+                    )
+                    if bit
+                )
+                for payment in order.authorized_payments
+            )
+        )
+        row.append(
+            "\n".join(
+                "{}%: {}".format(details["tax_rate"], details["tax_amount"])
+                for rate, details in order.data.get("tax_details", ())
+            )
+        )
+        yield row
+
+
+def order_csv(queryset, rows=None):
+    """
+    Yields the lines of a CSV file containing the orders in ``queryset``,
+    suitable for ``StreamingHttpResponse``
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(order_titles(queryset.model))
+    for row in order_rows(queryset) if rows is None else rows:
+        yield writer.writerow(row)
+
+
+def order_xls(queryset, rows=None):
+    """
+    Returns a ``XLSXDocument`` containing the orders in ``queryset``
+
+    Rows are written to the write-only workbook as they are generated.
+    """
+    xls = XLSXDocument()
+    xls.add_sheet(capfirst(_("orders")))
+    xls.table(
+        order_titles(queryset.model), order_rows(queryset) if rows is None else rows
+    )
+    return xls
+
+
+def write_order_export(queryset, format, output, rows=None):
+    """
+    Writes the export of the orders in ``queryset`` (or of the given rows)
+    to the binary file ``output``
+    """
+    if format == "xlsx":
+        order_xls(queryset, rows).workbook.save(output)
+    else:
+        for line in order_csv(queryset, rows):
+            output.write(line.encode("utf-8"))
+
+
+def order_export_response(queryset, format):
+    """
+    Returns a response streaming the export of the orders in ``queryset``
+
+    CSV files are generated while they are sent, XLSX files are written to a
+    temporary file first.
+    """
+    filename = export_filename(format)
+    if format == "xlsx":
+        output = tempfile.TemporaryFile()
+        write_order_export(queryset, format, output)
+        output.seek(0)
+        return FileResponse(
+            output, as_attachment=True, filename=filename, content_type=FORMATS[format]
+        )
+
+    response = StreamingHttpResponse(order_csv(queryset), content_type=FORMATS[format])
+    response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def export_filename(format):
+    return "orders-{}-{}.{}".format(
+        timezone.localtime().strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8], format
+    )
+
+
+def changelist_orders(params, user):
+    """
+    Returns the orders listed in the order changelist of the administration
+    panel for ``user`` and the query string ``params`` (a dictionary of
+    lists, f.e. ``dict(request.GET.lists())``), including filters, the date
+    hierarchy and the search
+    """
+    from django.contrib import admin
+
+    model = plata.shop_instance().order_model
+    model_admin = admin.site._registry[model]
+
+    request = HttpRequest()
+    request.method = "GET"
+    request.user = user
+    request.GET = QueryDict(mutable=True)
+    for key, values in params.items():
+        request.GET.setlist(key, values)
+
+    if not model_admin.has_view_permission(request):
+        raise PermissionDenied
+    return model_admin.get_changelist_instance(request).get_queryset(request)
+
+
+def export_orders(
+    sender, last, format, filename, pks=None, params=None, user=None, **kwargs
+):
+    """
+    Outbox receiver writing the export of the orders with the primary keys
+    ``pks`` or of the orders listed in the changelist for ``params`` and
+    ``user`` (see ``changelist_orders``) up to the primary key ``last`` to the
+    export storage
+
+    The export is written to a temporary name first and only moved to
+    ``filename`` when it is complete. Nothing is done if the file exists
+    already, f.e. because a previous delivery of the message succeeded.
+    """
+    storage = export_storage()
+    name = "plata/exports/%s" % filename
+    if storage.exists(name):
+        return
+
+    if params is None:
+        queryset = plata.shop_instance().order_model._default_manager.filter(pk__in=pks)
+    else:
+        queryset = changelist_orders(params, user)
+    queryset = queryset.filter(pk__lte=last)
+
+    with tempfile.TemporaryFile() as output:
+        write_order_export(queryset, format, output)
+        output.seek(0)
+        partial = storage.save(
+            "plata/exports/.%s.%s.part" % (filename, uuid.uuid4().hex),
+            File(output),
+        )
+    _move(storage, partial, name)
+
+
+def _move(storage, source, name):
+    try:
+        # Atomic if the storage is backed by the local filesystem
+        os.replace(storage.path(source), storage.path(name))
+    except NotImplementedError:
+        with storage.open(source) as f:
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, f)
+        storage.delete(source)
+
+
+#: Exporting hundreds of thousands of orders takes longer than the default
+#: lease of outbox messages. The job must not be delivered to a second worker
+#: in the meantime.
+EXPORT_LEASE = 6 * 3600
+
+export_job = outbox.deferred("plata-order-export", export_orders, lease=EXPORT_LEASE)
+
+
+def start_order_export(queryset, format, params=None, user=None):
+    """
+    Stores a job exporting the orders in ``queryset`` in the background and
+    returns the name of the file which will be available using
+    ``open_order_export``
+
+    The job stores the primary keys of the orders in ``queryset``, which is
+    fine for a page of orders selected in the changelist. Pass the query
+    string ``params`` of the changelist and the ``user`` instead when all
+    orders matching the changelist's filters have been selected; the
+    worker lists the orders again using ``changelist_orders``. Orders added
+    later are not exported.
+    """
+    filename = export_filename(format)
+    kwargs = {"last": queryset.aggregate(last=Max("pk"))["last"] or 0}
+    if params is None:
+        kwargs["pks"] = list(queryset.order_by("pk").values_list("pk", flat=True))
+    else:
+        kwargs.update(params=params, user=user)
+
+    export_job(
+        signal=None,
+        sender=None,
+        format=format,
+        filename=filename,
+        **kwargs,
+    )
+    return filename
+
+
+def open_order_export(filename):
+    """
+    Returns the export file opened for reading or ``None`` if it does not
+    exist (yet)
+    """
+    storage = export_storage()
+    name = "plata/exports/%s" % filename
+    if storage is None or not storage.exists(name):
+        return None
+    return storage.open(name)
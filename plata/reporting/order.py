@@ -9,10 +9,37 @@ from pdfdocument.elements import create_stationery_fn
 import plata
 
 
+class OrderReportData:
+    """
+    The items and payments of an order, loaded once for all sections of an
+    ``OrderReport``
+
+    Uses the prefetched objects if the order has been loaded with
+    ``prefetch_related(*OrderReportData.prefetch_related)``, so reports of
+    many orders need no additional queries at all.
+    """
+
+    prefetch_related = ("items", "payments")
+
+    def __init__(self, order):
+        self.order = order
+        self.items = list(order.items.all())
+        self.payments = list(order.payments.all())
+        self.authorized_payments = [p for p in self.payments if p.authorized]
+
+        zero = Decimal("0.00")
+        subtotal = sum((item.subtotal for item in self.items), zero)
+        discounted = sum((item.discounted_subtotal for item in self.items), zero)
+        #: Same as ``Order.subtotal`` and ``Order.discount``
+        self.subtotal = subtotal.quantize(zero)
+        self.discount = (subtotal - discounted).quantize(zero)
+
+
 class OrderReport:
     def __init__(self, pdf, order):
         self.pdf = pdf
         self.order = order
+        self.data = OrderReportData(order)
 
         if order.language_code:
             activate(order.language_code)
@@ -54,7 +81,7 @@ class OrderReport:
     def items_without_prices(self):
         self.pdf.table(
             [(_("SKU"), capfirst(_("product")), capfirst(_("quantity")))]
-            + [(item.sku, item.name, item.quantity) for item in self.order.items.all()],
+            + [(item.sku, item.name, item.quantity) for item in self.data.items],
             (2 * cm, 13.4 * cm, 1 * cm),
             self.pdf.style.tableHead + (("ALIGN", (1, 0), (1, -1), "LEFT"),),
         )
@@ -78,7 +105,7 @@ class OrderReport:
                     "%.2f" % item.unit_price,
                     "%.2f" % item.discounted_subtotal,
                 )
-                for item in self.order.items.all()
+                for item in self.data.items
             ],
             (2 * cm, 6 * cm, 1 * cm, 3 * cm, 4.4 * cm),
             self.pdf.style.tableHead + (("ALIGN", (1, 0), (1, -1), "LEFT"),),
@@ -87,13 +114,11 @@ class OrderReport:
     def summary(self):
         summary_table = [
             ("", ""),
-            (capfirst(_("subtotal")), "%.2f" % self.order.subtotal),
+            (capfirst(_("subtotal")), "%.2f" % self.data.subtotal),
         ]
 
-        if self.order.discount:
-            summary_table.append(
-                (capfirst(_("discount")), "%.2f" % self.order.discount)
-            )
+        if self.data.discount:
+            summary_table.append((capfirst(_("discount")), "%.2f" % self.data.discount))
 
         if self.order.shipping:
             summary_table.append(
@@ -136,7 +161,7 @@ class OrderReport:
     def payment(self):
         if not self.order.balance_remaining:
             try:
-                payment = self.order.payments.authorized()[0]
+                payment = self.data.authorized_payments[0]
             except IndexError:
                 payment = None
 
@@ -1,3 +1,5 @@
+import threading
+
 from pdfdocument.document import PDFDocument
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
@@ -5,10 +7,31 @@ from reportlab.pdfbase.ttfonts import TTFont
 import plata
 
 
+#: ``(name, path)`` of the fonts registered by ``register_font``
+_registered_fonts = set()
+_registered_fonts_lock = threading.Lock()
+
+
+def register_font(name, path):
+    """
+    Registers the TrueType font at ``path`` under ``name`` with reportlab
+
+    Parsing a TTF file is expensive, fonts are therefore only parsed and
+    registered once per process. Safe to call from several threads.
+    """
+    if (name, path) in _registered_fonts:
+        return
+
+    with _registered_fonts_lock:
+        if (name, path) not in _registered_fonts:
+            pdfmetrics.registerFont(TTFont(name, path))
+            _registered_fonts.add((name, path))
+
+
 def init_regular_font(suffix=""):
     name = f"{plata.settings.PLATA_PDF_FONT_NAME}{suffix}"
     path = plata.settings.PLATA_PDF_FONT_PATH or "%s.ttf" % name
-    pdfmetrics.registerFont(TTFont(name, path))
+    register_font(name, path)
 
 
 class PlataPDFDocument(PDFDocument):
@@ -22,7 +45,7 @@ class PlataPDFDocument(PDFDocument):
             # init bold font variant
             name = plata.settings.PLATA_PDF_FONT_BOLD_NAME
             path = plata.settings.PLATA_PDF_FONT_BOLD_PATH or "%s.ttf" % name
-            pdfmetrics.registerFont(TTFont(name, path))
+            register_font(name, path)
         elif plata.settings.PLATA_PDF_FONT_NAME:
             # init bold font variant from regular font, bold is always needed
             init_regular_font(suffix="-Bold")
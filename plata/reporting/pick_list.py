@@ -0,0 +1,116 @@
+"""
+Pick lists
+==========
+
+A pick list contains the total quantity of every SKU ordered in many orders,
+f.e. in all orders paid today, so that the warehouse staff can collect the
+products of a whole batch of orders in one walk through the warehouse before
+packing the orders using their packing slips.
+
+The quantities are summed up by the database in a single grouped query over
+order items. Rows are sorted by SKU by default; pass ``ordering`` to sort by
+a storage location of the product instead, f.e.
+``ordering=('product__location', 'sku')``.
+"""
+
+from datetime import datetime, time
+
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+from django.utils.text import capfirst
+from django.utils.translation import gettext as _
+from pdfdocument.document import cm
+from xlsxdocument import XLSXDocument
+
+import plata
+
+
+def pick_list(status=None, date_from=None, date_to=None, ordering=("sku",)):
+    """
+    Returns a list of dictionaries with ``sku``, ``product`` (the product
+    ID), ``name``, ``quantity`` and ``orders`` (the number of orders
+    containing the SKU) keys
+
+    ``status`` is an order status or a list of order statuses, ``date_from``
+    and ``date_to`` limit the date the orders have been confirmed (both
+    inclusive).
+    """
+    shop = plata.shop_instance()
+    items = shop.orderitem_model._default_manager.filter(quantity__gt=0)
+
+    if status is not None:
+        if isinstance(status, int):
+            status = [status]
+        items = items.filter(order__status__in=status)
+    if date_from:
+        items = items.filter(
+            order__confirmed__gte=timezone.make_aware(
+                datetime.combine(date_from, time.min)
+            )
+        )
+    if date_to:
+        items = items.filter(
+            order__confirmed__lte=timezone.make_aware(
+                datetime.combine(date_to, time.max)
+            )
+        )
+
+    return list(
+        items.values("sku", "product")
+        .annotate(
+            name=Min("name"),
+            quantity=Sum("quantity"),
+            orders=Count("order", distinct=True),
+        )
+        .order_by(*ordering)
+    )
+
+
+def pick_list_pdf(pdf, rows, title=None):
+    """PDF pick list for the rows returned by ``pick_list``"""
+
+    pdf.init_report()
+    pdf.h1(title or capfirst(_("pick list")))
+    pdf.hr()
+    pdf.table(
+        [
+            (
+                _("SKU"),
+                capfirst(_("product")),
+                capfirst(_("quantity")),
+                capfirst(_("orders")),
+                "",
+            )
+        ]
+        + [
+            (row["sku"], row["name"], row["quantity"], row["orders"], "[   ]")
+            for row in rows
+        ],
+        (3 * cm, 9.4 * cm, 1.6 * cm, 1.4 * cm, 1 * cm),
+        pdf.style.tableHead + (("ALIGN", (1, 0), (1, -1), "LEFT"),),
+    )
+    pdf.spacer()
+    pdf.p(
+        "{}: {}".format(
+            capfirst(_("total quantity")), sum(row["quantity"] for row in rows)
+        )
+    )
+
+    pdf.generate()
+
+
+def pick_list_xls(rows):
+    """XLSX pick list for the rows returned by ``pick_list``"""
+
+    xls = XLSXDocument()
+    xls.add_sheet(capfirst(_("pick list")))
+    xls.table(
+        [
+            _("SKU"),
+            capfirst(_("product")),
+            capfirst(_("quantity")),
+            capfirst(_("orders")),
+        ],
+        [(row["sku"], row["name"], row["quantity"], row["orders"]) for row in rows],
+    )
+    return xls
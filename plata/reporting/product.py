@@ -1,4 +1,6 @@
+import csv
 from collections import defaultdict
+from itertools import islice
 
 from django.db.models import Sum
 from django.utils.text import capfirst
@@ -8,46 +10,99 @@ from xlsxdocument import XLSXDocument
 import plata
 
 
-def product_xls():
+class Echo:
     """
-    Create a list of all product variations, including stock and aggregated
-    stock transactions (by type)
+    File-like object returning the written value instead of buffering it,
+    used for streaming CSV files
     """
 
-    from plata.product.stock.models import Period
+    def write(self, value):
+        return value
+
 
+def product_titles():
+    """
+    Returns the column titles of the product reports
+    """
     StockTransaction = plata.stock_model()
 
-    xls = XLSXDocument()
-    xls.add_sheet(capfirst(_("products")))
+    titles = [capfirst(_("product")), _("SKU"), capfirst(_("stock"))]
+    titles.extend("%s" % row[1] for row in StockTransaction.TYPE_CHOICES)
+    return titles
 
-    _transactions = (
-        StockTransaction.objects.filter(period=Period.objects.current())
-        .order_by()
-        .values("product", "type")
-        .annotate(Sum("change"))
+
+def product_rows(period=None, chunk_size=2000):
+    """
+    Yields a row for every product variation, including stock and aggregated
+    stock transactions (by type) of the given (or the current) period
+
+    Products are loaded in chunks of ``chunk_size`` and the stock
+    transactions are aggregated per chunk, so memory usage does not depend
+    on the size of the catalog.
+    """
+
+    from plata.product.stock.models import Period
+
+    StockTransaction = plata.stock_model()
+    period = period or Period.objects.current()
+
+    products = (
+        plata.product_model()
+        .objects.all()
+        .select_related()
+        .order_by("pk")
+        .iterator(chunk_size=chunk_size)
     )
+    while True:
+        chunk = list(islice(products, chunk_size))
+        if not chunk:
+            break
 
-    transactions = defaultdict(dict)
-    for t in _transactions:
-        transactions[t["product"]][t["type"]] = t["change__sum"]
+        transactions = defaultdict(dict)
+        for t in (
+            StockTransaction.objects.filter(
+                period=period, product__in=[product.pk for product in chunk]
+            )
+            .order_by()
+            .values("product", "type")
+            .annotate(Sum("change"))
+        ):
+            transactions[t["product"]][t["type"]] = t["change__sum"]
 
-    titles = [capfirst(_("product")), _("SKU"), capfirst(_("stock"))]
-    titles.extend("%s" % row[1] for row in StockTransaction.TYPE_CHOICES)
+        for product in chunk:
+            row = [
+                product,
+                getattr(product, "sku", ""),
+                getattr(product, "items_in_stock", -1),
+            ]
+            row.extend(
+                transactions[product.id].get(key, "")
+                for key, name in StockTransaction.TYPE_CHOICES
+            )
+            yield row
+
+
+def product_xls(period=None):
+    """
+    Create a list of all product variations, including stock and aggregated
+    stock transactions (by type) of the given (or the current) period
+
+    Rows are written to the write-only workbook as they are generated.
+    """
 
-    data = []
-
-    for product in plata.product_model().objects.all().select_related():
-        row = [
-            product,
-            getattr(product, "sku", ""),
-            getattr(product, "items_in_stock", -1),
-        ]
-        row.extend(
-            transactions[product.id].get(key, "")
-            for key, name in StockTransaction.TYPE_CHOICES
-        )
-        data.append(row)
-
-    xls.table(titles, data)
+    xls = XLSXDocument()
+    xls.add_sheet(capfirst(_("products")))
+    xls.table(product_titles(), product_rows(period))
     return xls
+
+
+def product_csv(period=None):
+    """
+    Yields the lines of a CSV file containing the same columns as
+    ``product_xls``, suitable for ``StreamingHttpResponse``
+    """
+
+    writer = csv.writer(Echo())
+    yield writer.writerow(product_titles())
+    for row in product_rows(period):
+        yield writer.writerow(row)
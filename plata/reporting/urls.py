@@ -5,6 +5,19 @@ from plata.reporting import views
 
 urlpatterns = [
     path("product_xls/", views.product_xls, name="plata_reporting_product_xls"),
+    path("product_csv/", views.product_csv, name="plata_reporting_product_csv"),
+    path(
+        "exports/<str:filename>/",
+        views.order_export,
+        name="plata_reporting_export",
+    ),
+    path("pick_list_pdf/", views.pick_list, name="plata_reporting_pick_list_pdf"),
+    path(
+        "pick_list_xls/",
+        views.pick_list,
+        {"format": "xlsx"},
+        name="plata_reporting_pick_list_xls",
+    ),
     path(
         "invoice_pdf/<int:order_id>/",
         views.invoice_pdf,
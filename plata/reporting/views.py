@@ -1,38 +1,116 @@
+import tempfile
+
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import Http404
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_date
 from pdfdocument.utils import pdf_response
 
-import plata.reporting.order
-
 # import plata
+import plata.reporting.export
+import plata.reporting.pick_list
 import plata.reporting.product
+from plata.reporting.documents import get_document
 from plata.reporting.pdfdocument import PlataPDFDocument
 
 
+def document_response(order, document_type, filename):
+    response = HttpResponse(
+        get_document(order, document_type), content_type="application/pdf"
+    )
+    response["Content-Disposition"] = 'attachment; filename="%s.pdf"' % filename
+    return response
+
+
 @staff_member_required
 def product_xls(request):
     """
     Returns an XLS containing product information
+
+    The workbook is written to a temporary file instead of memory.
     """
-    return plata.reporting.product.product_xls().to_response("products.xlsx")
+    output = tempfile.TemporaryFile()
+    plata.reporting.product.product_xls().workbook.save(output)
+    output.seek(0)
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename="products.xlsx",
+        content_type=(
+            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        ),
+    )
 
 
 @staff_member_required
-def invoice_pdf(request, order_id):
+def product_csv(request):
     """
-    Returns the invoice PDF
+    Streams a CSV containing product information
     """
-    order = get_object_or_404(plata.shop_instance().order_model, pk=order_id)
+    response = StreamingHttpResponse(
+        plata.reporting.product.product_csv(), content_type="text/csv"
+    )
+    response["Content-Disposition"] = 'attachment; filename="products.csv"'
+    return response
+
+
+@staff_member_required
+def pick_list(request, format="pdf"):
+    """
+    Returns the pick list of the orders filtered by the ``status``, ``from``
+    and ``to`` query parameters as PDF or XLSX
+    """
+    try:
+        status = [int(value) for value in request.GET.getlist("status")]
+        dates = {}
+        for key in ("from", "to"):
+            value = request.GET.get(key)
+            dates[key] = parse_date(value) if value else None
+            if value and not dates[key]:
+                raise ValueError("Invalid date %r" % value)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid filter")
 
-    pdf, response = pdf_response(
-        "invoice-%09d" % order.id, pdfdocument=PlataPDFDocument
+    rows = plata.reporting.pick_list.pick_list(
+        status=status or None, date_from=dates["from"], date_to=dates["to"]
     )
-    plata.reporting.order.invoice_pdf(pdf, order)
+    if format == "xlsx":
+        return plata.reporting.pick_list.pick_list_xls(rows).to_response(
+            "pick-list.xlsx"
+        )
+
+    pdf, response = pdf_response("pick-list", pdfdocument=PlataPDFDocument)
+    plata.reporting.pick_list.pick_list_pdf(pdf, rows)
     return response
 
 
+@staff_member_required
+def order_export(request, filename):
+    """
+    Returns an order export generated in the background
+    """
+    output = plata.reporting.export.open_order_export(filename)
+    if output is None:
+        raise Http404
+    return FileResponse(output, as_attachment=True, filename=filename)
+
+
+@staff_member_required
+def invoice_pdf(request, order_id):
+    """
+    Returns the invoice PDF
+    """
+    order = get_object_or_404(plata.shop_instance().order_model, pk=order_id)
+    return document_response(order, "invoice", "invoice-%09d" % order.id)
+
+
 @login_required
 def invoice(request, order_id):
     """
@@ -41,9 +119,7 @@ def invoice(request, order_id):
     order = get_object_or_404(plata.shop_instance().order_model, pk=order_id)
 
     if order in request.user.orders.all():
-        pdf, response = pdf_response("invoice-%09d" % order.id)
-        plata.reporting.order.invoice_pdf(pdf, order)
-        return response
+        return document_response(order, "invoice", "invoice-%09d" % order.id)
     else:
         raise Http404
 
@@ -54,9 +130,4 @@ def packing_slip_pdf(request, order_id):
     Returns the packing slip PDF
     """
     order = get_object_or_404(plata.shop_instance().order_model, pk=order_id)
-
-    pdf, response = pdf_response(
-        "packing-slip-%09d" % order.id, pdfdocument=PlataPDFDocument
-    )
-    plata.reporting.order.packing_slip_pdf(pdf, order)
-    return response
+    return document_response(order, "packing-slip", "packing-slip-%09d" % order.id)
@@ -1,9 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.http import HttpResponse
 from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
-from xlsxdocument import export_selected
 
+import plata
 from plata.discount.models import AppliedDiscount
+from plata.reporting.batch import render_batch
+from plata.reporting.export import (
+    export_storage,
+    order_export_response,
+    start_order_export,
+)
 from plata.shop import models
 
 
@@ -23,6 +32,75 @@ class OrderStatusInline(admin.TabularInline):
     extra = 0
 
 
+def document_batch_action(document_type, format, description):
+    """
+    Returns an admin action downloading the documents of the selected
+    orders, see ``plata.reporting.batch``
+    """
+
+    @admin.action(description=description)
+    def action(modeladmin, request, queryset):
+        try:
+            content, content_type, filename = render_batch(
+                queryset, document_type, format
+            )
+        except ImportError:
+            modeladmin.message_user(
+                request, _("Merging PDFs requires pypdf."), messages.ERROR
+            )
+            return
+
+        response = HttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+        return response
+
+    action.__name__ = "{}_{}".format(document_type.replace("-", "_"), format)
+    return action
+
+
+def export_orders_action(format, description):
+    """
+    Returns an admin action exporting the selected orders, in the background
+    if the selection is large, see ``plata.reporting.export``
+    """
+
+    @admin.action(description=description)
+    def action(modeladmin, request, queryset):
+        if (
+            export_storage() is None
+            or queryset.count() <= plata.settings.PLATA_REPORTING_EXPORT_THRESHOLD
+        ):
+            return order_export_response(queryset, format)
+
+        if request.POST.get("select_across") == "1":
+            # All orders matching the changelist's filters have been
+            # selected. Do not store all their primary keys, the worker lists
+            # them again.
+            filename = start_order_export(
+                queryset, format, params=dict(request.GET.lists()), user=request.user
+            )
+        else:
+            filename = start_order_export(queryset, format)
+
+        try:
+            url = reverse("plata_reporting_export", kwargs={"filename": filename})
+        except NoReverseMatch:
+            message = _("The orders are being exported to %(filename)s.") % {
+                "filename": filename
+            }
+        else:
+            message = format_html(
+                '{} <a href="{}">{}</a>',
+                _("The orders are being exported in the background."),
+                url,
+                _("Download the export when it is ready."),
+            )
+        modeladmin.message_user(request, message)
+
+    action.__name__ = "export_orders_%s" % format
+    return action
+
+
 class OrderAdmin(admin.ModelAdmin):
     date_hierarchy = "created"
     fieldsets = (
@@ -118,7 +196,14 @@ class OrderAdmin(admin.ModelAdmin):
 
         return ", ".join(bits)
 
-    actions = [export_selected]
+    actions = [
+        export_orders_action("csv", _("Export orders (CSV)")),
+        export_orders_action("xlsx", _("Export orders (XLSX)")),
+        document_batch_action("packing-slip", "pdf", _("Packing slips (PDF)")),
+        document_batch_action("packing-slip", "zip", _("Packing slips (ZIP)")),
+        document_batch_action("invoice", "pdf", _("Invoices (PDF)")),
+        document_batch_action("invoice", "zip", _("Invoices (ZIP)")),
+    ]
 
 
 class OrderPaymentAdmin(admin.ModelAdmin):
@@ -152,6 +237,44 @@ class OrderPaymentAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Order, OrderAdmin)
 admin.site.register(models.OrderPayment, OrderPaymentAdmin)
+admin.site.register(
+    models.PaymentNotification,
+    date_hierarchy="created",
+    list_display=("created", "payment_module_key", "transaction_id", "status", "order"),
+    list_filter=("payment_module_key",),
+    raw_id_fields=("order",),
+    search_fields=("transaction_id",),
+)
+
+
+@admin.action(description=_("Retry delivery"))
+def requeue_messages(modeladmin, request, queryset):
+    model = queryset.model
+    queryset.filter(status__in=(model.PENDING, model.FAILED)).update(
+        status=model.PENDING,
+        attempts=0,
+        next_attempt=timezone.now(),
+    )
+
+
+admin.site.register(
+    models.OutboxMessage,
+    actions=[requeue_messages],
+    date_hierarchy="created",
+    list_display=("created", "receiver", "status", "attempts", "next_attempt"),
+    list_filter=("status", "receiver"),
+    readonly_fields=("kwargs", "delivered", "last_error"),
+)
+admin.site.register(
+    models.QueuedEmail,
+    actions=[requeue_messages],
+    date_hierarchy="created",
+    exclude=("message",),
+    list_display=("created", "subject", "status", "attempts", "next_attempt"),
+    list_filter=("status",),
+    readonly_fields=("sent", "last_error"),
+    search_fields=("subject", "recipients"),
+)
 admin.site.register(
     models.TaxClass,
     list_display=("name", "rate", "priority"),
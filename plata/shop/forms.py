@@ -170,7 +170,10 @@ class ConfirmationForm(forms.Form):
             self.cleaned_data["payment_method"]
         ]
 
-        return module.process_order_confirmed(self.request, self.order)
+        try:
+            return module.process_order_confirmed(self.request, self.order)
+        except forms.ValidationError as exc:
+            return self.shop.order_reservation_failure(self.request, self.order, exc)
 
 
 class OrderItemForm(forms.Form):
@@ -225,7 +228,10 @@ class PaymentSelectMixin:
 
     def payment_order_confirmed(self, order, payment_method):
         module = {m.key: m for m in self.payment_modules}[payment_method]
-        return module.process_order_confirmed(self.request, order)
+        try:
+            return module.process_order_confirmed(self.request, order)
+        except forms.ValidationError as exc:
+            return self.shop.order_reservation_failure(self.request, order, exc)
 
 
 class PaymentSelectForm(forms.Form, PaymentSelectMixin):
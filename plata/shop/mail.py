@@ -0,0 +1,210 @@
+"""
+Sending e-mail
+==============
+
+The e-mail handlers in ``plata.shop.notifications`` and the prepay and
+check payment modules send their messages using ``send_messages``:
+
+- By default messages are delivered immediately. Messages sent inside a
+  ``batch()`` block are collected and delivered over one connection when
+  the block is left. The receivers of ``order_paid`` are called inside such
+  a block, so the messages of all notifications sent when an order has been
+  paid share a connection. Outside of ``batch()`` blocks every
+  ``send_messages`` call opens its own connection. Messages which could not
+  be delivered are stored as ``QueuedEmail`` and retried by the
+  ``plata_send_mail`` management command instead of being dropped silently.
+- If ``PLATA_EMAIL_QUEUE`` is ``True`` all messages are stored, and the
+  ``plata_send_mail`` management command delivers them in batches over one
+  connection. Run the command periodically (f.e. every minute) or pass
+  ``--poll`` to keep it running. This avoids opening one SMTP connection per
+  message in the request threads during order peaks.
+
+Failed deliveries are retried with the same backoff as outbox messages
+(``PLATA_OUTBOX_RETRY_DELAY`` and ``PLATA_OUTBOX_MAX_ATTEMPTS``, see
+``plata.shop.outbox``) and can be requeued in the administration panel.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+import plata
+from plata.shop.outbox import claim, schedule_retry
+
+
+logger = logging.getLogger("plata.shop.mail")
+
+_batch = threading.local()
+
+
+class RawMessage:
+    """
+    Stored MIME message which can be passed to e-mail backends
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def as_bytes(self, linesep="\n"):
+        return self.raw.replace(b"\r\n", b"\n").replace(b"\n", linesep.encode())
+
+    def get_charset(self):
+        return None
+
+
+class StoredEmailMessage(EmailMessage):
+    """
+    ``EmailMessage`` sending a ``QueuedEmail`` unchanged
+    """
+
+    def __init__(self, email):
+        super().__init__(
+            subject=email.subject,
+            from_email=email.from_email,
+            to=email.recipients.splitlines(),
+        )
+        self.email = email
+
+    def message(self):
+        return RawMessage(bytes(self.email.message))
+
+
+def queued_email(message):
+    """
+    Returns an unsaved ``QueuedEmail`` for an ``EmailMessage``
+    """
+    from plata.shop.models import QueuedEmail
+
+    return QueuedEmail(
+        subject=message.subject[:200],
+        from_email=message.from_email,
+        recipients="\n".join(message.recipients()),
+        message=message.message().as_bytes(),
+    )
+
+
+@contextmanager
+def batch():
+    """
+    Collect the messages passed to ``send_messages`` and send them over one
+    connection when leaving the block::
+
+        with batch():
+            signals.order_paid.send(sender=..., order=order, ...)
+
+    Messages sent with ``fail_silently=False`` are not collected, their
+    delivery errors are raised right away. Nested blocks are part of the
+    outermost block.
+    """
+    if hasattr(_batch, "messages"):
+        yield
+        return
+
+    _batch.messages = []
+    try:
+        yield
+    finally:
+        messages = _batch.messages
+        del _batch.messages
+        send_messages(messages)
+
+
+def send_messages(messages, fail_silently=True):
+    """
+    Send or queue e-mail messages and return the number of messages sent
+
+    Messages which cannot be delivered are queued for retrying. Pass
+    ``fail_silently=False`` to raise delivery errors instead (f.e. in
+    receivers retried by the outbox worker). Inside ``batch()`` blocks
+    messages are only collected and ``0`` is returned.
+    """
+    from plata.shop.models import QueuedEmail
+
+    messages = list(messages)
+    if fail_silently and hasattr(_batch, "messages"):
+        _batch.messages.extend(messages)
+        return 0
+
+    if not messages:
+        return 0
+
+    if plata.settings.PLATA_EMAIL_QUEUE:
+        QueuedEmail.objects.bulk_create([queued_email(m) for m in messages])
+        return 0
+
+    if not fail_silently:
+        with get_connection() as connection:
+            return connection.send_messages(messages) or 0
+
+    connection = get_connection()
+    sent = 0
+    try:
+        for message in messages:
+            try:
+                connection.open()
+                connection.send_messages([message])
+            except Exception:
+                logger.exception("Sending %r failed, queueing it" % message.subject)
+                # Start over with a new connection for the next message
+                connection.close()
+                try:
+                    # Rendering the message again may fail the same way
+                    email = queued_email(message)
+                    email.attempts = 1
+                    schedule_retry(email)
+                    email.save()
+                except Exception:
+                    logger.exception("Queueing %r failed" % message.subject)
+            else:
+                sent += 1
+    finally:
+        connection.close()
+    return sent
+
+
+def deliver_queued(batch_size=100, lease=300, max_attempts=None, retry_delay=None):
+    """
+    Deliver all due ``QueuedEmail`` messages over one connection and return
+    the number of sent and of failed messages
+
+    Messages are claimed in batches of ``batch_size`` and are not sent by
+    other workers for ``lease`` seconds.
+    """
+    from plata.shop.models import QueuedEmail
+
+    connection = get_connection()
+    sent = failed = 0
+    try:
+        while True:
+            emails = claim(batch_size, lease, model=QueuedEmail)
+            if not emails:
+                break
+
+            for email in emails:
+                email.attempts += 1
+                try:
+                    connection.open()
+                    connection.send_messages([StoredEmailMessage(email)])
+                except Exception:
+                    logger.exception("Sending queued e-mail %s failed" % email.pk)
+                    connection.close()
+                    schedule_retry(
+                        email, max_attempts=max_attempts, retry_delay=retry_delay
+                    )
+                    failed += 1
+                else:
+                    email.status = QueuedEmail.SENT
+                    email.sent = timezone.now()
+                    email.last_error = ""
+                    sent += 1
+
+            QueuedEmail.objects.bulk_update(
+                emails, ["attempts", "status", "next_attempt", "sent", "last_error"]
+            )
+    finally:
+        connection.close()
+
+    return sent, failed
@@ -0,0 +1,75 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+import plata
+from plata.reporting.batch import FORMATS, render_batch
+from plata.reporting.documents import DOCUMENTS
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the invoices or packing slips of many orders to one merged PDF"
+        " or to a ZIP file, f.e. the packing slips of all orders paid today."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("document_type", choices=sorted(DOCUMENTS))
+        parser.add_argument("output", help="Path of the file written.")
+        parser.add_argument(
+            "--format",
+            choices=sorted(FORMATS),
+            default="pdf",
+            help="One merged PDF or a ZIP file containing a PDF per order.",
+        )
+        parser.add_argument(
+            "--order",
+            type=int,
+            nargs="+",
+            metavar="ID",
+            help="Only the orders with these IDs.",
+        )
+        parser.add_argument(
+            "--status",
+            type=int,
+            help="Only orders with this status (f.e. 40 for paid orders).",
+        )
+        parser.add_argument(
+            "--date",
+            type=datetime.date.fromisoformat,
+            metavar="YYYY-MM-DD",
+            help="Only orders which reached --status on this date.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            help="Number of worker processes (PLATA_REPORTING_BATCH_PROCESSES).",
+        )
+
+    def handle(self, **options):
+        queryset = plata.shop_instance().order_model._default_manager.all()
+        if options["order"]:
+            queryset = queryset.filter(pk__in=options["order"])
+        if options["status"] is not None:
+            queryset = queryset.filter(status=options["status"])
+        if options["date"]:
+            if options["status"] is None:
+                raise CommandError("--date requires --status.")
+            queryset = queryset.filter(
+                statuses__status=options["status"],
+                statuses__created__date=options["date"],
+            ).distinct()
+
+        count = queryset.count()
+        if not count:
+            raise CommandError("No orders selected.")
+
+        content, content_type, filename = render_batch(
+            queryset,
+            options["document_type"],
+            options["format"],
+            processes=options["processes"],
+        )
+        with open(options["output"], "wb") as f:
+            f.write(content)
+        self.stdout.write("Wrote %s documents to %s." % (count, options["output"]))
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+# Register the receivers of the jobs stored by plata itself
+import plata.reporting.export  # noqa: F401
+from plata.shop.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Delivers the messages stored for deferred signal receivers. Run this"
+        " periodically or pass --poll to keep running."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=4,
+            help="Number of messages delivered concurrently.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of messages claimed at once.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=int,
+            default=300,
+            help="Seconds claimed messages are hidden from other workers.",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            metavar="SECONDS",
+            help="Keep running and look for new messages every SECONDS.",
+        )
+
+    def handle(self, **options):
+        while True:
+            delivered, failed = process_outbox(
+                threads=options["threads"],
+                batch_size=options["batch_size"],
+                lease=options["lease"],
+            )
+            if delivered or failed or not options["poll"]:
+                self.stdout.write(
+                    "Delivered %s messages, %s deliveries failed." % (delivered, failed)
+                )
+            if not options["poll"]:
+                break
+            time.sleep(options["poll"])
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from plata.shop.mail import deliver_queued
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends queued e-mail messages over one connection and retries failed"
+        " messages. Run this periodically or pass --poll to keep running."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of messages claimed at once.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=int,
+            default=300,
+            help="Seconds claimed messages are hidden from other workers.",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            metavar="SECONDS",
+            help="Keep running and look for new messages every SECONDS.",
+        )
+
+    def handle(self, **options):
+        while True:
+            sent, failed = deliver_queued(
+                batch_size=options["batch_size"], lease=options["lease"]
+            )
+            if sent or failed or not options["poll"]:
+                self.stdout.write("Sent %s messages, %s failed." % (sent, failed))
+            if not options["poll"]:
+                break
+            time.sleep(options["poll"])
@@ -4,8 +4,8 @@ from decimal import Decimal
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import F, ObjectDoesNotExist, Sum
+from django.db import models, transaction
+from django.db.models import Case, F, ObjectDoesNotExist, Sum, Value, When
 from django.urls.utils import get_callable
 from django.utils import timezone
 from django.utils.translation import gettext, gettext_lazy as _
@@ -517,6 +517,25 @@ class Order(BillingShippingAddress):
         instance = OrderStatus(order=self, status=status, notes=notes)
         instance.save()
 
+    def recalculate_paid(self, save=True):
+        """
+        Recalculates ``paid`` from all authorized payments in the currency of
+        the order
+
+        ``paid`` is maintained incrementally when payments are saved or
+        deleted; use this method to repair it.
+        """
+        self.paid = (
+            self.payments.authorized()
+            .filter(currency=self.currency)
+            .aggregate(total=Sum("amount"))["total"]
+            or 0
+        )
+        if save:
+            Order.objects.filter(pk=self.pk).update(paid=self.paid)
+
+    recalculate_paid.alters_data = True
+
     def reload(self):
         """
         Return this order instance, reloaded from the database
@@ -776,6 +795,19 @@ class OrderPayment(models.Model):
         help_text=_("Point in time when payment has been authorized."),
     )
 
+    token = models.CharField(
+        _("token"),
+        max_length=50,
+        unique=True,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=_(
+            "Secret used by payment modules to look up this payment, f.e. in"
+            " confirmation links."
+        ),
+    )
+
     notes = models.TextField(_("notes"), blank=True)
 
     data = JSONField(
@@ -809,21 +841,93 @@ class OrderPayment(models.Model):
             "order": self.order,
         }
 
-    def _recalculate_paid(self):
-        paid = (
-            OrderPayment.objects.authorized()
-            .filter(order=self.order_id, currency=F("order__currency"))
-            .aggregate(total=Sum("amount"))["total"]
-            or 0
+    def paid_entry(self):
+        """
+        Returns the ``(order_id, currency, amount)`` tuple this payment
+        contributes to ``Order.paid`` (if the currencies match), or ``None``
+        if the payment has not been authorized
+        """
+        if self.authorized is None:
+            return None
+        return (self.order_id, self.currency, self.amount)
+
+    def _saved_paid_entry(self):
+        """
+        Returns the ``paid_entry`` of the saved row, locking it until the end
+        of the transaction
+
+        Reading the previous state under the lock instead of remembering it
+        when the instance is loaded ensures that two instances of the same
+        payment saved one after the other do not both apply their
+        difference.
+        """
+        row = (
+            OrderPayment._default_manager.select_for_update()
+            .filter(pk=self.pk)
+            .order_by()
+            .values_list("order", "currency", "amount", "authorized")
+            .first()
         )
+        if row is None or row[3] is None:
+            return None
+        return row[:3]
 
-        Order.objects.filter(id=self.order_id).update(paid=paid)
+    def _update_paid(self, entry, previous):
+        """
+        Apply the difference between the previous and the current
+        contribution to ``Order.paid`` using an atomic ``F()`` update
+        instead of aggregating all payments of the order
+
+        Updates ``paid`` of the cached order instance (if any) so that its
+        ``balance_remaining`` is up to date without reloading it. Returns
+        the currency of the order, or ``None`` if nothing changed.
+        """
+
+        if entry == previous:
+            return None
+
+        changes = []
+        if previous:
+            changes.append((previous, -1))
+        if entry:
+            changes.append((entry, 1))
+
+        order_id = self.order_id
+        for (changed_order_id, currency, amount), factor in changes:
+            if changed_order_id != order_id:
+                # The payment has been moved to a different order
+                Order.objects.get(pk=changed_order_id).recalculate_paid()
+                continue
+
+            Order.objects.filter(pk=order_id).update(
+                paid=F("paid")
+                + Case(
+                    When(currency=currency, then=Value(Decimal(amount) * factor)),
+                    default=Value(Decimal("0.00")),
+                    output_field=models.DecimalField(max_digits=18, decimal_places=2),
+                )
+            )
+
+        paid, currency = Order.objects.filter(pk=order_id).values_list(
+            "paid", "currency"
+        )[0]
+        if OrderPayment.order.is_cached(self):
+            self.order.paid = paid
+        return currency
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self._recalculate_paid()
+        with transaction.atomic():
+            previous = (
+                None
+                if self._state.adding or self.pk is None
+                else self._saved_paid_entry()
+            )
+            super().save(*args, **kwargs)
+            currency = self._update_paid(self.paid_entry(), previous)
 
-        if self.currency != self.order.currency:
+        if currency is None:
+            currency = self.order.currency
+        if currency != self.currency:
             self.order.notes += (
                 "\n" + _("Currency of payment %s does not match.") % self
             )
@@ -832,12 +936,122 @@ class OrderPayment(models.Model):
     save.alters_data = True
 
     def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-        self._recalculate_paid()
+        with transaction.atomic():
+            previous = self._saved_paid_entry()
+            result = super().delete(*args, **kwargs)
+            self._update_paid(None, previous)
+        return result
 
     delete.alters_data = True
 
 
+class PaymentNotification(models.Model):
+    """
+    Journal of notifications received from payment service providers
+
+    Every combination of payment module, transaction ID and status is
+    processed only once, see ``ProcessorBase.process_notification``.
+    """
+
+    created = models.DateTimeField(_("created"), default=timezone.now)
+    payment_module_key = models.CharField(_("payment module key"), max_length=20)
+    transaction_id = models.CharField(_("transaction ID"), max_length=100)
+    status = models.CharField(_("status"), max_length=50)
+    order = models.ForeignKey(
+        Order,
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+        related_name="payment_notifications",
+        verbose_name=_("order"),
+    )
+
+    class Meta:
+        ordering = ("-created",)
+        unique_together = (("payment_module_key", "transaction_id", "status"),)
+        verbose_name = _("payment notification")
+        verbose_name_plural = _("payment notifications")
+
+    def __str__(self):
+        return f"{self.payment_module_key} {self.transaction_id} {self.status}"
+
+
+class OutboxMessage(models.Model):
+    """
+    Signal delivery to a deferred receiver, written in the same transaction
+    as the change which sent the signal and delivered later by the
+    ``plata_outbox_worker`` management command, see ``plata.shop.outbox``
+    """
+
+    PENDING = 10
+    DELIVERED = 20
+    FAILED = 30
+
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (DELIVERED, _("delivered")),
+        (FAILED, _("failed")),
+    )
+
+    created = models.DateTimeField(_("created"), default=timezone.now)
+    receiver = models.CharField(_("receiver"), max_length=100)
+    kwargs = JSONField(_("arguments"), blank=True)
+    status = models.PositiveIntegerField(
+        _("status"), choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    next_attempt = models.DateTimeField(_("next attempt"), default=timezone.now)
+    delivered = models.DateTimeField(_("delivered"), blank=True, null=True)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt"])]
+        ordering = ("-created",)
+        verbose_name = _("outbox message")
+        verbose_name_plural = _("outbox messages")
+
+    def __str__(self):
+        return f"{self.receiver} ({self.get_status_display()})"
+
+
+class QueuedEmail(models.Model):
+    """
+    E-mail message waiting for (or failed) delivery, see ``plata.shop.mail``
+    """
+
+    PENDING = 10
+    SENT = 20
+    FAILED = 30
+
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (SENT, _("sent")),
+        (FAILED, _("failed")),
+    )
+
+    created = models.DateTimeField(_("created"), default=timezone.now)
+    subject = models.CharField(_("subject"), max_length=200, blank=True)
+    from_email = models.CharField(_("from"), max_length=200)
+    recipients = models.TextField(_("recipients"))
+    message = models.BinaryField(_("message"))
+    status = models.PositiveIntegerField(
+        _("status"), choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    next_attempt = models.DateTimeField(_("next attempt"), default=timezone.now)
+    sent = models.DateTimeField(_("sent"), blank=True, null=True)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt"])]
+        ordering = ("-created",)
+        verbose_name = _("queued e-mail")
+        verbose_name_plural = _("queued e-mails")
+
+    def __str__(self):
+        return self.subject
+
+
 class PriceBase(models.Model):
     """
     Price for a given product, currency, tax class and time period
@@ -65,33 +65,24 @@ A real-world example follows::
         weak=False)
 """
 
-import contextlib
-from io import BytesIO
-
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.utils.translation import activate
 
+from plata.shop.mail import send_messages
+
 
 class BaseHandler:
     def invoice_pdf(self, order):
-        from plata.reporting.order import invoice_pdf
-        from plata.reporting.pdfdocument import PlataPDFDocument
+        from plata.reporting.documents import get_document
 
-        with contextlib.closing(BytesIO()) as content:
-            pdf = PlataPDFDocument(content)
-            invoice_pdf(pdf, order)
-            return content.getvalue()
+        return get_document(order, "invoice")
 
     def packing_slip_pdf(self, order):
-        from plata.reporting.order import packing_slip_pdf
-        from plata.reporting.pdfdocument import PlataPDFDocument
+        from plata.reporting.documents import get_document
 
-        with contextlib.closing(BytesIO()) as content:
-            pdf = PlataPDFDocument(content)
-            packing_slip_pdf(pdf, order)
-            return content.getvalue()
+        return get_document(order, "packing-slip")
 
     def context(self, ctx, **kwargs):
         request = ctx.get("request")
@@ -106,9 +97,12 @@ class BaseHandler:
 
 
 class EmailHandler(BaseHandler):
-    def __init__(self, always_to=None, always_bcc=None):
+    def __init__(self, always_to=None, always_bcc=None, fail_silently=True):
         self.always_to = always_to
         self.always_bcc = always_bcc
+        # Pass False for deferred handlers, so that failures are retried by
+        # the outbox worker instead of being queued (see plata.shop.mail)
+        self.fail_silently = fail_silently
 
     def __call__(self, sender, **kwargs):
         email = self.message(sender, **kwargs)
@@ -118,8 +112,7 @@ class EmailHandler(BaseHandler):
         if self.always_bcc:
             email.bcc += list(self.always_bcc)
 
-        # TODO log this, or send a replacement email to the shop owner
-        email.send(fail_silently=True)
+        send_messages([email], fail_silently=self.fail_silently)
 
 
 class ContactCreatedHandler(EmailHandler):
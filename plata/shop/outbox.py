@@ -0,0 +1,272 @@
+"""
+Transactional outbox for signal receivers
+=========================================
+
+Receivers of ``order_paid`` and the other shop signals run synchronously,
+f.e. inside the notification handler of a payment service provider. Slow
+receivers (sending e-mail, generating PDFs, calling tracking APIs) delay
+the response and may cause the payment service provider to time out and
+retry. Receivers can opt into deferred delivery instead::
+
+    from plata.shop import notifications, outbox, signals
+
+    signals.order_paid.connect(
+        outbox.deferred(
+            'send-invoice',
+            notifications.SendInvoiceHandler(fail_silently=False)),
+        weak=False)
+
+Sending the signal then only stores an ``OutboxMessage`` in the same
+transaction as the change which sent the signal (f.e. the order status
+change in ``ProcessorBase.order_paid``). The ``plata_outbox_worker``
+management command delivers stored messages to the receiver. Failed
+deliveries are retried with exponential backoff
+(``PLATA_OUTBOX_RETRY_DELAY``) and marked as failed after
+``PLATA_OUTBOX_MAX_ATTEMPTS`` attempts; failed messages can be requeued
+in the administration panel.
+
+Model instances and payment modules are passed by reference and loaded
+again when delivering the message, requests are passed as ``None``.
+Messages are delivered at least once, receivers should be idempotent.
+"""
+
+import logging
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.db import connections, models, transaction
+from django.http import HttpRequest
+from django.utils import timezone
+
+import plata
+
+
+logger = logging.getLogger("plata.shop.outbox")
+
+
+#: Deferred receivers by key
+receivers = {}
+
+#: Leases in seconds of deferred receivers which take longer than the lease
+#: passed to ``claim``, by key
+leases = {}
+
+
+class DeferredReceiver:
+    """
+    Signal receiver storing an ``OutboxMessage`` for ``receiver`` instead of
+    calling it
+    """
+
+    def __init__(self, key, receiver):
+        self.key = key
+        self.receiver = receiver
+
+    def __repr__(self):
+        return "<DeferredReceiver %s>" % self.key
+
+    def __call__(self, signal, sender, **kwargs):
+        from plata.shop.models import OutboxMessage
+
+        kwargs["sender"] = sender
+        OutboxMessage.objects.create(
+            receiver=self.key,
+            kwargs={key: encode(value) for key, value in kwargs.items()},
+        )
+
+
+def deferred(key, receiver, lease=None):
+    """
+    Register ``receiver`` under the unique ``key`` and return a receiver
+    for connecting to a signal which defers the call to the outbox worker
+
+    Messages for receivers with a ``lease`` (in seconds) are hidden from
+    other workers for at least this long when they are claimed.
+    """
+    if key in receivers and receivers[key] is not receiver:
+        raise ValueError("A different receiver has been registered as %s" % key)
+    receivers[key] = receiver
+    if lease:
+        leases[key] = lease
+    return DeferredReceiver(key, receiver)
+
+
+def send_on_commit(signal, sender, **kwargs):
+    """
+    Send ``signal`` from inside a transaction
+
+    Deferred receivers store their messages right away, in the same
+    transaction. All other receivers are called when the transaction has
+    been committed, so that slow receivers (sending e-mail, calling
+    tracking APIs) do not keep the rows locked by the transaction and their
+    exceptions do not roll it back. Exceptions raised by these receivers
+    are logged. Their e-mail messages are sent over one connection (see
+    ``plata.shop.mail.batch``).
+    """
+    from plata.shop.mail import batch
+
+    deferred_receivers, receivers_on_commit = [], []
+    for receiver in signal._live_receivers(sender):
+        if isinstance(receiver, DeferredReceiver):
+            deferred_receivers.append(receiver)
+        else:
+            receivers_on_commit.append(receiver)
+
+    for receiver in deferred_receivers:
+        receiver(signal=signal, sender=sender, **kwargs)
+
+    def send():
+        with batch():
+            for receiver in receivers_on_commit:
+                try:
+                    receiver(signal=signal, sender=sender, **kwargs)
+                except Exception:
+                    logger.exception("Signal receiver %r failed" % receiver)
+
+    if receivers_on_commit:
+        transaction.on_commit(send)
+
+
+def encode(value):
+    from plata.payment.modules.base import ProcessorBase
+
+    if isinstance(value, models.Model):
+        return {"model": value._meta.label_lower, "pk": value.pk}
+    if isinstance(value, ProcessorBase):
+        return {"payment_module": value.key}
+    if isinstance(value, HttpRequest):
+        return None
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict) and value.keys() == {"model", "pk"}:
+        return apps.get_model(value["model"])._default_manager.get(pk=value["pk"])
+    if isinstance(value, dict) and value.keys() == {"payment_module"}:
+        for module in plata.shop_instance().get_payment_modules():
+            if module.key == value["payment_module"]:
+                return module
+        raise LookupError("Unknown payment module %s" % value["payment_module"])
+    return value
+
+
+def claim(batch_size, lease, model=None):
+    """
+    Return up to ``batch_size`` due messages and hide them from other
+    workers for ``lease`` seconds
+
+    ``model`` defaults to ``OutboxMessage`` and may be any model with
+    ``status`` and ``next_attempt`` fields, such as ``QueuedEmail``.
+    Messages for receivers registered with a longer lease (see
+    ``deferred``) are hidden for that long instead.
+    """
+    from plata.shop.models import OutboxMessage
+
+    model = model or OutboxMessage
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(
+            model.objects.select_for_update(skip_locked=True)
+            .filter(status=model.PENDING, next_attempt__lte=now)
+            .order_by("next_attempt", "id")[:batch_size]
+        )
+        pks = defaultdict(list)
+        for message in messages:
+            receiver = getattr(message, "receiver", None)
+            pks[max(lease, leases.get(receiver, 0))].append(message.pk)
+        for message_lease, message_pks in pks.items():
+            model.objects.filter(pk__in=message_pks).update(
+                next_attempt=now + timedelta(seconds=message_lease)
+            )
+    return messages
+
+
+def schedule_retry(message, max_attempts=None, retry_delay=None):
+    """
+    Record the exception currently being handled on a failed message and
+    schedule the next attempt, or mark the message as failed if it has been
+    attempted ``max_attempts`` times already
+    """
+    max_attempts = max_attempts or plata.settings.PLATA_OUTBOX_MAX_ATTEMPTS
+    retry_delay = retry_delay or plata.settings.PLATA_OUTBOX_RETRY_DELAY
+
+    message.last_error = traceback.format_exc()
+    if message.attempts >= max_attempts:
+        message.status = message.FAILED
+    else:
+        message.next_attempt = timezone.now() + timedelta(
+            seconds=retry_delay * 2 ** (message.attempts - 1)
+        )
+
+
+def deliver(message, max_attempts=None, retry_delay=None):
+    """
+    Deliver a single message to its receiver and record the outcome
+
+    Returns ``True`` if the message has been delivered.
+    """
+    from plata.shop.models import OutboxMessage
+
+    message.attempts += 1
+    try:
+        receiver = receivers[message.receiver]
+        kwargs = {key: decode(value) for key, value in message.kwargs.items()}
+        receiver(signal=None, **kwargs)
+    except Exception:
+        logger.exception("Delivering outbox message %s failed" % message.pk)
+        schedule_retry(message, max_attempts=max_attempts, retry_delay=retry_delay)
+        delivered = False
+    else:
+        message.status = OutboxMessage.DELIVERED
+        message.delivered = timezone.now()
+        message.last_error = ""
+        delivered = True
+
+    message.save(
+        update_fields=["attempts", "status", "next_attempt", "delivered", "last_error"]
+    )
+    return delivered
+
+
+def _deliver_in_thread(message, **kwargs):
+    try:
+        return deliver(message, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def process_outbox(
+    threads=4, batch_size=100, lease=300, max_attempts=None, retry_delay=None
+):
+    """
+    Deliver all due messages using a pool of ``threads`` threads and return
+    the number of delivered and of failed deliveries
+
+    Messages are claimed in batches of ``batch_size`` and are not delivered
+    by other workers for ``lease`` seconds.
+    """
+
+    kwargs = {"max_attempts": max_attempts, "retry_delay": retry_delay}
+    delivered = failed = 0
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            messages = claim(batch_size, lease)
+            if not messages:
+                break
+            if threads > 1:
+                results = list(
+                    executor.map(
+                        lambda message: _deliver_in_thread(message, **kwargs),
+                        messages,
+                    )
+                )
+            else:
+                results = [deliver(message, **kwargs) for message in messages]
+            delivered += results.count(True)
+            failed += results.count(False)
+
+    return delivered, failed
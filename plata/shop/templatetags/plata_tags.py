@@ -2,7 +2,7 @@ from django import forms, template
 from django.db.models import ObjectDoesNotExist
 from django.template.loader import render_to_string
 
-# import plata
+import plata
 import plata.context_processors
 
 
@@ -33,6 +33,35 @@ def quantity_ordered(product, order):
         return 0
 
 
+@register.simple_tag
+def stock_availability(products):
+    """
+    Determine the available stock of all products of a listing at once and
+    store it in the ``stock_available`` attribute of each product. Payment
+    process reservations of other customers are taken into account::
+
+        {% stock_availability object_list as stock %}
+        {% for product in object_list %}
+            {% if product.stock_available > 3 %}In stock
+            {% elif product.stock_available %}Only {{ product.stock_available }} left
+            {% else %}Sold out{% endif %}
+        {% endfor %}
+
+    Returns a dictionary mapping product IDs to the available quantity, or an
+    empty dictionary if stock tracking is disabled. Costs a single query, see
+    ``PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT`` for caching the values.
+    """
+    if not plata.settings.PLATA_STOCK_TRACKING:
+        return {}
+
+    products = list(products)
+    available = plata.stock_backend().cached_availability(products)
+    for product in products:
+        if hasattr(product, "pk"):
+            product.stock_available = available[product.pk]
+    return available
+
+
 def _type_class(item):
     if isinstance(item.field.widget, forms.CheckboxInput):
         return "checkbox"
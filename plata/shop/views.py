@@ -255,7 +255,8 @@ class Shop:
         Import and return all payment modules defined in
         ``PLATA_PAYMENT_MODULES``
 
-        If request is given only applicable modules are loaded.
+        If request is given only applicable modules are loaded. Modules
+        whose circuit breaker is open are not offered either.
         """
         all_modules = [
             get_callable(module)(self)
@@ -263,7 +264,11 @@ class Shop:
         ]
         if not request:
             return all_modules
-        return [module for module in all_modules if module.enabled_for_request(request)]
+        return [
+            module
+            for module in all_modules
+            if module.enabled_for_request(request) and not module.breaker.is_open
+        ]
 
     def user_is_authenticated(self, user):
         """
@@ -676,12 +681,7 @@ class Shop:
         logger.warn("Order payment failure for %s" % order.order_id)
 
         if plata.settings.PLATA_STOCK_TRACKING:
-            StockTransaction = plata.stock_model()
-
-            for transaction in order.stock_transactions.filter(
-                type=StockTransaction.PAYMENT_PROCESS_RESERVATION
-            ):
-                transaction.delete()
+            plata.stock_backend().release(order)
 
         order.payments.pending().delete()
 
@@ -698,10 +698,7 @@ class Shop:
             )
             messages.info(
                 request,
-                _(
-                    "Payment failed; you can continue editing your order and"
-                    " try again."
-                ),
+                _("Payment failed; you can continue editing your order and try again."),
             )
 
         return self.render(
@@ -710,6 +707,20 @@ class Shop:
             self.get_context(request, {"order": order, "progress": "failure"}),
         )
 
+    def order_reservation_failure(self, request, order, exc):
+        """
+        Handles orders whose stock could not be reserved when handing off
+        to the payment module, i.e. because somebody else has been faster
+        """
+        logger.warning("Stock reservation failure for %s" % order.order_id)
+
+        order.update_status(
+            order.CHECKOUT, "Stock reservation failure, going back to checkout"
+        )
+        for message in exc.messages:
+            messages.error(request, message)
+        return self.redirect("plata_shop_cart")
+
     def order_new(self, request):
         """
         Forcibly create a new order and redirect user either to the frontpage
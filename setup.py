@@ -34,6 +34,7 @@ setup(
     extras_require={
         "billogram": ["billogram_api"],
         "payson": ["payson_api"],
+        "pypdf": ["pypdf"],
         "stripe": ["stripe"],
     },
     classifiers=[
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Benchmark for generating invoice PDFs
+
+Draws the invoice of an order repeatedly using reportlab's default fonts and
+using custom TrueType fonts (``PLATA_PDF_FONT_NAME`` etc.), once parsing the
+fonts for every document as before fonts were registered once per process
+and once with the font registration of ``PlataPDFDocument``. Reports
+documents per second for each combination::
+
+    python tests/benchmarks/pdf_documents.py --documents 200
+
+Pass ``--font-path`` and ``--bold-font-path`` to benchmark other fonts than
+the Bitstream Vera fonts shipped with reportlab.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+TESTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [TESTS, os.path.dirname(TESTS)]
+
+
+def main():
+    import reportlab
+
+    fonts = os.path.join(os.path.dirname(reportlab.__file__), "fonts")
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--items", type=int, default=10)
+    parser.add_argument("--font-path", default=os.path.join(fonts, "Vera.ttf"))
+    parser.add_argument("--bold-font-path", default=os.path.join(fonts, "VeraBd.ttf"))
+    parser.add_argument("--settings", default="testapp.settings")
+    args = parser.parse_args()
+
+    os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+
+    import django
+
+    django.setup()
+
+    from django.db import connection
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        order = create_order(args)
+        for fonts in ("default", "custom"):
+            for mode in ("uncached", "cached"):
+                print(run(order, fonts, mode, args))
+    finally:
+        connection.creation.destroy_test_db(
+            connection.settings_dict["NAME"], verbosity=0
+        )
+
+
+def create_order(args):
+    import plata
+    from plata.shop.models import Order, OrderItem
+
+    product = plata.product_model().objects.create(name="Product")
+    order = Order.objects.create(currency="CHF", billing_last_name="Customer")
+    OrderItem.objects.bulk_create(
+        OrderItem(
+            order=order,
+            product=product,
+            name="Product %s" % i,
+            sku="P%s" % i,
+            quantity=1,
+            currency="CHF",
+            _unit_price=10,
+            _unit_tax=0,
+            tax_rate=0,
+        )
+        for i in range(args.items)
+    )
+    return order
+
+
+def run(order, fonts, mode, args):
+    from io import BytesIO
+
+    import plata
+    import plata.reporting.pdfdocument
+    from plata.reporting.order import invoice_pdf
+    from plata.reporting.pdfdocument import PlataPDFDocument
+
+    custom = fonts == "custom"
+    plata.settings.PLATA_PDF_FONT_NAME = "BenchmarkFont" if custom else ""
+    plata.settings.PLATA_PDF_FONT_PATH = args.font_path if custom else ""
+    plata.settings.PLATA_PDF_FONT_BOLD_NAME = "BenchmarkFont-Bold" if custom else ""
+    plata.settings.PLATA_PDF_FONT_BOLD_PATH = args.bold_font_path if custom else ""
+
+    plata.reporting.pdfdocument._registered_fonts.clear()
+    start = time.perf_counter()
+    for i in range(args.documents):
+        if mode == "uncached":
+            # Parse the fonts again for every document
+            plata.reporting.pdfdocument._registered_fonts.clear()
+        pdf = PlataPDFDocument(BytesIO())
+        invoice_pdf(pdf, order)
+    elapsed = time.perf_counter() - start
+
+    return "%-7s fonts, %-8s %s documents in %.2fs (%.1f/s)" % (
+        fonts,
+        mode,
+        args.documents,
+        elapsed,
+        args.documents / elapsed,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Contention benchmark for payment process stock reservations
+
+Many threads try to reserve the last few items of a single product at the
+same time, once using the unlocked check-then-write sequence and once using
+``StockTransaction.objects.reserve``. Reports throughput, rejected, failed
+and oversold reservations for both. Database conflicts are retried::
+
+    python tests/benchmarks/stock_contention.py --threads 32 --stock 10
+
+SQLite serializes writers using a database-wide lock, so meaningful numbers
+require a database with row level locks. Pass a settings module configuring
+e.g. PostgreSQL using ``--settings``.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+TESTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [TESTS, os.path.dirname(TESTS)]
+
+#: Attempts per reservation when the database reports a conflict
+RETRIES = 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--stock", type=int, default=50)
+    parser.add_argument("--settings", default="testapp.settings")
+    args = parser.parse_args()
+
+    os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+
+    from django.conf import settings
+
+    database = settings.DATABASES["default"]
+    if database["ENGINE"] == "django.db.backends.sqlite3":
+        # Threads need a shared database, not the in-memory default
+        database["TEST"] = {"NAME": os.path.join(tempfile.mkdtemp(), "bench.db")}
+        database["OPTIONS"] = {"timeout": 30}
+
+    import django
+
+    django.setup()
+
+    from django.db import connection
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        for mode in ("unlocked", "reserve"):
+            print(run(mode, args))
+    finally:
+        connection.creation.destroy_test_db(database["NAME"], verbosity=0)
+
+
+def run(mode, args):
+    from django.core.exceptions import ValidationError
+    from django.db import DatabaseError, connection, transaction
+
+    import plata
+    from plata.product.stock.models import validate_order_stock_available
+    from plata.shop.models import Order, OrderItem
+
+    StockTransaction = plata.stock_model()
+    product = plata.product_model().objects.create(name="Product (%s)" % mode)
+    StockTransaction.objects.create(
+        product=product, type=StockTransaction.PURCHASE, change=args.stock
+    )
+
+    orders = []
+    for i in range(args.orders):
+        order = Order.objects.create(currency="CHF")
+        OrderItem.objects.create(
+            order=order,
+            product=product,
+            quantity=1,
+            _unit_price=0,
+            _unit_tax=0,
+            tax_rate=0,
+        )
+        orders.append(order)
+    connection.close()
+
+    results = {"reserved": 0, "insufficient": 0, "errors": 0, "retries": 0}
+    lock = threading.Lock()
+    queue = list(orders)
+
+    def reserve(order):
+        if mode == "reserve":
+            StockTransaction.objects.reserve(order)
+            return
+
+        validate_order_stock_available(order)
+        with transaction.atomic():
+            StockTransaction.objects.bulk_create(
+                order,
+                type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
+                negative=True,
+            )
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    order = queue.pop()
+                for attempt in range(RETRIES):
+                    try:
+                        reserve(order)
+                        outcome = "reserved"
+                    except ValidationError:
+                        outcome = "insufficient"
+                    except DatabaseError:
+                        # Deadlocks, serialization failures, busy databases
+                        outcome = "errors"
+                        with lock:
+                            results["retries"] += 1
+                        continue
+                    break
+                with lock:
+                    results[outcome] += 1
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    reserved = -sum(
+        StockTransaction.objects.filter(
+            product=product, type=StockTransaction.PAYMENT_PROCESS_RESERVATION
+        ).values_list("change", flat=True)
+    )
+
+    return (
+        "%(mode)-8s %(orders)s orders in %(elapsed).2fs (%(rate).0f/s):"
+        " %(reserved)s reserved, %(insufficient)s rejected, %(errors)s failed"
+        " (%(retries)s retries), %(oversold)s oversold"
+        % dict(
+            results,
+            mode=mode,
+            orders=args.orders,
+            elapsed=elapsed,
+            rate=args.orders / elapsed,
+            oversold=max(0, reserved - args.stock),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
+import socketserver
+import threading
 from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.test import Client, TestCase
 
 import plata
 from plata.contact.models import Contact
-from plata.product.stock.models import StockTransaction
+from plata.payment.http import HTTPClient
+from plata.product.stock.models import Period, StockTransaction
 from plata.shop import notifications, signals
 from plata.shop.models import Order, OrderItem, TaxClass
 
@@ -51,10 +57,153 @@ def get_request(**kwargs):
     return request
 
 
+class StubServer:
+    """
+    Local HTTP server standing in for payment service providers
+
+    ``handler(request)`` is called for every request with a dictionary
+    containing ``method``, ``path``, ``body`` and ``port`` (the client port,
+    which stays the same while a connection is kept alive) and returns a
+    ``(status, body)`` tuple. All requests are recorded in ``requests``.
+    Use ``StubHTTPClient`` to send the calls of payment modules here::
+
+        with StubServer(lambda request: (200, b"VERIFIED")) as server:
+            ...
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                request = {
+                    "method": self.command,
+                    "path": self.path,
+                    "body": self.rfile.read(length),
+                    "port": self.client_address[1],
+                }
+                stub.requests.append(request)
+                status, body = stub.handler(request)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        # Clients giving up because of timeouts close connections early
+        self.server.handle_error = lambda request, client_address: None
+        self.url = "http://127.0.0.1:%s" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        StubHTTPClient.server_url = self.url
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class StubHTTPClient(HTTPClient):
+    """
+    Sends all calls to the running ``StubServer`` and does not wait before
+    retrying
+    """
+
+    server_url = None
+    backoff = 0
+
+    def request(self, method, url, **kwargs):
+        scheme, netloc = urlsplit(self.server_url)[:2]
+        url = urlunsplit((scheme, netloc) + urlsplit(url)[2:])
+        return super().request(method, url, **kwargs)
+
+
+class StubSMTPServer:
+    """
+    Local SMTP server recording delivered messages and the number of
+    connections, refusing the recipients in ``reject``::
+
+        with StubSMTPServer() as server, self.settings(**server.settings):
+            ...
+    """
+
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode("ascii") + b"\r\n")
+
+            def handle(self):
+                stub.connections += 1
+                self.reply("220 localhost")
+                envelope = None
+                for line in self.rfile:
+                    command = line.decode("ascii").strip()
+                    verb = command[:4].upper()
+                    if verb == "MAIL":
+                        envelope = {"from": command[10:].strip("<>"), "to": []}
+                    elif verb == "RCPT":
+                        address = command[8:].strip("<>")
+                        if address in stub.reject:
+                            self.reply("550 %s rejected" % address)
+                            continue
+                        envelope["to"].append(address)
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                        stub.messages.append(dict(envelope, data=data))
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    self.reply("250 OK")
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.settings = {
+            "EMAIL_BACKEND": "django.core.mail.backends.smtp.EmailBackend",
+            "EMAIL_HOST": "127.0.0.1",
+            "EMAIL_PORT": self.server.server_address[1],
+        }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
 PRODUCTION_CREATION_COUNTER = 0
 
 
 class PlataTest(TestCase):
+    def setUp(self):
+        # Periods cached by earlier tests have been rolled back
+        Period.objects.clear_cache()
+        # Reset the circuit breakers of payment modules
+        cache.clear()
+
     def assertRaisesWithCode(self, exception, fn, code):
         try:
             fn()
@@ -64,6 +213,22 @@ class PlataTest(TestCase):
             raise
         raise Exception(f"{fn} did not raise {exception}")
 
+    def stub_payment_server(self, handler):
+        """
+        Send the calls of payment modules to a ``StubServer`` until the end
+        of the test
+        """
+        server = StubServer(handler).__enter__()
+        self.addCleanup(server.__exit__)
+        self.addCleanup(
+            setattr,
+            plata.settings,
+            "PLATA_PAYMENT_HTTP_CLIENT",
+            plata.settings.PLATA_PAYMENT_HTTP_CLIENT,
+        )
+        plata.settings.PLATA_PAYMENT_HTTP_CLIENT = "testapp.base.StubHTTPClient"
+        return server
+
     def create_contact(self):
         return Contact.objects.create(
             billing_company="BigCorp",
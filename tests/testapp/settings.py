@@ -77,6 +77,8 @@ INSTALLED_APPS = (
 
 PLATA_SHOP_PRODUCT = "testapp.Product"
 PLATA_STOCK_TRACKING = True
+# Opening a new period waits until cached periods have expired
+PLATA_STOCK_PERIOD_CACHE_TIMEOUT = 1
 POSTFINANCE = {
     "PSPID": "plataTEST",
     "SHA1_IN": "plataSHA1_IN",
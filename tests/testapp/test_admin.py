@@ -1,12 +1,23 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
 from decimal import Decimal
+from io import BytesIO, StringIO
 
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.forms.models import model_to_dict
 from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
 
 import plata
 from plata.discount.models import Discount
-from plata.shop.models import TaxClass
+from plata.reporting import export
+from plata.shop import outbox
+from plata.shop.models import Order, OutboxMessage, TaxClass
 from testapp.base import PlataTest
 
 
@@ -15,6 +26,7 @@ Product = plata.product_model()
 
 class AdminTest(PlataTest):
     def setUp(self):
+        super().setUp()
         u = User.objects.create_user("admin", "admin@example.com", "password")
         u.is_staff = True
         u.is_superuser = True
@@ -137,3 +149,124 @@ class AdminTest(PlataTest):
         self.assertContains(orders, "Is a cart", 2)
         self.assertContains(orders, "/invoice_pdf/%d/" % order.id, 1)
         self.assertContains(orders, "/packing_slip_pdf/%d/" % order.id, 1)
+
+    def test_03_document_batch(self):
+        self.addCleanup(
+            setattr,
+            plata.settings,
+            "PLATA_REPORTING_BATCH_PROCESSES",
+            plata.settings.PLATA_REPORTING_BATCH_PROCESSES,
+        )
+        plata.settings.PLATA_REPORTING_BATCH_PROCESSES = 1
+
+        orders = [Order.objects.create(currency="CHF") for i in range(2)]
+        self.login()
+
+        response = self.client.post(
+            "/admin/shop/order/",
+            {
+                "action": "packing_slip_zip",
+                "_selected_action": [order.pk for order in orders],
+            },
+        )
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertEqual(
+            zipfile.ZipFile(BytesIO(response.content)).namelist(),
+            ["packing-slip-%09d.pdf" % order.pk for order in orders],
+        )
+
+        response = self.client.post(
+            "/admin/shop/order/",
+            {"action": "invoice_pdf", "_selected_action": [orders[0].pk]},
+        )
+        self.assertEqual(response["Content-Type"], "application/pdf")
+
+    def test_04_order_export(self):
+        orders = [Order.objects.create(currency="CHF") for i in range(3)]
+        self.login()
+
+        response = self.client.post(
+            "/admin/shop/order/",
+            {
+                "action": "export_orders_csv",
+                "_selected_action": [order.pk for order in orders],
+            },
+        )
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 4)
+
+        # Large selections are exported in the background
+        other = Order.objects.create(currency="CHF")
+        Order.objects.filter(pk=other.pk).update(status=Order.CHECKOUT)
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        for name, value in [
+            (
+                "PLATA_REPORTING_EXPORT_STORAGE",
+                "django.core.files.storage.FileSystemStorage",
+            ),
+            ("PLATA_REPORTING_EXPORT_THRESHOLD", 2),
+        ]:
+            self.addCleanup(
+                setattr, plata.settings, name, getattr(plata.settings, name)
+            )
+            setattr(plata.settings, name, value)
+
+        with self.settings(MEDIA_ROOT=location):
+            # All orders matching the filter have been selected
+            response = self.client.post(
+                "/admin/shop/order/?status__exact=%s" % Order.CART,
+                {
+                    "action": "export_orders_xlsx",
+                    "select_across": "1",
+                    "_selected_action": [orders[0].pk],
+                },
+                follow=True,
+            )
+            self.assertContains(response, "exported in the background")
+            message = OutboxMessage.objects.get()
+            self.assertEqual(message.receiver, "plata-order-export")
+            filename = message.kwargs["filename"]
+            url = reverse("plata_reporting_export", kwargs={"filename": filename})
+            self.assertContains(response, url)
+
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+            # The filter is stored, not the selected orders. Orders added in
+            # the meantime are not exported.
+            self.assertNotIn("pks", message.kwargs)
+            self.assertEqual(
+                message.kwargs["params"], {"status__exact": [str(Order.CART)]}
+            )
+            Order.objects.create(currency="CHF")
+
+            # The job cannot be edited in the administration panel
+            self.assertNotContains(
+                self.client.get("/admin/shop/outboxmessage/%s/change/" % message.pk),
+                'name="kwargs"',
+            )
+
+            # Exports are hidden from other workers for longer than the
+            # default lease
+            self.assertEqual(outbox.claim(100, 300), [message])
+            message.refresh_from_db()
+            self.assertGreater(
+                message.next_attempt,
+                timezone.now() + timedelta(seconds=export.EXPORT_LEASE - 60),
+            )
+            self.assertEqual(outbox.claim(100, 300), [])
+            OutboxMessage.objects.update(next_attempt=timezone.now())
+
+            call_command("plata_outbox_worker", threads=1, stdout=StringIO())
+            # Only the complete file is left
+            self.assertEqual(
+                os.listdir(os.path.join(location, "plata", "exports")), [filename]
+            )
+
+            response = self.client.get(url)
+            self.assertEqual(
+                response["Content-Disposition"],
+                'attachment; filename="%s"' % filename,
+            )
+            sheet = load_workbook(BytesIO(b"".join(response.streaming_content))).active
+            self.assertEqual(sheet.max_row, 4)
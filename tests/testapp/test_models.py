@@ -1,21 +1,50 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import warnings
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from io import BytesIO
+from io import BytesIO, StringIO
+from uuid import uuid4
 
 from django import forms
+from django.apps import apps as django_apps
+from django.core import serializers
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.serializers import serialize
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, Sum
+from django.http import Http404
+from django.template import Context, Template
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import plata
+import plata.payment.http
+import plata.reporting.batch
 import plata.reporting.order
+import plata.reporting.product
 from plata.discount.models import Discount, DiscountBase
-from plata.product.stock.models import Period, StockTransaction
+from plata.payment.modules import check, prepay
+from plata.payment.modules.base import move_payment_tokens
+from plata.product.stock.backends import DatabaseBackend, LocalCounterBackend
+from plata.product.stock.models import (
+    Period,
+    PeriodManager,
+    StockBalance,
+    StockTransaction,
+)
+from plata.reporting import documents
+from plata.reporting.documents import get_document
 from plata.reporting.pdfdocument import PlataPDFDocument
-from plata.shop.models import Order, OrderPayment, OrderStatus
-from testapp.base import PlataTest
+from plata.shop.models import Order, OrderItem, OrderPayment, OrderStatus
+from plata.shop.notifications import SendInvoiceHandler
+from testapp.base import PlataTest, StubHTTPClient, StubServer, User, get_request
 
 
 Product = plata.product_model()
@@ -726,6 +755,7 @@ class ModelTest(PlataTest):
         self.assertEqual(transaction.type, StockTransaction.INITIAL)
         self.assertEqual(transaction.change, 9)
         self.assertEqual(transaction.period.name, "Something")
+        self.assertEqual(Product.objects.get(pk=product.id).items_in_stock, 9)
 
     def test_18_amount_discount_incl_tax(self):
         """Test discount amounts specified with tax included"""
@@ -1121,3 +1151,1172 @@ class ModelTest(PlataTest):
         self.assertTrue(isinstance(serialized, str))
         self.assertTrue('"model": "shop.order"' in serialized)
         self.assertTrue('\\"now_tz_with_ms\\"' in serialized)
+
+    def test_31_stock_balances(self):
+        """Test incremental stock balances and their reconciliation"""
+        product = self.create_product(stock=10)
+        Product = product.__class__
+
+        def balance(type):
+            return StockBalance.objects.get(product=product, type=type).total
+
+        s = StockTransaction.objects.create(
+            product=product, type=StockTransaction.SALE, change=-3
+        )
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 7)
+        self.assertEqual(balance(StockTransaction.PURCHASE), 10)
+        self.assertEqual(balance(StockTransaction.SALE), -3)
+
+        s.type = StockTransaction.CORRECTION
+        s.change = -4
+        s.save()
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 6)
+        self.assertEqual(balance(StockTransaction.SALE), 0)
+        self.assertEqual(balance(StockTransaction.CORRECTION), -4)
+
+        StockTransaction.objects.get(pk=s.pk).delete()
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 10)
+        self.assertEqual(StockTransaction.objects.items_in_stock(product), 10)
+
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        Product.objects.filter(pk=product.pk).update(items_in_stock=42)
+        StockBalance.objects.filter(type=StockTransaction.PURCHASE).update(total=5)
+
+        drift = StockTransaction.objects.reconcile(fix=True)
+        self.assertEqual(
+            sorted((row["type"] or 0, row["expected"], row["actual"]) for row in drift),
+            [(0, 10, 42), (StockTransaction.PURCHASE, 10, 5)],
+        )
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 10)
+        self.assertEqual(balance(StockTransaction.PURCHASE), 10)
+
+        output = StringIO()
+        call_command("plata_stock_reconcile", stdout=output)
+        self.assertIn("No drift found.", output.getvalue())
+
+        # Opening a new period carries the stock over without doubling it
+        StockTransaction.objects.create(
+            product=product, type=StockTransaction.SALE, change=-1
+        )
+        StockTransaction.objects.open_new_period()
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 9)
+        self.assertEqual(StockTransaction.objects.items_in_stock(product), 9)
+        self.assertEqual(balance(StockTransaction.INITIAL), 9)
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+    def test_32_stock_availability(self):
+        """Test batch stock availability and cart validation queries"""
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=5)
+        p3 = self.create_product()
+
+        order = self.create_order()
+        order.modify_item(p1, 4)
+        order.modify_item(p2, 5)
+
+        other = Order.objects.create(currency="CHF")
+        StockTransaction.objects.create(
+            product=p1,
+            order=other,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
+            change=-3,
+        )
+        StockTransaction.objects.create(
+            product=p2,
+            order=order,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
+            change=-5,
+        )
+        StockTransaction.objects.create(
+            product=p2, order=order, type=StockTransaction.SALE, change=-2
+        )
+
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2, p3]),
+            {p1.pk: 10, p2.pk: 3, p3.pk: 0},
+        )
+        self.assertEqual(
+            StockTransaction.objects.availability(
+                [p1, p2.pk], exclude_order=order, include_reservations=True
+            ),
+            {p1.pk: 7, p2.pk: 5},
+        )
+        self.assertEqual(
+            StockTransaction.objects.items_in_stock(
+                p1, exclude_order=order, include_reservations=True
+            ),
+            7,
+        )
+
+        # The currency check, the order items and the availability of all
+        # products; the current period is cached
+        with self.assertNumQueries(3):
+            order.validate(order.VALIDATE_CART)
+
+        order.modify_item(p1, relative=4)
+        self.assertRaisesWithCode(
+            ValidationError,
+            lambda: order.validate(order.VALIDATE_CART),
+            code="insufficient_stock",
+        )
+
+    def test_33_current_period_cache(self):
+        """Test the process-local cache of the current stock period"""
+        period = Period.objects.create(
+            name="Period 1", start=timezone.now() - timedelta(days=1)
+        )
+
+        self.assertEqual(Period.objects.current(), period)
+        with self.assertNumQueries(0):
+            self.assertEqual(Period.objects.current(), period)
+
+        # Creating a period clears the cache
+        upcoming = Period.objects.create(
+            name="Period 2", start=timezone.now() + timedelta(seconds=1)
+        )
+        with self.assertNumQueries(2):
+            self.assertEqual(Period.objects.current(), period)
+
+        # The cache expires when the upcoming period starts
+        Period.objects.filter(pk=upcoming.pk).update(start=timezone.now())
+        self.assertEqual(Period.objects.current(), period)
+        time.sleep(1)
+        self.assertEqual(Period.objects.current(), upcoming)
+
+        upcoming.delete()
+        self.assertEqual(Period.objects.current(), period)
+
+    def test_34_stock_transaction_bulk_create(self):
+        """Test bulk creating stock transactions with a constant query count"""
+        Product = plata.product_model()
+        products = [self.create_product(stock=10) for i in range(5)]
+        contact = self.create_contact()
+
+        def create(products):
+            order = self.create_order(contact)
+            for product in products:
+                order.modify_item(product, 2)
+
+            Period.objects.current()
+            with CaptureQueriesContext(connection) as queries:
+                transactions = StockTransaction.objects.bulk_create(
+                    order, type=StockTransaction.SALE, negative=True, notes="sale"
+                )
+            self.assertEqual(len(transactions), len(products))
+            self.assertTrue(all(t.pk for t in transactions))
+            return len(queries)
+
+        self.assertEqual(create(products[:2]), create(products[2:]))
+
+        self.assertEqual(
+            set(Product.objects.values_list("items_in_stock", flat=True)), {8}
+        )
+        self.assertEqual(
+            StockBalance.objects.filter(type=StockTransaction.SALE, total=-2).count(),
+            5,
+        )
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+    def test_35_open_new_period(self):
+        """Test the chunked and resumable period rollover"""
+        Product = plata.product_model()
+        p1 = self.create_product(stock=5)
+        p2 = self.create_product()
+        p3 = self.create_product(stock=3)
+        p4 = self.create_product(stock=7)
+
+        calls = []
+        period = StockTransaction.objects.open_new_period(
+            name="2026",
+            chunk_size=2,
+            skip_zero_stock=True,
+            progress=lambda processed, total: calls.append((processed, total)),
+        )
+        self.assertEqual(Period.objects.current(), period)
+        self.assertEqual(calls, [(2, 4), (4, 4)])
+        self.assertEqual(
+            dict(period.stock_transactions.values_list("product", "change")),
+            {p1.pk: 5, p3.pk: 3, p4.pk: 7},
+        )
+        self.assertEqual(
+            set(Product.objects.values_list("pk", "items_in_stock")),
+            {(p1.pk, 5), (p2.pk, 0), (p3.pk, 3), (p4.pk, 7)},
+        )
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # Simulate an interrupted run: p3 and p4 have not been processed
+        # yet, and p3 has been sold in the new period already
+        period.stock_transactions.filter(product__in=[p3, p4]).delete()
+        Product.objects.filter(pk=p3.pk).update(items_in_stock=3)
+        Product.objects.filter(pk=p4.pk).update(items_in_stock=7)
+        StockTransaction.objects.create(
+            product=p3, type=StockTransaction.SALE, change=-1
+        )
+
+        output = StringIO()
+        call_command(
+            "plata_stock_open_period",
+            "--resume=%s" % period.pk,
+            "--skip-zero-stock",
+            stdout=output,
+        )
+        self.assertIn("3/3 products processed", output.getvalue())
+        self.assertEqual(
+            dict(
+                period.stock_transactions.filter(
+                    type=StockTransaction.INITIAL
+                ).values_list("product", "change")
+            ),
+            {p1.pk: 5, p3.pk: 3, p4.pk: 7},
+        )
+        self.assertEqual(Product.objects.get(pk=p3.pk).items_in_stock, 2)
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+    def test_36_expire_reservations(self):
+        """Test configurable reservation lifetimes and the reservation sweeper"""
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=10)
+
+        order = self.create_order()
+        order.modify_item(p1, 2)
+        order.modify_item(p2, 3)
+
+        shop = plata.shop_instance()
+        processor = shop.get_payment_modules()[0]
+        self.assertEqual(processor.stock_reservation_ttl, 15 * 60)
+
+        plata.settings.PLATA_STOCK_RESERVATION_TTLS = {processor.key: 60}
+        try:
+            self.assertEqual(processor.stock_reservation_ttl, 60)
+            processor.reserve_stock_item(order, processor.create_pending_payment(order))
+        finally:
+            plata.settings.PLATA_STOCK_RESERVATION_TTLS = {}
+
+        reservations = StockTransaction.objects.filter(
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION
+        )
+        self.assertTrue(
+            all(
+                timedelta(seconds=55) < t.expires - t.created < timedelta(seconds=65)
+                for t in reservations.all()
+            )
+        )
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 8, p2.pk: 7},
+        )
+
+        # Nothing has expired yet
+        self.assertEqual(StockTransaction.objects.expire_reservations(), 0)
+
+        with self.assertNumQueries(5):
+            # Savepoint, select, delete, a single balance update and release
+            self.assertEqual(
+                StockTransaction.objects.expire_reservations(
+                    now=timezone.now() + timedelta(seconds=120)
+                ),
+                2,
+            )
+
+        self.assertFalse(reservations.exists())
+        self.assertEqual(
+            set(
+                StockBalance.objects.filter(
+                    type=StockTransaction.PAYMENT_PROCESS_RESERVATION
+                ).values_list("total", flat=True)
+            ),
+            {0},
+        )
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        output = StringIO()
+        call_command("plata_stock_expire_reservations", stdout=output)
+        self.assertIn("Deleted 0 expired reservations.", output.getvalue())
+
+        # Reservations are deleted in chunks, each in its own transaction
+        StockTransaction.objects.reserve(order)
+        with self.assertNumQueries(2 * 5 + 3):
+            self.assertEqual(
+                StockTransaction.objects.expire_reservations(
+                    now=timezone.now() + timedelta(days=1), chunk_size=1
+                ),
+                2,
+            )
+        self.assertFalse(reservations.exists())
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # Reservations without expiry date expire PLATA_STOCK_RESERVATION_TTL
+        # seconds after their creation
+        StockTransaction.objects.reserve(order)
+        reservations.update(expires=None)
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 8, p2.pk: 7},
+        )
+        self.assertEqual(StockTransaction.objects.expire_reservations(), 0)
+        self.assertEqual(
+            StockTransaction.objects.expire_reservations(
+                now=timezone.now() + timedelta(seconds=16 * 60)
+            ),
+            2,
+        )
+        self.assertFalse(reservations.exists())
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+    def test_37_stock_reserve(self):
+        """Test atomically checking and reserving the stock of an order"""
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=2)
+
+        order = self.create_order()
+        order.modify_item(p1, 6)
+        transactions = StockTransaction.objects.reserve(order, notes="first")
+        self.assertEqual([t.change for t in transactions], [-6])
+        self.assertTrue(all(t.expires for t in transactions))
+
+        other = Order.objects.create(currency="CHF")
+        other.modify_item(p2, 1)
+        other.modify_item(p1, 5)
+
+        # All or nothing
+        self.assertRaisesWithCode(
+            ValidationError,
+            lambda: StockTransaction.objects.reserve(other),
+            code="insufficient_stock",
+        )
+        self.assertEqual(other.stock_transactions.count(), 0)
+
+        other.modify_item(p1, relative=-1)
+        StockTransaction.objects.reserve(other)
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 0, p2.pk: 1},
+        )
+
+    def test_38_counter_stock_backend(self):
+        """Test the write-behind counter stock backend"""
+        self.assertIsInstance(plata.stock_backend(), DatabaseBackend)
+        plata.settings.PLATA_STOCK_BACKEND = (
+            "plata.product.stock.backends.LocalCounterBackend"
+        )
+        try:
+            self.assertIsInstance(plata.stock_backend(), LocalCounterBackend)
+        finally:
+            plata.settings.PLATA_STOCK_BACKEND = (
+                "plata.product.stock.backends.DatabaseBackend"
+            )
+
+        Product = plata.product_model()
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=5)
+        backend = LocalCounterBackend()
+
+        order = self.create_order()
+        order.modify_item(p1, 4)
+        order.modify_item(p2, 5)
+
+        self.assertEqual(
+            backend.availability([p1, p2], include_reservations=True),
+            {p1.pk: 10, p2.pk: 5},
+        )
+
+        backend.reserve(order, notes="reservation")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                backend.availability([p1, p2], include_reservations=True),
+                {p1.pk: 6, p2.pk: 0},
+            )
+            self.assertEqual(
+                backend.availability(
+                    [p1, p2], exclude_order=order, include_reservations=True
+                ),
+                {p1.pk: 10, p2.pk: 5},
+            )
+        # Nothing has been written to the ledger yet
+        self.assertEqual(order.stock_transactions.count(), 0)
+
+        other = Order.objects.create(currency="CHF")
+        other.modify_item(p2, 1)
+        self.assertRaisesWithCode(
+            ValidationError,
+            lambda: backend.reserve(other),
+            code="insufficient_stock",
+        )
+        self.assertEqual(backend.items_in_stock(p2, include_reservations=True), 0)
+
+        self.assertEqual(backend.flush(), 1)
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 6, p2.pk: 0},
+        )
+
+        # The payment has been successful
+        backend.commit_sale(order, notes="sale")
+        backend.release(order)
+        self.assertEqual(
+            backend.availability([p1, p2], include_reservations=True),
+            {p1.pk: 6, p2.pk: 0},
+        )
+        self.assertEqual(backend.flush(), 2)
+        self.assertEqual(
+            set(order.stock_transactions.values_list("type", flat=True)),
+            {StockTransaction.SALE},
+        )
+        self.assertEqual(Product.objects.get(pk=p1.pk).items_in_stock, 6)
+
+        # Expired reservations are returned to the counters
+        third = Order.objects.create(currency="CHF")
+        third.modify_item(p1, 3)
+        backend.reserve(third, expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(backend.items_in_stock(p1, include_reservations=True), 3)
+        self.assertEqual(backend.expire_reservations(), 1)
+        self.assertEqual(backend.items_in_stock(p1, include_reservations=True), 6)
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # Counters are not rebuilt while another process is flushing
+        backend.reserve(third)
+        backend.cache.add(backend._key("lock"), 1)
+        backend.cache.delete(backend._key("available", p1.pk))
+        timer = threading.Timer(0.2, backend.cache.delete, [backend._key("lock")])
+        timer.start()
+        self.assertEqual(backend.items_in_stock(p1, include_reservations=True), 3)
+        timer.join()
+        self.assertEqual(third.stock_transactions.count(), 1)
+
+    def test_39_stock_availability_tag(self):
+        """Test the stock availability template tag for catalog listings"""
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=5)
+        p3 = self.create_product()
+
+        other = Order.objects.create(currency="CHF")
+        StockTransaction.objects.create(
+            product=p1,
+            order=other,
+            type=StockTransaction.PAYMENT_PROCESS_RESERVATION,
+            change=-3,
+        )
+
+        Product = plata.product_model()
+        template = Template(
+            "{% load plata_tags %}{% stock_availability products as stock %}"
+            "{% for product in products %}{{ product.stock_available }},"
+            "{% endfor %}"
+        )
+
+        products = Product.objects.order_by("pk")
+        Period.objects.current()
+        # The products and their availability
+        with self.assertNumQueries(2):
+            self.assertEqual(template.render(Context({"products": products})), "7,5,0,")
+
+        cache.clear()
+        plata.settings.PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT = 60
+        try:
+            backend = plata.stock_backend()
+            self.assertEqual(
+                backend.cached_availability([p1, p2]), {p1.pk: 7, p2.pk: 5}
+            )
+            other.stock_transactions.all().delete()
+
+            # Only the products missing in the cache are queried
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    backend.cached_availability([p1, p2, p3]),
+                    {p1.pk: 7, p2.pk: 5, p3.pk: 0},
+                )
+            with self.assertNumQueries(0):
+                backend.cached_availability([p1, p2, p3])
+        finally:
+            plata.settings.PLATA_STOCK_AVAILABILITY_CACHE_TIMEOUT = 0
+            cache.clear()
+
+    def test_40_compact_period(self):
+        """Test archiving and summarizing the transactions of closed periods"""
+        Period.objects.create(name="2025", start=timezone.now() - timedelta(days=1))
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=5)
+        p3 = self.create_product(stock=1)
+
+        order = self.create_order()
+        order.modify_item(p1, 3)
+        StockTransaction.objects.bulk_create(
+            order, type=StockTransaction.SALE, negative=True
+        )
+        StockTransaction.objects.create(
+            product=p1, type=StockTransaction.PURCHASE, change=4
+        )
+        p3.delete()
+
+        old = Period.objects.current()
+        self.assertRaises(ValueError, StockTransaction.objects.compact_period, old)
+
+        StockTransaction.objects.open_new_period(name="2026")
+
+        def totals():
+            return set(
+                old.stock_transactions.order_by()
+                .values_list("product", "type")
+                .annotate(Sum("change"))
+            )
+
+        before = totals()
+        calls = []
+        with tempfile.TemporaryFile("w+", encoding="utf-8") as archive:
+            self.assertEqual(
+                StockTransaction.objects.compact_period(
+                    old,
+                    archive=archive,
+                    chunk_size=1,
+                    progress=lambda processed, total: calls.append((processed, total)),
+                ),
+                2,
+            )
+            archive.seek(0)
+            archived = list(serializers.deserialize("jsonl", archive.read()))
+        self.assertEqual(calls, [(1, 2), (2, 2)])
+        self.assertEqual(totals(), before - {(None, StockTransaction.PURCHASE, 1)})
+        self.assertEqual(old.stock_transactions.filter(product=p1).count(), 2)
+        self.assertEqual(old.stock_transactions.filter(product=p2).count(), 1)
+        self.assertEqual(StockTransaction.objects.reconcile(old), [])
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # The raw transactions of p1 and the transaction of p3
+        self.assertEqual(len(archived), 4)
+        self.assertEqual({obj.object.order_id for obj in archived}, {order.pk, None})
+
+        # Compacted periods are left alone
+        output = StringIO()
+        call_command(
+            "plata_stock_compact_period", str(old.pk), "--no-archive", stdout=output
+        )
+        self.assertIn("removed 0 transactions", output.getvalue())
+        with tempfile.NamedTemporaryFile("r", encoding="utf-8") as archive:
+            output = StringIO()
+            call_command(
+                "plata_stock_compact_period",
+                str(old.pk),
+                "--archive",
+                archive.name,
+                stdout=output,
+            )
+            self.assertIn("removed 0 transactions", output.getvalue())
+            self.assertEqual(archive.read(), "")
+        self.assertEqual(
+            plata.reporting.product.product_xls(old)
+            .to_response("products.xlsx")
+            .status_code,
+            200,
+        )
+
+    def test_41_release_reservations(self):
+        """Test releasing all payment process reservations of an order"""
+        p1 = self.create_product(stock=10)
+        p2 = self.create_product(stock=10)
+
+        order = self.create_order()
+        order.modify_item(p1, 2)
+        order.modify_item(p2, 3)
+
+        processor = plata.shop_instance().get_payment_modules()[0]
+        processor.reserve_stock_item(order, processor.create_pending_payment(order))
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 8, p2.pk: 7},
+        )
+
+        with self.assertNumQueries(5):
+            # Savepoint, select, delete, a single balance update and release
+            self.assertEqual(StockTransaction.objects.release_reservations(order), 2)
+
+        self.assertEqual(
+            StockTransaction.objects.availability([p1, p2], include_reservations=True),
+            {p1.pk: 10, p2.pk: 10},
+        )
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # The payment module releases the reservations of pending payments
+        processor.reserve_stock_item(order, processor.create_pending_payment(order))
+        processor.clear_pending_payments(order)
+        self.assertFalse(order.stock_transactions.exists())
+        self.assertFalse(order.payments.exists())
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+    def test_42_payment_tokens(self):
+        """Test confirmation tokens of the prepay and check payment modules"""
+        product = self.create_product()
+        order = self.create_order()
+        order.modify_item(product, 1)
+
+        # Tokens used to be stored in the order notes
+        token = str(uuid4())
+        order.notes = token
+        order.save()
+        payment = order.payments.create(
+            currency=order.currency,
+            amount=order.balance_remaining,
+            payment_module_key="prepay",
+        )
+
+        move_payment_tokens(django_apps, None)
+        self.assertEqual(OrderPayment.objects.get(pk=payment.pk).token, token)
+        self.assertEqual(Order.objects.get(pk=order.pk).notes, "")
+
+        shop = plata.shop_instance()
+        self.assertRaises(
+            Http404, check.PaymentProcessor(shop).confirm, get_request(), token
+        )
+
+        processor = prepay.PaymentProcessor(shop)
+        self.assertRaises(Http404, processor.confirm, get_request(), str(uuid4()))
+        with self.assertNumQueries(1):
+            self.assertRaises(Http404, processor.confirm, get_request(), "")
+
+        self.assertEqual(
+            processor.confirm(get_request(), token).content, b"Order authorized"
+        )
+        self.assertEqual(
+            OrderPayment.objects.get(pk=payment.pk).status, OrderPayment.AUTHORIZED
+        )
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.PAID)
+        self.assertEqual(
+            processor.confirm(get_request(), token).content, b"Already authorized"
+        )
+
+    def test_43_incremental_order_paid(self):
+        """Test maintaining Order.paid incrementally"""
+        product = self.create_product()
+        order = self.create_order()
+        order.modify_item(product, 2)
+        total = order.total
+
+        payment = order.payments.create(
+            currency="CHF", amount=Decimal("100.00"), payment_module_key="cod"
+        )
+        self.assertEqual(Order.objects.get(pk=order.pk).paid, 0)
+
+        payment.authorized = timezone.now()
+        with self.assertNumQueries(6):
+            # Savepoint, locked read of the saved payment, payment update,
+            # paid update, reading back paid and releasing the savepoint
+            payment.save()
+        # The cached order instance is up to date
+        self.assertEqual(order.paid, Decimal("100.00"))
+        self.assertEqual(order.balance_remaining, total - Decimal("100.00"))
+
+        payment = order.payments.get(pk=payment.pk)
+        payment.amount = Decimal("120.00")
+        payment.save()
+        self.assertEqual(order.paid, Decimal("120.00"))
+
+        # Instances loaded before either of them has been saved apply the
+        # difference to the saved state, not to the state they were loaded in
+        first = OrderPayment.objects.get(pk=payment.pk)
+        second = OrderPayment.objects.get(pk=payment.pk)
+        first.amount = second.amount = Decimal("150.00")
+        first.save()
+        second.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).paid, Decimal("150.00"))
+        second.delete()
+        first.delete()
+        self.assertEqual(Order.objects.get(pk=order.pk).paid, 0)
+
+        payment = order.payments.create(
+            currency="CHF",
+            amount=Decimal("120.00"),
+            payment_module_key="cod",
+            authorized=timezone.now(),
+        )
+        self.assertEqual(order.paid, Decimal("120.00"))
+
+        # Payments in other currencies do not count
+        other = order.payments.create(
+            currency="EUR",
+            amount=Decimal("50.00"),
+            payment_module_key="cod",
+            authorized=timezone.now(),
+        )
+        self.assertEqual(Order.objects.get(pk=order.pk).paid, Decimal("120.00"))
+        self.assertIn("does not match", Order.objects.get(pk=order.pk).notes)
+        other.delete()
+
+        payment.delete()
+        self.assertEqual(order.paid, 0)
+
+        order.payments.create(
+            currency="CHF",
+            amount=Decimal("10.00"),
+            payment_module_key="cod",
+            authorized=timezone.now(),
+        )
+        Order.objects.filter(pk=order.pk).update(paid=Decimal("99.00"))
+        order = Order.objects.get(pk=order.pk)
+        order.recalculate_paid()
+        self.assertEqual(order.paid, Decimal("10.00"))
+        self.assertEqual(Order.objects.get(pk=order.pk).paid, Decimal("10.00"))
+
+    def test_44_payment_http_client(self):
+        """Test connection reuse, retries and timeouts of the HTTP client"""
+        responses = [(503, b"unavailable"), (200, b"VERIFIED"), (200, b"OK")]
+
+        with StubServer(lambda request: responses.pop(0)) as server:
+            client = StubHTTPClient(retries=2)
+            response = client.post("https://psp.example.com/verify", {"a": 1})
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.text, "VERIFIED")
+            self.assertEqual(client.get("https://psp.example.com/").content, b"OK")
+
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(server.requests[0]["body"], b"a=1")
+            self.assertEqual(server.requests[1]["path"], "/verify")
+            self.assertEqual(server.requests[2]["method"], "GET")
+            # All requests have been sent over the same connection
+            self.assertEqual(len({request["port"] for request in server.requests}), 1)
+
+            # Server errors are returned after the last attempt
+            responses[:] = [(502, b"bad gateway")]
+            response = StubHTTPClient(retries=0).get("https://psp.example.com/")
+            self.assertEqual(response.status, 502)
+            client.close()
+
+        def slow(request):
+            time.sleep(0.5)
+            return 200, b"late"
+
+        with StubServer(slow) as server:
+            client = StubHTTPClient(timeout=(1, 0.1), retries=1)
+            with self.assertRaises(socket.timeout):
+                client.get("https://psp.example.com/")
+            # The call has been retried once
+            time.sleep(0.6)
+            self.assertEqual(len(server.requests), 2)
+
+        self.assertIs(plata.payment.http.get_client(), plata.payment.http.get_client())
+
+    def test_45_document_store(self):
+        """Test storing generated documents until the order changes"""
+        order = self.create_order()
+        order.modify_item(self.create_product(), 2)
+
+        # Without storage, documents are generated every time
+        self.assertTrue(get_document(order, "invoice").startswith(b"%PDF"))
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(
+            setattr,
+            plata.settings,
+            "PLATA_REPORTING_DOCUMENT_STORAGE",
+            plata.settings.PLATA_REPORTING_DOCUMENT_STORAGE,
+        )
+        plata.settings.PLATA_REPORTING_DOCUMENT_STORAGE = (
+            "django.core.files.storage.FileSystemStorage"
+        )
+        directory = os.path.join(location, "plata", "documents", str(order.pk))
+
+        with self.settings(MEDIA_ROOT=location):
+            invoice = get_document(order, "invoice")
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            # Stored documents are read without generating them again
+            with self.assertNumQueries(2):  # Fingerprint: items and payments
+                self.assertEqual(get_document(order, "invoice"), invoice)
+            self.assertEqual(
+                SendInvoiceHandler().invoice_pdf(Order.objects.get(pk=order.pk)),
+                invoice,
+            )
+
+            staff = User.objects.create_superuser("admin", "admin@example.com", "pw")
+            self.client.force_login(staff)
+            response = self.client.get("/reporting/invoice_pdf/%s/" % order.pk)
+            self.assertEqual(response.content, invoice)
+            self.assertEqual(
+                response["Content-Disposition"],
+                'attachment; filename="invoice-%09d.pdf"' % order.pk,
+            )
+
+            # Changing the order replaces the stored document
+            fingerprint = documents.fingerprint(order)
+            order.modify_item(order.items.get().product, 1)
+            self.assertNotEqual(documents.fingerprint(order), fingerprint)
+            self.assertNotEqual(get_document(order, "invoice"), invoice)
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            order.payments.create(
+                currency=order.currency,
+                amount=order.balance_remaining,
+                payment_module_key="cod",
+                payment_method="Cash",
+                authorized=timezone.now(),
+            )
+            self.assertNotEqual(documents.fingerprint(order), fingerprint)
+
+            get_document(order, "packing-slip")
+            self.assertEqual(
+                sorted(name.split("-")[0] for name in os.listdir(directory)),
+                ["invoice", "packing"],
+            )
+            documents.invalidate(order, "invoice")
+            self.assertEqual(len(os.listdir(directory)), 1)
+            documents.invalidate(order)
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_46_font_registration(self):
+        """Test that custom fonts are parsed once per process"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        import reportlab
+        from reportlab.pdfbase import pdfmetrics
+
+        import plata.reporting.pdfdocument
+
+        parsed = []
+
+        class TTFont(plata.reporting.pdfdocument.TTFont):
+            def __init__(self, name, path):
+                parsed.append(name)
+                super().__init__(name, path)
+
+        self.addCleanup(
+            setattr,
+            plata.reporting.pdfdocument,
+            "TTFont",
+            plata.reporting.pdfdocument.TTFont,
+        )
+        plata.reporting.pdfdocument.TTFont = TTFont
+
+        fonts = os.path.join(os.path.dirname(reportlab.__file__), "fonts")
+        for name, value in [
+            ("PLATA_PDF_FONT_NAME", "PlataVera"),
+            ("PLATA_PDF_FONT_PATH", os.path.join(fonts, "Vera.ttf")),
+            ("PLATA_PDF_FONT_BOLD_NAME", "PlataVera-Bold"),
+            ("PLATA_PDF_FONT_BOLD_PATH", os.path.join(fonts, "VeraBd.ttf")),
+        ]:
+            self.addCleanup(
+                setattr, plata.settings, name, getattr(plata.settings, name)
+            )
+            setattr(plata.settings, name, value)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for pdf in executor.map(lambda i: PlataPDFDocument(BytesIO()), range(8)):
+                pdf.init_report()
+                pdf.p("Invoice")
+                pdf.generate()
+
+        self.assertEqual(sorted(parsed), ["PlataVera", "PlataVera-Bold"])
+        self.assertIsInstance(pdfmetrics.getFont("PlataVera-Bold"), TTFont)
+
+        # Fonts are registered again for a different path
+        plata.settings.PLATA_PDF_FONT_BOLD_PATH = os.path.join(fonts, "VeraBI.ttf")
+        PlataPDFDocument(BytesIO())
+        PlataPDFDocument(BytesIO())
+        self.assertEqual(len(parsed), 3)
+
+    def test_47_batch_documents(self):
+        """Test rendering the documents of many orders at once"""
+        import zipfile
+
+        from django.utils.translation import get_language, override
+        from pypdf import PdfReader
+
+        from plata.reporting.batch import (
+            _render_in_worker,
+            render_batch,
+            render_documents,
+        )
+
+        product = self.create_product(stock=10)
+        orders = []
+        for language_code in ("de", "en", ""):
+            order = Order.objects.create(currency="CHF", language_code=language_code)
+            order.modify_item(product, 1)
+            orders.append(order)
+
+        with override("fr"):
+            documents = render_documents(orders, "packing-slip", processes=1)
+            # Orders' languages do not leak into the calling thread
+            self.assertEqual(get_language(), "fr")
+        self.assertEqual([order for order, content in documents], orders)
+
+        # Worker processes load the order and its data using one query each
+        with self.assertNumQueries(3):
+            content = _render_in_worker(orders[0].pk, "invoice")
+        self.assertEqual(len(PdfReader(BytesIO(content)).pages), 1)
+
+        class InlineExecutor:
+            """Runs the worker function in this process and database transaction"""
+
+            def __init__(self, max_workers, **kwargs):
+                pools.append(max_workers)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def map(self, fn, *iterables, chunksize=1):
+                return map(fn, *iterables)
+
+        pools = []
+        self.addCleanup(
+            setattr,
+            plata.reporting.batch,
+            "ProcessPoolExecutor",
+            plata.reporting.batch.ProcessPoolExecutor,
+        )
+        plata.reporting.batch.ProcessPoolExecutor = InlineExecutor
+
+        queryset = Order.objects.filter(pk__in=[order.pk for order in orders])
+        # Counting and loading the primary keys in this process, the orders
+        # and their data in the workers
+        with self.assertNumQueries(2 + 3 * 3):
+            content, content_type, filename = render_batch(
+                queryset, "invoice", "zip", processes=None
+            )
+        self.assertEqual(pools, [plata.settings.PLATA_REPORTING_BATCH_PROCESSES])
+        self.assertEqual(
+            zipfile.ZipFile(BytesIO(content)).namelist(),
+            ["invoice-%09d.pdf" % order.pk for order in orders],
+        )
+
+        queryset = Order.objects.filter(pk__in=[order.pk for order in orders])
+        content, content_type, filename = render_batch(
+            queryset, "invoice", "pdf", processes=1
+        )
+        self.assertEqual(content_type, "application/pdf")
+        self.assertTrue(filename.startswith("invoice-"))
+        self.assertEqual(len(PdfReader(BytesIO(content)).pages), 3)
+
+        content, content_type, filename = render_batch(
+            queryset, "packing-slip", "zip", processes=1
+        )
+        self.assertEqual(content_type, "application/zip")
+        self.assertEqual(
+            zipfile.ZipFile(BytesIO(content)).namelist(),
+            ["packing-slip-%09d.pdf" % order.pk for order in orders],
+        )
+
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as output:
+            call_command(
+                "plata_documents",
+                "packing-slip",
+                output.name,
+                order=[orders[0].pk, orders[2].pk],
+                processes=1,
+                stdout=StringIO(),
+            )
+            self.assertEqual(len(PdfReader(output.name).pages), 2)
+
+    def test_48_pick_list(self):
+        """Test summing up the quantities of many orders per SKU"""
+        from openpyxl import load_workbook
+
+        from plata.reporting.pick_list import pick_list
+
+        p1 = self.create_product(stock=100)
+        p2 = self.create_product(stock=100)
+
+        today = timezone.now()
+        for quantity, status, confirmed in [
+            (1, Order.PAID, today),
+            (2, Order.PAID, today),
+            (4, Order.PAID, today - timedelta(days=3)),
+            (8, Order.CHECKOUT, today),
+        ]:
+            order = Order.objects.create(currency="CHF")
+            order.modify_item(p1, quantity)
+            order.modify_item(p2, 10 * quantity)
+            Order.objects.filter(pk=order.pk).update(status=status, confirmed=confirmed)
+        OrderItem.objects.filter(product=p1).update(sku="B-1")
+        OrderItem.objects.filter(product=p2).update(sku="A-2")
+
+        with self.assertNumQueries(1):
+            rows = pick_list(
+                status=Order.PAID,
+                date_from=timezone.localdate(today),
+                date_to=timezone.localdate(today),
+            )
+        self.assertEqual(
+            [(row["sku"], row["quantity"], row["orders"]) for row in rows],
+            [("A-2", 30, 2), ("B-1", 3, 2)],
+        )
+        self.assertEqual(
+            [row["quantity"] for row in pick_list(status=[Order.PAID])], [70, 7]
+        )
+        self.assertEqual([row["quantity"] for row in pick_list()], [150, 15])
+
+        staff = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(staff)
+
+        response = self.client.get(
+            "/reporting/pick_list_pdf/",
+            {"status": Order.PAID, "from": timezone.localdate(today).isoformat()},
+        )
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertTrue(response.content.startswith(b"%PDF"))
+
+        response = self.client.get(
+            "/reporting/pick_list_xls/", {"status": [Order.PAID, Order.CHECKOUT]}
+        )
+        sheet = load_workbook(BytesIO(response.content)).active
+        self.assertEqual(
+            [row[::2] for row in sheet.iter_rows(min_row=2, values_only=True)],
+            [("A-2", 150), ("B-1", 15)],
+        )
+
+        self.assertEqual(
+            self.client.get("/reporting/pick_list_pdf/", {"from": "x"}).status_code,
+            400,
+        )
+
+    def test_49_report_queries(self):
+        """Test that reports load the order's data once regardless of its size"""
+        from plata.reporting.order import OrderReportData
+
+        for lines in (1, 10):
+            order = Order.objects.create(currency="CHF")
+            for i in range(lines):
+                order.modify_item(self.create_product(stock=10), 1)
+            order.payments.create(
+                currency=order.currency,
+                amount=order.balance_remaining,
+                payment_module_key="cod",
+                payment_method="Cash",
+                authorized=timezone.now(),
+            )
+            Order.objects.filter(pk=order.pk).update(paid=order.total)
+
+            order = Order.objects.get(pk=order.pk)
+            # Items and payments
+            with self.assertNumQueries(2):
+                plata.reporting.order.invoice_pdf(PlataPDFDocument(BytesIO()), order)
+
+            order = Order.objects.prefetch_related(
+                *OrderReportData.prefetch_related
+            ).get(pk=order.pk)
+            with self.assertNumQueries(0):
+                plata.reporting.order.invoice_pdf(PlataPDFDocument(BytesIO()), order)
+                plata.reporting.order.packing_slip_pdf(
+                    PlataPDFDocument(BytesIO()), order
+                )
+
+            data = OrderReportData(order)
+            self.assertEqual(data.subtotal, order.subtotal)
+            self.assertEqual(data.discount, order.discount)
+            self.assertEqual(len(data.items), lines)
+            self.assertEqual(len(data.authorized_payments), 1)
+
+    def test_50_product_export(self):
+        """Test exporting the stock of all products in chunks"""
+        import csv
+
+        from openpyxl import load_workbook
+
+        products = [self.create_product(stock=i + 1) for i in range(5)]
+        products[1].stock_transactions.create(type=StockTransaction.SALE, change=-1)
+
+        rows = list(plata.reporting.product.product_rows(chunk_size=2))
+        self.assertEqual([row[0] for row in rows], products)
+        self.assertEqual([row[2] for row in rows], [1, 1, 3, 4, 5])
+        sale = [key for key, name in StockTransaction.TYPE_CHOICES].index(
+            StockTransaction.SALE
+        )
+        self.assertEqual([row[3 + sale] for row in rows], ["", -1, "", "", ""])
+
+        staff = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.client.force_login(staff)
+
+        response = self.client.get("/reporting/product_csv/")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = list(
+            csv.reader(b"".join(response.streaming_content).decode().splitlines())
+        )
+        self.assertEqual(lines[0], plata.reporting.product.product_titles())
+        self.assertEqual(
+            [line[:3] for line in lines[1:]],
+            [[str(row[0]), row[1], str(row[2])] for row in rows],
+        )
+
+        response = self.client.get("/reporting/product_xls/")
+        sheet = load_workbook(BytesIO(b"".join(response.streaming_content))).active
+        self.assertEqual(
+            [row[2] for row in sheet.iter_rows(min_row=2, values_only=True)],
+            [1, 1, 3, 4, 5],
+        )
+
+    def test_51_order_export(self):
+        """Test exporting orders in chunks"""
+        import csv
+
+        from plata.reporting.export import order_csv, order_rows, order_titles
+
+        product = self.create_product(stock=100)
+        orders = []
+        for i in range(5):
+            order = Order.objects.create(currency="CHF")
+            order.modify_item(product, i + 1)
+            order.payments.create(
+                currency=order.currency,
+                amount=order.balance_remaining,
+                payment_module_key="cod",
+                payment_method="Cash",
+                transaction_id="T%s" % i,
+                authorized=timezone.now() if i % 2 else None,
+            )
+            orders.append(order)
+
+        # One query for the orders, two per chunk for items and payments
+        with self.assertNumQueries(7):
+            rows = list(order_rows(Order.objects.all(), chunk_size=2))
+
+        titles = order_titles(Order)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual({len(row) for row in rows}, {len(titles)})
+        self.assertEqual(
+            [row[-3] for row in rows],
+            ["%s x %s" % (i + 1, orders[i].items.get().name) for i in range(5)],
+        )
+        self.assertEqual(
+            [row[-2] for row in rows],
+            [
+                "",
+                "CHF %s Cash T1" % orders[1].total,
+                "",
+                "CHF %s Cash T3" % orders[3].total,
+                "",
+            ],
+        )
+
+        lines = list(csv.reader("".join(order_csv(Order.objects.all())).splitlines()))
+        self.assertEqual(lines[0], titles)
+        self.assertEqual(len(lines), 6)
+
+    def test_52_stale_period_cache(self):
+        """Test that periods cached by other processes expire in time"""
+        product = self.create_product(stock=10)
+        Product = product.__class__
+
+        old = Period.objects.current()
+        # The cache of another process, which is not cleared when this
+        # process saves the new period
+        stale = PeriodManager._current
+        self.assertEqual(stale[0], old)
+
+        period = StockTransaction.objects.open_new_period()
+        self.assertGreaterEqual(period.start, stale[1])
+
+        PeriodManager._current = stale
+        self.assertEqual(Period.objects.current(), period)
+        StockTransaction.objects.create(
+            product=product, type=StockTransaction.SALE, change=-3
+        )
+        self.assertEqual(
+            StockTransaction.objects.get(type=StockTransaction.SALE).period, period
+        )
+        self.assertEqual(Product.objects.get(pk=product.pk).items_in_stock, 7)
+        self.assertEqual(
+            StockTransaction.objects.availability([product]), {product.pk: 7}
+        )
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
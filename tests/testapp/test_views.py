@@ -1,19 +1,40 @@
+import smtplib
+import time
 import warnings
 from datetime import timedelta
-from io import BytesIO
+from hashlib import sha1
+from io import StringIO
 from urllib.parse import parse_qs
 
 import django
 from django.core import mail
 from django.core.exceptions import ValidationError
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.db import transaction
+from django.dispatch import Signal
+from django.test import RequestFactory
 from django.utils import timezone
 
 import plata
 from plata.contact.models import Contact
 from plata.discount.models import Discount
+from plata.payment.breaker import breaker_states
+from plata.payment.modules import datatrans, pagseguro
 from plata.product.stock.models import Period, StockTransaction
-from plata.shop.models import Order, OrderPayment
-from testapp.base import PlataTest, get_request
+from plata.shop import outbox, signals
+from plata.shop.admin import requeue_messages
+from plata.shop.mail import deliver_queued, send_messages
+from plata.shop.models import (
+    Order,
+    OrderPayment,
+    OutboxMessage,
+    PaymentNotification,
+    QueuedEmail,
+)
+from plata.shop.notifications import SendPackingSlipHandler
+from plata.shop.outbox import process_outbox
+from testapp.base import PlataTest, StubSMTPServer, get_request
 
 
 try:  # pragma: no cover
@@ -253,13 +274,15 @@ class ViewTest(PlataTest):
         # Test this view works at all
         client.get("/order/payment_failure/")
 
-        self.assertRedirects(
-            client.post(
-                "/confirmation/",
-                {"terms_and_conditions": True, "payment_method": "cod"},
-            ),
-            "/order/success/",
-        )
+        # order_paid receivers are called when the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertRedirects(
+                client.post(
+                    "/confirmation/",
+                    {"terms_and_conditions": True, "payment_method": "cod"},
+                ),
+                "/order/success/",
+            )
         self.assertEqual(
             len(mail.outbox), 3
         )  # account creation, invoice and packing slip
@@ -416,17 +439,14 @@ class ViewTest(PlataTest):
             "last_name": "H\xe5konsen",
         }
 
-        from plata.payment.modules import paypal
-
-        def mock_urlopen(*args, **kwargs):
-            qs = parse_qs(args[1])
+        def verify(request):
+            qs = parse_qs(request["body"].decode("utf-8"))
             self.assertEqual(qs["cmd"][0], "_notify-validate")
             for k, v in paypal_ipn_data.items():
                 self.assertEqual("%s" % qs[k][0], v)
-            s = BytesIO(b"VERIFIED")
-            return s
+            return 200, b"VERIFIED"
 
-        paypal.urlopen = mock_urlopen
+        self.stub_payment_server(verify)
 
         product = self.create_product()
         client = self.login()
@@ -715,13 +735,13 @@ class ViewTest(PlataTest):
             StockTransaction.objects.items_in_stock(p1, include_reservations=True), 3
         )
 
-        StockTransaction.objects.update(created=timezone.now() - timedelta(minutes=10))
+        StockTransaction.objects.update(expires=timezone.now() + timedelta(minutes=5))
         self.assertEqual(StockTransaction.objects.items_in_stock(p1), 10)
         self.assertEqual(
             StockTransaction.objects.items_in_stock(p1, include_reservations=True), 3
         )
 
-        StockTransaction.objects.update(created=timezone.now() - timedelta(minutes=20))
+        StockTransaction.objects.update(expires=timezone.now() - timedelta(minutes=5))
         self.assertEqual(
             StockTransaction.objects.items_in_stock(p1, include_reservations=True), 10
         )
@@ -731,7 +751,7 @@ class ViewTest(PlataTest):
         order.modify_item(p1, relative=5)
         order.validate(order.VALIDATE_ALL)
 
-        StockTransaction.objects.update(created=timezone.now() - timedelta(minutes=10))
+        StockTransaction.objects.update(expires=timezone.now() + timedelta(minutes=5))
         self.assertRaises(ValidationError, order.validate, order.VALIDATE_ALL)
 
     def test_14_remaining_discount(self):
@@ -802,3 +822,415 @@ class ViewTest(PlataTest):
         self.assertEqual(StockTransaction.objects.count(), 3)
         p1 = Product.objects.get(pk=p1.pk)
         self.assertEqual(p1.items_in_stock, 4)
+
+    def test_15_concurrent_reservation(self):
+        """Test that stock reserved concurrently during checkout is respected"""
+        product = self.create_product(stock=5)
+        client = self.login()
+        client.post(product.get_absolute_url(), {"quantity": 4})
+
+        def competing_checkout(order, **kwargs):
+            # Another customer is faster after our cart has been validated
+            other = Order.objects.create(currency="CHF")
+            other.modify_item(product, 3)
+            StockTransaction.objects.reserve(other)
+
+        signals.order_confirmed.connect(competing_checkout)
+        try:
+            response = client.post(
+                "/confirmation/",
+                {"terms_and_conditions": True, "payment_method": "paypal"},
+            )
+        finally:
+            signals.order_confirmed.disconnect(competing_checkout)
+
+        self.assertRedirects(response, "/cart/", fetch_redirect_response=False)
+
+        order = Order.objects.get(user__isnull=False)
+        self.assertEqual(order.status, Order.CHECKOUT)
+        self.assertEqual(order.payments.count(), 0)
+        self.assertEqual(order.stock_transactions.count(), 0)
+        self.assertEqual(
+            StockTransaction.objects.filter(
+                type=StockTransaction.PAYMENT_PROCESS_RESERVATION
+            ).count(),
+            1,
+        )
+        self.assertContains(client.get("/cart/"), "Not enough stock available for")
+
+    def test_16_duplicate_notifications(self):
+        """Test that retried PSP notifications are processed only once"""
+        product = self.create_product()
+        client = self.login()
+
+        product.stock_transactions.create(type=StockTransaction.PURCHASE, change=10)
+        client.post(product.get_absolute_url(), {"quantity": 5})
+        client.post(
+            "/confirmation/",
+            {"terms_and_conditions": True, "payment_method": "postfinance"},
+        )
+        order = Order.objects.get()
+        payment = order.payments.get()
+
+        def notify(status):
+            ipn_data = {
+                "orderID": "Order-%s-%s" % (order.pk, payment.pk),
+                "currency": order.currency,
+                "amount": "%s" % order.balance_remaining,
+                "PM": "Postfinance",
+                "ACCEPTANCE": "xxx",
+                "STATUS": status,
+                "CARDNO": "xxxxxxxxxxxx1111",
+                "PAYID": "123456789",
+                "NCERROR": "",
+                "BRAND": "VISA",
+            }
+            sha1_source = "".join(ipn_data.values()) + "plataSHA1_OUT"
+            ipn_data["SHASIGN"] = sha1(sha1_source.encode("utf-8")).hexdigest()
+            return self.client.post("/payment/postfinance/ipn/", ipn_data)
+
+        sales = StockTransaction.objects.filter(type=StockTransaction.SALE)
+
+        self.assertContains(notify("5"), "OK")
+        self.assertEqual(Order.objects.get().status, Order.PAID)
+        self.assertEqual(sales.count(), 1)
+
+        # A retry is acknowledged without doing anything
+        with self.assertNumQueries(7):
+            # The order lookup, savepoints and the failing journal insert
+            self.assertContains(notify("5"), "OK")
+        self.assertEqual(PaymentNotification.objects.count(), 1)
+
+        # A new status is processed, but does not sell the items again
+        self.assertContains(notify("9"), "OK")
+        self.assertEqual(PaymentNotification.objects.count(), 2)
+        self.assertEqual(sales.count(), 1)
+        self.assertEqual(StockTransaction.objects.reconcile(), [])
+
+        # Retries are acknowledged without querying the PSP again
+        server = self.stub_payment_server(lambda request: (500, b""))
+        shop = plata.shop_instance()
+        factory = RequestFactory()
+        for module, status in ((datatrans, "1"), (pagseguro, "3")):
+            PaymentNotification.objects.create(
+                payment_module_key=module.PaymentProcessor.key,
+                transaction_id="%s-%s" % (order.pk, payment.pk),
+                status=status,
+                order=order,
+            )
+
+        with self.settings(DATATRANS={"MERCHANT_ID": "1"}):
+            response = datatrans.PaymentProcessor(shop).datatrans_success(
+                factory.post(
+                    "/payment/datatrans/success/",
+                    {
+                        "uppTransactionId": "42",
+                        "refno": "%s-%s" % (order.pk, payment.pk),
+                        "responseCode": "1",
+                    },
+                )
+            )
+            self.assertRedirects(
+                response, "/order/success/", fetch_redirect_response=False
+            )
+        with self.settings(PAGSEGURO={}):
+            response = pagseguro.PaymentProcessor(shop).psnotify(
+                factory.post(
+                    "/payment/pagseguro/notify/",
+                    {"notificationCode": "%s-%s" % (order.pk, payment.pk)},
+                )
+            )
+            self.assertEqual(response.content, b"OK")
+        self.assertEqual(server.requests, [])
+
+    def test_17_circuit_breaker(self):
+        """Test the circuit breaker guarding calls to payment service providers"""
+        delay = [0.5]
+
+        def verify(request):
+            time.sleep(delay[0])
+            return 200, b"INVALID"
+
+        server = self.stub_payment_server(verify)
+        for name, value in (
+            ("PLATA_PAYMENT_BREAKER_THRESHOLD", 2),
+            ("PLATA_PAYMENT_BREAKER_RESET_TIMEOUT", 1),
+            ("PLATA_PAYMENT_LATENCY_BUDGET", 0.2),
+        ):
+            self.addCleanup(
+                setattr, plata.settings, name, getattr(plata.settings, name)
+            )
+            setattr(plata.settings, name, value)
+
+        shop = plata.shop_instance()
+        paypal = next(m for m in shop.get_payment_modules() if m.key == "paypal")
+
+        def keys():
+            return [m.key for m in shop.get_payment_modules(get_request())]
+
+        self.assertIn("paypal", keys())
+
+        ipn_data = {"txn_id": "123", "payment_status": "Completed"}
+
+        # The slow PSP exceeds the latency budget, retries are skipped
+        for i in range(2):
+            with self.assertRaises(OSError):
+                self.client.post("/payment/paypal/ipn/", ipn_data)
+        self.assertEqual(len(server.requests), 2)
+
+        status = {s["key"]: s for s in breaker_states()}["paypal"]
+        self.assertEqual(status["state"], "open")
+        self.assertEqual(status["failures"], 2)
+        self.assertNotIn("paypal", keys())
+        self.assertIn("cod", keys())
+
+        # Open breakers fail fast without calling the PSP
+        response = self.client.post("/payment/paypal/ipn/", ipn_data)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(server.requests), 2)
+
+        # Slow but successful responses count as failures too
+        time.sleep(1)
+        self.assertEqual(paypal.breaker.state, "half-open")
+        self.assertIn("paypal", keys())
+        delay[0] = 0.3
+        with paypal.breaker.call():
+            self.assertTrue(paypal.breaker.is_open is False)
+            paypal.http_client.get("https://www.paypal.com/")
+        self.assertEqual(paypal.breaker.state, "open")
+
+        # Only one probe is let through while half-open, a successful probe
+        # closes the breaker
+        time.sleep(1)
+        delay[0] = 0
+        self.assertTrue(paypal.breaker.allow())
+        self.assertFalse(paypal.breaker.allow())
+        paypal.breaker.record_success(0.01)
+        self.assertEqual(paypal.breaker.state, "closed")
+        self.assertEqual(
+            self.client.post("/payment/paypal/ipn/", ipn_data).status_code, 403
+        )
+        self.assertEqual(paypal.breaker.status()["failures"], 0)
+        self.assertIn("paypal", keys())
+
+        # Excluded exceptions do not count as failures
+        with self.assertRaises(ValueError), paypal.breaker.call(exclude=ValueError):
+            raise ValueError
+        self.assertEqual(paypal.breaker.status()["failures"], 0)
+
+        paypal.breaker.record_failure()
+        paypal.breaker.record_failure()
+        out = StringIO()
+        call_command("plata_payment_breakers", stdout=out)
+        self.assertIn("paypal: open (2 failures", out.getvalue())
+        call_command("plata_payment_breakers", reset=["paypal"], stdout=out)
+        self.assertEqual(paypal.breaker.state, "closed")
+
+    def test_18_outbox(self):
+        """Test deferred delivery of signals using the transactional outbox"""
+        calls = []
+
+        def receiver(sender, order, payment, request, **kwargs):
+            calls.append((sender.key, order, payment, request))
+            if len(calls) == 1:
+                raise OSError("SMTP server unavailable")
+
+        deferred = outbox.deferred("test-receiver", receiver)
+        signals.order_paid.connect(deferred, weak=False)
+        self.addCleanup(signals.order_paid.disconnect, deferred)
+        self.addCleanup(outbox.receivers.pop, "test-receiver")
+
+        product = self.create_product()
+        client = self.login()
+        product.stock_transactions.create(type=StockTransaction.PURCHASE, change=10)
+        client.post(product.get_absolute_url(), {"quantity": 5})
+        client.post(
+            "/confirmation/",
+            {"terms_and_conditions": True, "payment_method": "postfinance"},
+        )
+        order = Order.objects.get()
+        payment = order.payments.get()
+
+        ipn_data = {
+            "orderID": "Order-%s-%s" % (order.pk, payment.pk),
+            "currency": order.currency,
+            "amount": "%s" % order.balance_remaining,
+            "PM": "Postfinance",
+            "ACCEPTANCE": "xxx",
+            "STATUS": "5",
+            "CARDNO": "xxxxxxxxxxxx1111",
+            "PAYID": "123456789",
+            "NCERROR": "",
+            "BRAND": "VISA",
+        }
+        sha1_source = "".join(ipn_data.values()) + "plataSHA1_OUT"
+        ipn_data["SHASIGN"] = sha1(sha1_source.encode("utf-8")).hexdigest()
+        self.assertContains(
+            self.client.post("/payment/postfinance/ipn/", ipn_data), "OK"
+        )
+
+        # The receiver has not been called yet
+        self.assertEqual(calls, [])
+        message = OutboxMessage.objects.get()
+        self.assertEqual(
+            message.kwargs["order"], {"model": "shop.order", "pk": order.pk}
+        )
+        self.assertEqual(message.kwargs["sender"], {"payment_module": "postfinance"})
+        self.assertEqual(message.kwargs["request"], None)
+
+        # The first delivery fails and is retried later
+        self.assertEqual(process_outbox(threads=1), (0, 1))
+        message.refresh_from_db()
+        self.assertEqual(message.status, OutboxMessage.PENDING)
+        self.assertEqual(message.attempts, 1)
+        self.assertIn("SMTP server unavailable", message.last_error)
+        self.assertEqual(process_outbox(threads=1), (0, 0))
+
+        OutboxMessage.objects.update(next_attempt=timezone.now())
+        out = StringIO()
+        call_command("plata_outbox_worker", threads=1, stdout=out)
+        self.assertIn("Delivered 1 messages, 0 deliveries failed.", out.getvalue())
+        self.assertEqual(calls[1], ("postfinance", order, payment, None))
+        message.refresh_from_db()
+        self.assertEqual(message.status, OutboxMessage.DELIVERED)
+        self.assertEqual(message.attempts, 2)
+
+        # Undeliverable messages are marked as failed and can be requeued
+        failing = OutboxMessage.objects.create(receiver="unknown")
+        self.assertEqual(process_outbox(threads=1, max_attempts=1), (0, 1))
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, OutboxMessage.FAILED)
+        requeue_messages(None, None, OutboxMessage.objects.all())
+        self.assertEqual(
+            dict(OutboxMessage.objects.values_list("pk", "status")),
+            {message.pk: OutboxMessage.DELIVERED, failing.pk: OutboxMessage.PENDING},
+        )
+
+        # Outbox messages are only stored if the status change is committed
+        other = self.create_order()
+        other.modify_item(product, 1)
+        other.status = Order.CONFIRMED
+        other.save()
+
+        processor = plata.shop_instance().get_payment_modules()[0]
+        with self.assertRaises(ValueError), transaction.atomic():
+            processor.order_paid(other)
+            raise ValueError
+        self.assertEqual(Order.objects.get(pk=other.pk).status, Order.CONFIRMED)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+        # Other receivers are called after the commit, their failures do not
+        # roll back the status change
+        def explode(**kwargs):
+            raise ValueError
+
+        signals.order_paid.connect(explode)
+        self.addCleanup(signals.order_paid.disconnect, explode)
+        other = Order.objects.get(pk=other.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            processor.order_paid(other)
+            self.assertEqual(OutboxMessage.objects.count(), 3)
+        self.assertEqual(len(callbacks), 1)
+        with self.assertLogs("plata.shop.outbox", "ERROR"):
+            callbacks[0]()
+        self.assertEqual(Order.objects.get(pk=other.pk).status, Order.PAID)
+
+    def test_19_mail_queue(self):
+        """Test sending e-mail over one connection and queueing failures"""
+
+        def message(to):
+            return EmailMessage("Order %s" % to, "Hällo", "shop@example.com", [to])
+
+        with StubSMTPServer(reject={"c@example.com"}) as server, self.settings(
+            **server.settings
+        ):
+            sent = send_messages(
+                [message("a@example.com"), message("b@example.com")]
+                + [message("c@example.com")]
+            )
+            self.assertEqual(sent, 2)
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(
+                [m["to"] for m in server.messages],
+                [["a@example.com"], ["b@example.com"]],
+            )
+
+            # The refused message has been queued for retrying
+            failed = QueuedEmail.objects.get()
+            self.assertEqual(failed.status, QueuedEmail.PENDING)
+            self.assertEqual(failed.attempts, 1)
+            self.assertIn("c@example.com", failed.last_error)
+            self.assertEqual(deliver_queued(), (0, 0))
+
+            # Delivery errors are raised if not failing silently
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                send_messages([message("c@example.com")], fail_silently=False)
+            self.assertEqual(QueuedEmail.objects.count(), 1)
+
+            # Messages which cannot even be rendered are logged, not raised
+            broken = message("g@example.com")
+            broken.message = lambda: 1 / 0
+            with self.assertLogs("plata.shop.mail", "ERROR") as logs:
+                self.assertEqual(send_messages([broken, message("h@example.com")]), 1)
+            self.assertIn("Queueing 'Order g@example.com' failed", logs.output[-1])
+            self.assertEqual(QueuedEmail.objects.count(), 1)
+
+            # The messages of all order_paid receivers share one connection
+            connections = server.connections
+            signal = Signal()
+            for to in ("i@example.com", "j@example.com"):
+                signal.connect(
+                    lambda sender, to=to, **kwargs: send_messages([message(to)]),
+                    weak=False,
+                )
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    outbox.send_on_commit(signal, sender=None)
+            self.assertEqual(server.connections, connections + 1)
+            self.assertEqual(
+                [m["to"] for m in server.messages[-2:]],
+                [["i@example.com"], ["j@example.com"]],
+            )
+
+        self.addCleanup(
+            setattr,
+            plata.settings,
+            "PLATA_EMAIL_QUEUE",
+            plata.settings.PLATA_EMAIL_QUEUE,
+        )
+        plata.settings.PLATA_EMAIL_QUEUE = True
+
+        with StubSMTPServer() as server, self.settings(**server.settings):
+            # Messages are only queued, also those of notification handlers
+            self.assertEqual(send_messages([message("d@example.com")]), 0)
+            SendPackingSlipHandler(always_to=["e@example.com"])(
+                None, order=self.create_order()
+            )
+            self.assertEqual(server.connections, 0)
+            self.assertEqual(QueuedEmail.objects.count(), 3)
+
+            QueuedEmail.objects.update(next_attempt=timezone.now())
+            out = StringIO()
+            call_command("plata_send_mail", stdout=out)
+            self.assertIn("Sent 3 messages, 0 failed.", out.getvalue())
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(
+                sorted(m["to"][0] for m in server.messages),
+                ["c@example.com", "d@example.com", "e@example.com"],
+            )
+            self.assertIn(
+                "Hällo".encode(), b"".join(m["data"] for m in server.messages)
+            )
+            self.assertEqual(
+                QueuedEmail.objects.filter(status=QueuedEmail.SENT).count(), 3
+            )
+
+        # Messages are marked as failed after the last attempt
+        with StubSMTPServer(reject={"f@example.com"}) as server, self.settings(
+            **server.settings
+        ):
+            send_messages([message("f@example.com")])
+            self.assertEqual(deliver_queued(max_attempts=1), (0, 1))
+            self.assertEqual(
+                QueuedEmail.objects.filter(status=QueuedEmail.FAILED).count(), 1
+            )